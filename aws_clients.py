@@ -0,0 +1,292 @@
+"""Create boto3 clients and execute their calls under shared rate limits.
+
+Every AWS call made by the Lambda functions goes through ``call`` (or
+``paginate``), which waits on a per-API token bucket, retries throttled and
+transient failures with jittered exponential backoff and counts throttles
+and retries per API.  botocore's own retries are switched off so attempts
+are not multiplied.  Clients are instrumented on creation and
+``flush_metrics`` publishes each invocation's figures as EMF logs.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import (ClientError, ConnectionError,
+                                 ConnectTimeoutError, ReadTimeoutError)
+
+import instrumentation
+from structured_logging import LogEvent, get_logger
+
+log = get_logger(__name__)
+
+# botocore must not retry underneath the retry loop in call()
+CLIENT_CONFIG = Config(retries={'total_max_attempts': 1, 'mode': 'standard'})
+
+THROTTLE_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RateExceeded',
+    'SlowDown',
+])
+TRANSIENT_CODES = frozenset([
+    'InternalError',
+    'InternalFailure',
+    'InternalServiceError',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    'RequestTimeout',
+    'RequestTimeoutException',
+])
+TRANSIENT_EXCEPTIONS = (ConnectionError, ConnectTimeoutError,
+                        ReadTimeoutError)
+
+# calls that start a stack update; one that reached CloudFormation before
+# failing is only safe to repeat under the same ClientRequestToken, so
+# without one only throttles, which were turned down, are retried
+TOKEN_IDEMPOTENT_APIS = frozenset([
+    'cloudformation:update_stack',
+    'cloudformation:execute_change_set',
+])
+
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.2  # seconds
+BACKOFF_CAP = 5.0  # seconds
+
+# sustained calls per second and burst size for each API; keys are
+# "{service}:{method}" and anything unlisted uses DEFAULT_RATE_LIMIT
+DEFAULT_RATE_LIMIT = (10.0, 10)
+RATE_LIMITS = {
+    'cloudformation:describe_stacks': (4.0, 8),
+    'cloudformation:update_stack': (2.0, 4),
+    'sts:assume_role': (5.0, 5),
+    'events:put_rule': (5.0, 5),
+    'events:put_targets': (5.0, 5),
+    'lambda:add_permission': (5.0, 5),
+    'lambda:remove_permission': (5.0, 5),
+}
+# e.g. API_RATE_LIMITS='{"cloudformation:describe_stacks": [2, 4]}'
+RATE_LIMITS.update({
+    api: tuple(limit) for api, limit in
+    json.loads(os.environ.get('API_RATE_LIMITS', '{}')).items()
+})
+
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service_name, region_name=None):
+    """Return the memoized client for a service and region."""
+    key = (service_name, region_name)
+    client = clients.get(key)
+    if client is None:
+        with clients_lock:
+            client = clients.get(key)
+            if client is None:
+                client = instrumentation.instrument(boto3.client(
+                    service_name, region_name=region_name,
+                    config=CLIENT_CONFIG))
+                clients[key] = client
+    return client
+
+
+class TokenBucket(object):
+    """Limit the call rate of one API, backing off when it is throttled."""
+
+    # the refill rate never drops below this fraction of its configured rate
+    MIN_RATE_FRACTION = 0.1
+
+    def __init__(self, rate, burst):
+        """Define the bucket, starting full."""
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """Add the tokens earned since the last refill."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        """Halve the refill rate after a throttling error."""
+        with self.lock:
+            self.rate = max(self.max_rate * self.MIN_RATE_FRACTION,
+                            self.rate / 2)
+
+    def succeeded(self):
+        """Recover the refill rate gradually after a success."""
+        with self.lock:
+            self.rate = min(self.max_rate,
+                            self.rate + self.max_rate * 0.05)
+
+
+class CallStats(object):
+    """Count calls, throttles, retries and failures per API."""
+
+    def __init__(self):
+        """Define the counters."""
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add(self, api, counter):
+        """Increment one counter of an API."""
+        with self.lock:
+            counters = self.counters.setdefault(
+                api, {'calls': 0, 'throttles': 0, 'retries': 0,
+                      'failures': 0})
+            counters[counter] += 1
+
+    def snapshot(self):
+        """Return a copy of every counter."""
+        with self.lock:
+            return {api: dict(counters)
+                    for api, counters in self.counters.items()}
+
+    def reset(self):
+        """Clear every counter."""
+        with self.lock:
+            self.counters.clear()
+
+
+buckets = {}
+buckets_lock = threading.Lock()
+call_stats = CallStats()
+
+# epoch seconds after which call() starts no new attempt, or None
+call_deadline = None
+
+
+class DeadlineExceeded(Exception):
+    """An AWS call was not started because the deadline had passed."""
+
+
+def set_deadline(deadline):
+    """Stop call() starting attempts after an epoch time; None lifts it."""
+    global call_deadline
+    call_deadline = deadline
+
+
+def get_bucket(api, region_name=None):
+    """Return the token bucket shared by every caller of an API in a region.
+
+    AWS applies its limits per region, so each region gets its own bucket.
+    """
+    key = (api, region_name)
+    with buckets_lock:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(*RATE_LIMITS.get(api, DEFAULT_RATE_LIMIT))
+            buckets[key] = bucket
+        return bucket
+
+
+def classify_error(error):
+    """Return 'throttle', 'transient' or 'fatal' for a failed call."""
+    if isinstance(error, TRANSIENT_EXCEPTIONS):
+        return 'transient'
+    if not isinstance(error, ClientError):
+        return 'fatal'
+    code = error.response.get('Error', {}).get('Code')
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    if code in THROTTLE_CODES or status == 429:
+        return 'throttle'
+    if code in TRANSIENT_CODES or (status or 0) >= 500:
+        return 'transient'
+    return 'fatal'
+
+
+def get_backoff(attempt):
+    """Return a full-jitter exponential backoff delay in seconds."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def call(client, method_name, **kwargs):
+    """Call a client method under its API's rate limit and retry policy."""
+    api = '{}:{}'.format(client.meta.service_model.service_name, method_name)
+    bucket = get_bucket(api, client.meta.region_name)
+    method = getattr(client, method_name)
+    idempotent = (api not in TOKEN_IDEMPOTENT_APIS or
+                  'ClientRequestToken' in kwargs)
+    attempt = 0
+    while True:
+        bucket.acquire()
+        if call_deadline is not None and time.time() >= call_deadline:
+            raise DeadlineExceeded('{} not called after the deadline'.format(
+                api))
+        call_stats.add(api, 'calls')
+        try:
+            response = method(**kwargs)
+        except Exception as e:
+            kind = classify_error(e)
+            if kind == 'throttle':
+                call_stats.add(api, 'throttles')
+                bucket.throttled()
+            attempt += 1
+            if kind == 'transient' and not idempotent:
+                kind = 'fatal'
+            if kind == 'fatal' or attempt >= MAX_ATTEMPTS:
+                call_stats.add(api, 'failures')
+                raise
+            call_stats.add(api, 'retries')
+            delay = get_backoff(attempt)
+            log.info(LogEvent('retrying', api=api, error=kind,
+                              attempt=attempt, delay=round(delay, 2)))
+            time.sleep(delay)
+            continue
+        bucket.succeeded()
+        return response
+
+
+def paginate(client, method_name, input_token='NextToken',
+             output_token='NextToken', **kwargs):
+    """Yield every page of a paginated call, each page through call()."""
+    while True:
+        page = call(client, method_name, **kwargs)
+        yield page
+        token = page.get(output_token)
+        if not token:
+            return
+        kwargs[input_token] = token
+
+
+def get_operation_name(method_name):
+    """Return the API operation name of a client method name."""
+    return ''.join(part.capitalize() for part in method_name.split('_'))
+
+
+def flush_metrics():
+    """Emit this invocation's per-API figures as EMF and reset them."""
+    for api, counters in call_stats.snapshot().items():
+        service, method_name = api.split(':', 1)
+        if counters['throttles'] or counters['retries']:
+            instrumentation.recorder.add_counts(
+                service, get_operation_name(method_name),
+                counters['throttles'], counters['retries'])
+    call_stats.reset()
+    return instrumentation.emit()
@@ -0,0 +1,140 @@
+"""Measure cold-start init time and AWS API calls for both Lambda modules.
+
+Each measurement runs in a fresh interpreter against moto, so module import
+cost is paid exactly as in a new Lambda execution environment.  Pass
+``--ref <git ref>`` to measure an older revision of the modules for
+comparison, e.g. ``python benchmarks/cold_start.py --ref HEAD~1``.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['cfn_auto_update_broker', 'cwe_update_target']
+
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'REGION': 'us-east-1',
+    'FUNCTION_NAME': 'cfn-update-scheduler-dev-cwe_update_target',
+    'STACK_UPDATE_ARN': 'arn:aws:iam::123456789012:role/StackUpdateRole',
+    'SCHEDULE_TABLE': 'cfn-update-scheduler-dev-schedule',
+}
+
+# runs inside the child interpreter; prints one JSON line of results
+PROBE = '''
+import importlib, json, sys, time
+from unittest import mock
+import boto3, botocore.client
+from moto import mock_events, mock_iam, mock_lambda, mock_sts
+
+calls = []
+make_api_call = botocore.client.BaseClient._make_api_call
+
+def counting_api_call(self, operation_name, api_params):
+    calls.append(operation_name)
+    return make_api_call(self, operation_name, api_params)
+
+class Context(object):
+    invoked_function_arn = (
+        'arn:aws:lambda:us-east-1:123456789012:function:broker')
+    log_stream_name = 'benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 120000
+
+with mock_sts(), mock_iam(), mock_lambda(), mock_events(), \\
+        mock.patch.object(botocore.client.BaseClient, '_make_api_call',
+                          counting_api_call):
+    start = time.perf_counter()
+    module = importlib.import_module(sys.argv[1])
+    init_seconds = time.perf_counter() - start
+    init_calls = list(calls)
+    del calls[:]
+    delete_calls = None
+    if sys.argv[1] == 'cfn_auto_update_broker':
+        event = {
+            'RequestType': 'Delete',
+            'ResponseURL': 'https://example.com/response',
+            'StackId': 'stack-id',
+            'RequestId': 'request-id',
+            'LogicalResourceId': 'AutoUpdateStack',
+            'ResourceProperties': {
+                'ToggleValues': ['A', 'B'],
+                'ToggleParameter': 'ForceUpdateToggle',
+                'UpdateSchedule': 'rate(1 day)',
+                'StackName': 'benchmark-stack',
+            },
+        }
+        with mock.patch.object(module.cfnresponse, 'send'):
+            try:
+                module.lambda_handler(event, Context())
+            except Exception:
+                pass
+        delete_calls = list(calls)
+print(json.dumps({'init_seconds': init_seconds, 'init_calls': init_calls,
+                  'delete_calls': delete_calls}))
+'''
+
+
+def export_ref(ref, destination):
+    """Write the repository's python files at a git ref to a directory."""
+    names = subprocess.check_output(
+        ['git', 'ls-tree', '--name-only', ref], cwd=REPO,
+        universal_newlines=True).split()
+    for name in names:
+        if name.endswith('.py'):
+            source = subprocess.check_output(
+                ['git', 'show', '{}:{}'.format(ref, name)], cwd=REPO)
+            with open(os.path.join(destination, name), 'wb') as handle:
+                handle.write(source)
+
+
+def measure(module, source_dir, runs):
+    """Return the median init time and the API calls of a cold start."""
+    environment = dict(os.environ, **ENVIRONMENT)
+    environment['PYTHONPATH'] = source_dir
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', PROBE, module], cwd=source_dir,
+            env=environment, stderr=subprocess.DEVNULL,
+            universal_newlines=True)
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    samples.sort(key=lambda sample: sample['init_seconds'])
+    return samples[len(samples) // 2]
+
+
+def main():
+    """Print cold-start measurements for each module."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ref', help='git ref to measure instead of the '
+                                      'working tree')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    source_dir = REPO
+    temp_dir = None
+    if args.ref:
+        temp_dir = source_dir = tempfile.mkdtemp()
+        export_ref(args.ref, source_dir)
+    try:
+        for module in MODULES:
+            result = measure(module, source_dir, args.runs)
+            print('{}: init {:.1f} ms, init API calls {}, '
+                  'Delete API calls {}'.format(
+                      module, result['init_seconds'] * 1000,
+                      result['init_calls'], result['delete_calls']))
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""Benchmark API calls and latency of every handler path against moto.
+
+Drives cfn_auto_update_broker.lambda_handler (Create, Update, Delete) and
+cwe_update_target.lambda_handler (one rule event per stack, and one batch
+event) for fleets of 1, 100 and 1,000 stacks.  For each path and fleet size
+it records AWS API calls per stack by operation and p50/p95 latency, plus
+cold-start init cost from ``cold_start.py``.
+
+    python benchmarks/handlers.py            # compare with baseline.json
+    python benchmarks/handlers.py --save     # record a new baseline
+
+The comparison exits non-zero when any path makes more API calls per stack
+than the baseline, or its p95 latency grows by more than ``--tolerance``.
+Client-side rate limits are lifted so the numbers measure the code, not
+the pacing.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [REPO, BENCH_DIR]
+
+import cold_start  # noqa: E402
+
+os.environ.update(cold_start.ENVIRONMENT)
+os.environ['STATE_STORE'] = 'memory'
+
+import boto3  # noqa: E402
+import botocore.client  # noqa: E402
+import mock  # noqa: E402
+from moto import (mock_cloudformation, mock_events, mock_iam,  # noqa: E402
+                  mock_lambda, mock_sts)
+
+import aws_clients  # noqa: E402
+import cfn_auto_update_broker as broker  # noqa: E402
+import cwe_update_target as updater  # noqa: E402
+from rollouts import percentile  # noqa: E402
+import stack_cache  # noqa: E402
+import state_store  # noqa: E402
+
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+SIZES = [1, 100, 1000]
+ACCOUNT_ID = '123456789012'
+
+TEMPLATE = json.dumps({
+    'Parameters': {
+        'ForceUpdateToggle': {'Type': 'String', 'Default': 'A',
+                              'AllowedValues': ['A', 'B']},
+    },
+    'Resources': {'Queue': {'Type': 'AWS::SQS::Queue'}},
+})
+
+
+class Context(object):
+    """Stand in for the Lambda invocation context."""
+
+    invoked_function_arn = (
+        'arn:aws:lambda:us-east-1:{}:function:broker'.format(ACCOUNT_ID))
+    log_stream_name = 'benchmark'
+
+    def get_remaining_time_in_millis(self):
+        """Report plenty of time left."""
+        return 120000
+
+
+class ApiCallCounter(object):
+    """Count every botocore API call by operation name."""
+
+    def __init__(self):
+        """Define the counter."""
+        self.calls = Counter()
+        self.make_api_call = botocore.client.BaseClient._make_api_call
+
+    def patch(self):
+        """Return a patcher that counts calls made while it is active."""
+        counter = self
+
+        def counting_api_call(client, operation_name, api_params):
+            counter.calls[operation_name] += 1
+            return counter.make_api_call(client, operation_name, api_params)
+        return mock.patch.object(botocore.client.BaseClient,
+                                 '_make_api_call', counting_api_call)
+
+
+def summarize(samples, calls, stacks):
+    """Return the recorded figures for one path and fleet size."""
+    return {
+        'calls_per_stack': round(sum(calls.values()) / float(stacks), 3),
+        'calls_by_operation': {
+            operation: round(count / float(stacks), 3)
+            for operation, count in sorted(calls.items())
+        },
+        'p50_ms': round(percentile(samples, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'first_ms': round(samples[0] * 1000, 3),
+    }
+
+
+def get_request(request_type, stack_name):
+    """Return a custom resource request for a stack."""
+    properties = {
+        'ToggleValues': ['A', 'B'],
+        'ToggleParameter': 'ForceUpdateToggle',
+        'UpdateSchedule': 'rate(1 day)',
+        'StackName': stack_name,
+    }
+    request = {
+        'RequestType': request_type,
+        'ResponseURL': 'https://example.com/response',
+        'StackId': stack_name,
+        'RequestId': 'request-id',
+        'LogicalResourceId': 'AutoUpdateStack',
+        'ResourceProperties': properties,
+    }
+    if request_type == 'Update':
+        # a schedule-only change, as CloudFormation sends it
+        request['OldResourceProperties'] = dict(
+            properties, UpdateSchedule='rate(12 hours)')
+    return request
+
+
+def get_descriptor(stack_name):
+    """Return the rule input for a stack."""
+    return {
+        'event_name': 'auto-update-{}'.format(stack_name),
+        'stack_name': stack_name,
+        'toggle_parameter': 'ForceUpdateToggle',
+        'toggle_values': ['A', 'B'],
+    }
+
+
+def timed(counter, handler, events):
+    """Invoke a handler once per event; return latencies and API calls."""
+    # the broker and updater are separate functions in production, so one
+    # path must not be served from stacks another path described
+    stack_cache.stack_cache.clear()
+    counter.calls.clear()
+    samples = []
+    with counter.patch():
+        for event in events:
+            start = time.perf_counter()
+            handler(event, Context())
+            samples.append(time.perf_counter() - start)
+    return samples, Counter(counter.calls)
+
+
+def reset_module_state():
+    """Drop caches that would otherwise carry across fleet sizes."""
+    aws_clients.buckets.clear()
+    stack_cache.stack_cache.clear()
+    updater.elevated_clients.clear()
+    state_store.state_store = None
+    broker.dispatcher_ready = False
+
+
+def run_fleet(size):
+    """Run every handler path for one fleet size."""
+    aws_clients.RATE_LIMITS.clear()
+    aws_clients.DEFAULT_RATE_LIMIT = (1e9, 1e9)
+
+    with mock_sts(), mock_iam(), mock_lambda(), mock_events(), \
+            mock_cloudformation():
+        role = boto3.client('iam').create_role(
+            RoleName='lambda-role', AssumeRolePolicyDocument='{}',
+            Path='/')['Role']['Arn']
+        boto3.client('lambda').create_function(
+            FunctionName=os.environ['FUNCTION_NAME'], Runtime='python3.9',
+            Role=role, Handler='cwe_update_target.lambda_handler',
+            Code={'ZipFile': b'benchmark'})
+        cfn = boto3.client('cloudformation')
+        names = ['bench-stack-{}'.format(index) for index in range(size)]
+        for name in names:
+            cfn.create_stack(StackName=name, TemplateBody=TEMPLATE)
+
+        reset_module_state()
+        counter = ApiCallCounter()
+        results = {}
+        with mock.patch.object(broker.cfnresponse, 'send'):
+            for request_type in ('Create', 'Update'):
+                samples, calls = timed(
+                    counter, broker.lambda_handler,
+                    [get_request(request_type, name) for name in names])
+                results['broker.{}'.format(request_type)] = summarize(
+                    samples, calls, size)
+
+            samples, calls = timed(counter, updater.lambda_handler,
+                                   [get_descriptor(name) for name in names])
+            results['updater.single'] = summarize(samples, calls, size)
+
+            samples, calls = timed(
+                counter, updater.lambda_handler,
+                [{'stacks': [get_descriptor(name) for name in names]}])
+            results['updater.batch'] = summarize(
+                [samples[0] / size], calls, size)
+
+            samples, calls = timed(
+                counter, broker.lambda_handler,
+                [get_request('Delete', name) for name in names])
+            results['broker.Delete'] = summarize(samples, calls, size)
+    return results
+
+
+def run(sizes):
+    """Return results for every fleet size plus cold-start init cost."""
+    results = {'fleets': {}, 'cold_start': {}}
+    for module in cold_start.MODULES:
+        probe = cold_start.measure(module, REPO, 3)
+        results['cold_start'][module] = {
+            'init_ms': round(probe['init_seconds'] * 1000, 3),
+            'init_calls': len(probe['init_calls']),
+        }
+    for size in sizes:
+        results['fleets'][str(size)] = run_fleet(size)
+    return results
+
+
+def compare(results, baseline, tolerance, noise_ms):
+    """Return a list of regressions against the baseline."""
+    regressions = []
+    for size, paths in results['fleets'].items():
+        for path, figures in paths.items():
+            before = baseline.get('fleets', {}).get(size, {}).get(path)
+            if before is None:
+                continue
+            label = '{} x{}'.format(path, size)
+            if figures['calls_per_stack'] > before['calls_per_stack'] + 1e-9:
+                regressions.append('{}: API calls per stack {} > {}'.format(
+                    label, figures['calls_per_stack'],
+                    before['calls_per_stack']))
+            limit = max(before['p95_ms'] * (1 + tolerance),
+                        before['p95_ms'] + noise_ms)
+            if figures['p95_ms'] > limit:
+                regressions.append('{}: p95 {} ms > {:.3f} ms'.format(
+                    label, figures['p95_ms'], limit))
+    for module, figures in results['cold_start'].items():
+        before = baseline.get('cold_start', {}).get(module)
+        if before and figures['init_calls'] > before['init_calls']:
+            regressions.append('{}: init API calls {} > {}'.format(
+                module, figures['init_calls'], before['init_calls']))
+    return regressions
+
+
+def report(results):
+    """Print a table of the results."""
+    for module, figures in sorted(results['cold_start'].items()):
+        print('{:<28} init {:>8.1f} ms  {} API calls'.format(
+            module, figures['init_ms'], figures['init_calls']))
+    for size, paths in sorted(results['fleets'].items(),
+                              key=lambda item: int(item[0])):
+        for path, figures in sorted(paths.items()):
+            print('{:<16} x{:<5} calls/stack {:>6}  p50 {:>8.2f} ms  '
+                  'p95 {:>8.2f} ms  {}'.format(
+                      path, size, figures['calls_per_stack'],
+                      figures['p50_ms'], figures['p95_ms'],
+                      figures['calls_by_operation']))
+
+
+def main():
+    """Run the suite and save or check the baseline."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--save', action='store_true',
+                        help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative p95 growth (default 0.5)')
+    parser.add_argument('--noise-ms', type=float, default=5.0,
+                        help='p95 growth always tolerated (default 5 ms)')
+    args = parser.parse_args()
+
+    results = run(args.sizes)
+    report(results)
+    if args.save:
+        with open(BASELINE, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+            handle.write('\n')
+        print('Saved baseline to {}'.format(BASELINE))
+        return 0
+    if not os.path.exists(BASELINE):
+        print('No baseline found; run with --save first.')
+        return 0
+    with open(BASELINE) as handle:
+        baseline = json.load(handle)
+    regressions = compare(results, baseline, args.tolerance, args.noise_ms)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,534 @@
+"""Simulate a fleet's scheduled updates over days of simulated time.
+
+Each stack's rule fires on its jittered rate() or cron() schedule. Every
+firing runs cwe_update_target.lambda_handler against in-process stand-ins
+for CloudFormation and STS, so fleets of thousands of stacks simulate in
+seconds.
+
+The stand-ins track each stack's status and finish every update after a
+set duration. They throttle calls beyond per-second account limits. A
+simulated clock replaces ``time`` in the updater's modules, so backoff and
+pacing sleeps advance simulated time instead of blocking.
+
+    python benchmarks/simulate.py --stacks 5000 --days 3
+    python benchmarks/simulate.py --stacks 5000 --queue --max-in-progress 20
+
+The report gives peak concurrent stack updates, API calls per minute,
+throttles, handler results, and the lag from each rule firing to the
+completion of the update that served it.
+
+Each invocation runs on its own timeline from its firing time with fresh
+client-side token buckets, as concurrent Lambda invocations would. The
+per-second limits of the stand-ins model the account-wide limits that
+those invocations share.
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import os
+import random
+import sys
+from collections import Counter, defaultdict
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [REPO, BENCH_DIR]
+
+import cold_start  # noqa: E402
+
+os.environ.update(cold_start.ENVIRONMENT)
+os.environ['STATE_STORE'] = 'memory'
+
+import mock  # noqa: E402
+from botocore.exceptions import ClientError  # noqa: E402
+
+import aws_clients  # noqa: E402
+import breaker  # noqa: E402
+import cwe_update_target as updater  # noqa: E402
+import dispatch_cache  # noqa: E402
+import fingerprint  # noqa: E402
+import inflight  # noqa: E402
+import rollouts  # noqa: E402
+from rollouts import percentile  # noqa: E402
+import schedule_expression  # noqa: E402
+import stack_cache  # noqa: E402
+import state_store  # noqa: E402
+import update_queue  # noqa: E402
+
+# calls per second the stand-ins accept before throttling; real limits are
+# not published, so tune these to what your account sees
+DEFAULT_LIMITS = {
+    'cloudformation:describe_stacks': 10,
+    'cloudformation:update_stack': 5,
+    'sts:assume_role': 10,
+}
+DESCRIBE_PAGE_SIZE = 100
+# seconds the shortest simulated sleep takes
+MIN_SLEEP = 1e-6
+# modules whose time and get_client the simulation replaces
+TIMED_MODULES = [aws_clients, breaker, dispatch_cache, fingerprint,
+                 inflight, rollouts, stack_cache, update_queue]
+CLIENT_MODULES = [aws_clients, updater, fingerprint, stack_cache,
+                  update_queue]
+
+
+class SimulatedClock(object):
+    """Stand in for the time module on the simulated timeline.
+
+    Time is kept relative to the start so that the short sleeps of token
+    bucket pacing are not lost to float precision at epoch magnitudes.
+    """
+
+    def __init__(self, start):
+        """Start the clock at an epoch timestamp."""
+        self.start = start
+        self.elapsed = 0.0
+
+    @property
+    def now(self):
+        """Return the simulated epoch time."""
+        return self.start + self.elapsed
+
+    @now.setter
+    def now(self, value):
+        """Move the clock to an epoch time."""
+        self.elapsed = float(value - self.start)
+
+    def time(self):
+        """Return the simulated epoch time."""
+        return self.now
+
+    def monotonic(self):
+        """Return the simulated seconds since the start."""
+        return self.elapsed
+
+    def perf_counter(self):
+        """Return the simulated seconds since the start."""
+        return self.elapsed
+
+    def sleep(self, seconds):
+        """Advance the clock instead of blocking."""
+        # a real sleep always lets some time pass, however short the wait
+        self.elapsed += max(seconds, MIN_SLEEP)
+
+
+def get_datetime_class(clock):
+    """Return a datetime whose now() reads the simulated clock."""
+    class SimulatedDatetime(datetime):
+        """Stand in for datetime on the simulated timeline."""
+
+        @classmethod
+        def now(cls, tz=None):
+            """Return the simulated time."""
+            return datetime.fromtimestamp(clock.now, tz)
+    return SimulatedDatetime
+
+
+def get_client_error(code, message, method_name):
+    """Return the ClientError botocore raises for an error response."""
+    return ClientError({'Error': {'Code': code, 'Message': message}},
+                       aws_clients.get_operation_name(method_name))
+
+
+class FakeClient(object):
+    """Stand in for a boto3 client, answering from a FakeCloud."""
+
+    def __init__(self, cloud, service_name, region_name=None):
+        """Define the client."""
+        self.cloud = cloud
+        self.service_name = service_name
+        self.meta = mock.Mock(region_name=region_name)
+        self.meta.service_model.service_name = service_name
+
+    def __getattr__(self, method_name):
+        """Return a method that sends its call to the cloud."""
+        def method(**kwargs):
+            return self.cloud.request(self.service_name, method_name, kwargs)
+        return method
+
+
+class FakeCloud(object):
+    """Keep stack state and account-wide API limits for the simulation."""
+
+    def __init__(self, clock, limits, get_duration):
+        """Define an account without stacks."""
+        self.clock = clock
+        self.limits = limits
+        self.get_duration = get_duration
+        self.stacks = {}
+        self.calls = Counter()
+        self.window = Counter()
+        self.throttles = Counter()
+        self.updates = []
+
+    def add_stack(self, stack_name, toggle_value='A'):
+        """Create a stack whose toggle starts at a value."""
+        self.stacks[stack_name] = {
+            'StackName': stack_name,
+            'StackId': 'arn:aws:cloudformation:us-east-1:{}:stack/{}'.format(
+                cold_start.ENVIRONMENT['STACK_UPDATE_ARN'].split(':')[4],
+                stack_name),
+            'StackStatus': 'CREATE_COMPLETE',
+            'Parameters': [{'ParameterKey': 'ForceUpdateToggle',
+                            'ParameterValue': toggle_value}],
+            'CreationTime': datetime.fromtimestamp(self.clock.now,
+                                                   timezone.utc),
+            'completes_at': None,
+        }
+
+    def request(self, service_name, method_name, kwargs):
+        """Count a call, throttle it over the limit, else answer it."""
+        api = '{}:{}'.format(service_name, method_name)
+        now = self.clock.now
+        self.calls[int(now // 60), api] += 1
+        limit = self.limits.get(api)
+        if limit is not None:
+            if self.window[api, int(now)] >= limit:
+                self.throttles[api] += 1
+                raise get_client_error('Throttling', 'Rate exceeded',
+                                       method_name)
+            self.window[api, int(now)] += 1
+        handler = getattr(self, method_name, None)
+        if handler is None:
+            raise NotImplementedError('The simulation has no {}.'.format(api))
+        return handler(**kwargs)
+
+    def get_stack(self, stack_name):
+        """Return a stack, finishing its update if the time has come."""
+        stack = self.stacks.get(stack_name)
+        if stack is None:
+            raise get_client_error(
+                'ValidationError',
+                'Stack with id {} does not exist'.format(stack_name),
+                'describe_stacks')
+        if (stack['completes_at'] is not None and
+                self.clock.now >= stack['completes_at']):
+            stack['StackStatus'] = 'UPDATE_COMPLETE'
+            stack['completes_at'] = None
+        return stack
+
+    def describe(self, stack_name):
+        """Return a stack as describe_stacks lists it."""
+        stack = self.get_stack(stack_name)
+        return {key: value for key, value in stack.items()
+                if key != 'completes_at'}
+
+    def describe_stacks(self, StackName=None, NextToken=None):
+        """Describe one stack, or a page of every stack."""
+        if StackName is not None:
+            return {'Stacks': [self.describe(StackName)]}
+        names = sorted(self.stacks)
+        start = int(NextToken or 0)
+        page = {'Stacks': [self.describe(name) for name in
+                           names[start:start + DESCRIBE_PAGE_SIZE]]}
+        if start + DESCRIBE_PAGE_SIZE < len(names):
+            page['NextToken'] = str(start + DESCRIBE_PAGE_SIZE)
+        return page
+
+    def update_stack(self, StackName, Parameters, **kwargs):
+        """Start an update that finishes after the stack's duration."""
+        stack = self.get_stack(StackName)
+        if stack['StackStatus'].endswith('_IN_PROGRESS'):
+            raise get_client_error(
+                'ValidationError',
+                'Stack:{} is in {} state and can not be updated.'.format(
+                    stack['StackId'], stack['StackStatus']),
+                'update_stack')
+        values = {parameter['ParameterKey']: parameter['ParameterValue']
+                  for parameter in Parameters
+                  if 'ParameterValue' in parameter}
+        for parameter in stack['Parameters']:
+            parameter['ParameterValue'] = values.get(
+                parameter['ParameterKey'], parameter['ParameterValue'])
+        now = self.clock.now
+        stack['StackStatus'] = 'UPDATE_IN_PROGRESS'
+        stack['LastUpdatedTime'] = datetime.fromtimestamp(now, timezone.utc)
+        stack['completes_at'] = now + self.get_duration(StackName)
+        self.updates.append((StackName, now, stack['completes_at']))
+        return {'StackId': stack['StackId']}
+
+    def assume_role(self, RoleArn, DurationSeconds, **kwargs):
+        """Return credentials that expire on the simulated clock."""
+        return {'Credentials': {
+            'AccessKeyId': 'simulated',
+            'SecretAccessKey': 'simulated',
+            'SessionToken': 'simulated',
+            'Expiration': datetime.fromtimestamp(
+                self.clock.now + DurationSeconds, timezone.utc),
+        }}
+
+
+def get_patches(cloud, clock):
+    """Return the patchers that point the updater at the simulation."""
+    def get_client(service_name, region_name=None):
+        return FakeClient(cloud, service_name, region_name)
+
+    def get_elevated_session(region_name=None, **kwargs):
+        return FakeClient(cloud, 'cloudformation', region_name)
+
+    patches = [mock.patch.object(module, 'time', clock)
+               for module in TIMED_MODULES]
+    patches += [mock.patch.object(module, 'get_client', get_client)
+                for module in CLIENT_MODULES]
+    patches += [
+        mock.patch.object(updater, 'datetime', get_datetime_class(clock)),
+        mock.patch.object(updater, 'get_elevated_session',
+                          get_elevated_session),
+        # the simulation reads the call counters itself
+        mock.patch.object(updater, 'flush_metrics', lambda: None),
+        # one worker keeps a single invocation on a single timeline
+        mock.patch.object(updater, 'max_workers', 1),
+    ]
+    return patches
+
+
+def reset_module_state(queue, max_in_progress):
+    """Drop state left behind by earlier runs and apply the settings."""
+    aws_clients.buckets.clear()
+    aws_clients.call_stats.reset()
+    stack_cache.stack_cache.clear()
+    updater.elevated_clients.clear()
+    fingerprint.resolver.clear()
+    state_store.state_store = None
+    update_queue.update_queue = None
+    update_queue.update_queue_type = 'memory' if queue else 'none'
+    updater.max_in_progress = max_in_progress
+
+
+def get_descriptor(stack_name):
+    """Return the rule input for a stack."""
+    return {
+        'event_name': 'auto-update-{}'.format(stack_name),
+        'stack_name': stack_name,
+        'toggle_parameter': 'ForceUpdateToggle',
+        'toggle_values': ['A', 'B'],
+    }
+
+
+def get_peak_concurrency(updates):
+    """Return the most stack updates in progress at one time."""
+    changes = sorted([(start, 1) for _, start, _ in updates] +
+                     [(end, -1) for _, _, end in updates])
+    peak = running = 0
+    for _, change in changes:
+        running += change
+        peak = max(peak, running)
+    return peak
+
+
+def get_lags(fires, updates):
+    """Return firing-to-completion lags and the count of unserved fires.
+
+    A firing is served by the first update started on its stack at or
+    after the time it fired.
+    """
+    starts = defaultdict(list)
+    for stack_name, start, end in updates:
+        starts[stack_name].append((start, end))
+    lags = []
+    unserved = 0
+    for stack_name, fired in fires.items():
+        stack_updates = sorted(starts[stack_name])
+        index = 0
+        for fired_at in sorted(fired):
+            while (index < len(stack_updates) and
+                   stack_updates[index][0] < fired_at):
+                index += 1
+            if index == len(stack_updates):
+                unserved += 1
+            else:
+                lags.append(stack_updates[index][1] - fired_at)
+    return lags, unserved
+
+
+def get_call_rates(calls, minutes):
+    """Return the peak and mean calls per minute, overall and per API."""
+    totals = Counter()
+    peaks = Counter()
+    per_api = Counter()
+    for (minute, api), count in calls.items():
+        totals[minute] += count
+        per_api[api] += count
+        peaks[api] = max(peaks[api], count)
+    return {
+        'peak_per_minute': max(totals.values()) if totals else 0,
+        'mean_per_minute': round(sum(totals.values()) / float(minutes), 3),
+        'peak_per_minute_by_api': dict(sorted(peaks.items())),
+        'total_by_api': dict(sorted(per_api.items())),
+    }
+
+
+def simulate(stacks, days, schedules, jitter_window, update_minutes,
+             limits, queue=False, max_in_progress=10, seed=0,
+             start='2018-01-01T00:00:00', delivery_spread=0):
+    """Run a fleet through days of simulated time and return the figures."""
+    rng = random.Random(seed)
+    start_time = datetime.strptime(start, '%Y-%m-%dT%H:%M:%S').replace(
+        tzinfo=timezone.utc)
+    start_at = schedule_expression.to_timestamp(start_time)
+    end_at = start_at + days * 86400
+    clock = SimulatedClock(start_at)
+    durations = {}
+
+    def get_duration(stack_name):
+        # each stack keeps one duration, spread around the mean
+        if stack_name not in durations:
+            durations[stack_name] = update_minutes * 60 * rng.uniform(0.5,
+                                                                      1.5)
+        return durations[stack_name]
+
+    cloud = FakeCloud(clock, limits, get_duration)
+    events = []
+    sequence = [0]
+
+    def push(at, kind, payload=None):
+        sequence[0] += 1
+        heapq.heappush(events, (at, sequence[0], kind, payload))
+
+    names = ['sim-stack-{}'.format(index) for index in range(stacks)]
+    for index, name in enumerate(names):
+        cloud.add_stack(name)
+        expression = schedule_expression.jitter(
+            schedules[index % len(schedules)], name, jitter_window)
+        fire = schedule_expression.next_fire_time(expression, start_time,
+                                                  anchor=start_time)
+        push(schedule_expression.to_timestamp(fire), 'fire',
+             (name, expression))
+    if queue:
+        push(start_at + 60, 'drain')
+
+    statuses = Counter()
+    fires = defaultdict(list)
+    invocations = 0
+    patches = get_patches(cloud, clock)
+    for patcher in patches:
+        patcher.start()
+    try:
+        reset_module_state(queue, max_in_progress)
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            while events:
+                at, _, kind, payload = heapq.heappop(events)
+                if at >= end_at:
+                    break
+                if kind == 'fire':
+                    name, expression = payload
+                    fires[name].append(at)
+                    fire = schedule_expression.next_fire_time(
+                        expression, schedule_expression.from_timestamp(at),
+                        anchor=start_time)
+                    push(schedule_expression.to_timestamp(fire), 'fire',
+                         payload)
+                    # the invocation may arrive a little after the minute
+                    push(at + rng.uniform(0, delivery_spread), 'invoke',
+                         get_descriptor(name))
+                    continue
+                if kind == 'drain':
+                    event = {'drain': True}
+                    push(at + 60, 'drain')
+                else:
+                    event = payload
+                clock.now = at
+                # a concurrent invocation paces its calls on its own
+                aws_clients.buckets.clear()
+                invocations += 1
+                results = updater.lambda_handler(event, None) or []
+                statuses.update(result['status'] for result in results)
+        client_stats = aws_clients.call_stats.snapshot()
+    finally:
+        for patcher in reversed(patches):
+            patcher.stop()
+
+    lags, unserved = get_lags(fires, cloud.updates)
+    return {
+        'stacks': stacks,
+        'days': days,
+        'invocations': invocations,
+        'fires': sum(len(fired) for fired in fires.values()),
+        'updates': len(cloud.updates),
+        'peak_concurrent_updates': get_peak_concurrency(cloud.updates),
+        'api_calls': get_call_rates(cloud.calls, days * 24 * 60),
+        'throttles': dict(sorted(cloud.throttles.items())),
+        'retries': sum(counters['retries']
+                       for counters in client_stats.values()),
+        'results': dict(sorted(statuses.items())),
+        'lag_minutes': {
+            name: (round(value / 60.0, 2) if value is not None else None)
+            for name, value in (
+                ('p50', percentile(lags, 0.5)),
+                ('p95', percentile(lags, 0.95)),
+                ('max', max(lags) if lags else None))
+        },
+        'unserved_fires': unserved,
+    }
+
+
+def report(figures):
+    """Print the figures of a run."""
+    print('{stacks} stacks over {days} days: {invocations} invocations, '
+          '{fires} rule firings, {updates} updates'.format(**figures))
+    print('peak concurrent updates  {}'.format(
+        figures['peak_concurrent_updates']))
+    calls = figures['api_calls']
+    print('API calls per minute     peak {} mean {}'.format(
+        calls['peak_per_minute'], calls['mean_per_minute']))
+    for api, total in calls['total_by_api'].items():
+        print('  {:<32} total {:>8} peak/min {:>6}'.format(
+            api, total, calls['peak_per_minute_by_api'][api]))
+    print('throttles                {} ({} client retries)'.format(
+        figures['throttles'] or 0, figures['retries']))
+    print('handler results          {}'.format(figures['results']))
+    lag = figures['lag_minutes']
+    print('fire-to-completion lag   p50 {} p95 {} max {} minutes, '
+          '{} firings unserved'.format(lag['p50'], lag['p95'], lag['max'],
+                                       figures['unserved_fires']))
+
+
+def main():
+    """Parse the settings, run the simulation and report it."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stacks', type=int, default=1000)
+    parser.add_argument('--days', type=float, default=1)
+    parser.add_argument('--schedule', action='append', dest='schedules',
+                        help='UpdateSchedule given to stacks in turn '
+                             '(default rate(1 day))')
+    parser.add_argument('--jitter-window', type=int,
+                        default=int(os.environ.get('JITTER_WINDOW', '3600')))
+    parser.add_argument('--update-minutes', type=float, default=10,
+                        help='mean duration of one stack update')
+    parser.add_argument('--limits', type=json.loads, default=DEFAULT_LIMITS,
+                        help='JSON calls per second per "service:method"')
+    parser.add_argument('--queue', action='store_true',
+                        help='buffer updates in the memory queue and drain '
+                             'it every minute')
+    parser.add_argument('--max-in-progress', type=int, default=10)
+    parser.add_argument('--delivery-spread', type=float, default=0,
+                        help='seconds over which a rule\'s invocation may '
+                             'arrive after its scheduled minute (default 0, '
+                             'every rule in a minute at once)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='print the figures as JSON')
+    parser.add_argument('--verbose', action='store_true',
+                        help='keep the handlers\' log output')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    figures = simulate(args.stacks, args.days,
+                       args.schedules or ['rate(1 day)'], args.jitter_window,
+                       args.update_minutes, args.limits, args.queue,
+                       args.max_in_progress, args.seed,
+                       delivery_spread=args.delivery_spread)
+    if args.json:
+        print(json.dumps(figures, indent=2, sort_keys=True))
+    else:
+        report(figures)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""Back off stacks whose updates keep failing, and open their breaker.
+
+Each failure of a stack doubles the wait before its next attempt, and
+attempts inside that wait return before any AWS call.  After
+``breaker_threshold`` consecutive failures the breaker opens and the
+stack's rule is disabled, so it stops invoking the updater at all.
+``recover`` closes the breakers of stacks that are healthy again and
+re-enables their rules; a successful update closes a breaker too.
+
+Failure state lives in the state store, shared by every execution
+environment when it is DynamoDB.  A rule the breaker disables is also
+tagged, so ``recover`` still finds it through ``list_rules`` if that
+state is lost, and never re-enables a rule someone disabled by hand.
+
+Only failures that will repeat count: blocked stack states and fatal
+errors.  Busy stacks are deferred by the in-flight tracker, and throttles
+and transient errors are retried by ``call``.
+"""
+
+import os
+import threading
+import time
+
+from aws_clients import call, get_client, paginate
+from rule_targets import RULE_PREFIX, get_rule_input
+from state_store import get_state_store
+from structured_logging import LogEvent, get_logger
+
+log = get_logger(__name__)
+
+backoff_base = int(os.environ.get('FAILURE_BACKOFF', '300'))
+backoff_cap = int(os.environ.get('FAILURE_BACKOFF_CAP', '86400'))
+breaker_threshold = int(os.environ.get('BREAKER_THRESHOLD', '5'))
+
+BREAKER_TAG = 'cfn-update-scheduler:breaker'
+
+
+class FailureBreaker(object):
+    """Keep per-stack failure counts, backoffs and open breakers."""
+
+    def __init__(self, base, cap, threshold):
+        """Define the breaker and its counters."""
+        self.base = base
+        self.cap = cap
+        self.threshold = threshold
+        self.stats = {'backed_off': 0, 'failed': 0, 'opened': 0,
+                      'closed': 0}
+        self.lock = threading.Lock()
+
+    def count(self, counter):
+        """Increment a counter."""
+        with self.lock:
+            self.stats[counter] += 1
+
+    def get_delay(self, failures):
+        """Return the wait after a number of consecutive failures."""
+        return min(self.cap, self.base * 2 ** (failures - 1))
+
+    def allows(self, stack_key, now=None):
+        """Return True unless the stack is waiting out a backoff."""
+        state = get_state_store().get('failures:{}'.format(stack_key))
+        if state is None or state['retry_at'] <= (now or time.time()):
+            return True
+        self.count('backed_off')
+        return False
+
+    def failed(self, descriptor, stack_key, error):
+        """Record a failure, opening the breaker once there are enough."""
+        store = get_state_store()
+        key = 'failures:{}'.format(stack_key)
+        state = store.get(key) or {'failures': 0, 'open': False}
+        failures = state['failures'] + 1
+        self.count('failed')
+        is_open = state['open']
+        if failures >= self.threshold and not is_open:
+            is_open = self.set_rule_state(descriptor, 'disable_rule')
+            if is_open:
+                self.count('opened')
+        store.set(key, {
+            'failures': failures,
+            'retry_at': time.time() + self.get_delay(failures),
+            'error': str(error),
+            'open': is_open,
+            'descriptor': descriptor,
+        })
+        log.info(LogEvent('Update failure recorded', stack=stack_key,
+                          failures=failures, open=is_open))
+
+    def succeeded(self, stack_key):
+        """Forget a stack's failures, closing its breaker if it is open."""
+        key = 'failures:{}'.format(stack_key)
+        state = get_state_store().get(key)
+        if state is not None:
+            self.close(key, state)
+
+    def close(self, key, state):
+        """Re-enable an open breaker's rule and drop its failure state."""
+        if state['open']:
+            if not self.set_rule_state(state['descriptor'], 'enable_rule'):
+                return False
+            self.count('closed')
+        get_state_store().delete(key)
+        return True
+
+    def set_rule_state(self, descriptor, method_name):
+        """Disable or enable a stack's rule; return True if that worked.
+
+        Dispatched stacks have no rule of their own, so their breaker only
+        keeps the backoff.
+        """
+        if descriptor.get('dispatched'):
+            return True
+        events = get_client('events')
+        try:
+            rule_arn = call(events, 'describe_rule',
+                            Name=descriptor['event_name'])['Arn']
+            if method_name == 'disable_rule':
+                call(events, 'tag_resource', ResourceARN=rule_arn,
+                     Tags=[{'Key': BREAKER_TAG, 'Value': 'open'}])
+            call(events, method_name, Name=descriptor['event_name'])
+            if method_name == 'enable_rule':
+                call(events, 'untag_resource', ResourceARN=rule_arn,
+                     TagKeys=[BREAKER_TAG])
+        except Exception:
+            log.exception(LogEvent('Breaker rule change failed',
+                                   rule=descriptor['event_name'],
+                                   action=method_name))
+            return False
+        log.info(LogEvent(method_name, rule=descriptor['event_name']))
+        return True
+
+    def get_tripped_rules(self, known):
+        """Yield the descriptors of breaker-disabled rules not in known."""
+        events = get_client('events')
+        for page in paginate(events, 'list_rules', NamePrefix=RULE_PREFIX):
+            for rule in page['Rules']:
+                if rule['State'] != 'DISABLED' or rule['Name'] in known:
+                    continue
+                tags = call(events, 'list_tags_for_resource',
+                            ResourceARN=rule['Arn'])['Tags']
+                if BREAKER_TAG not in [tag['Key'] for tag in tags]:
+                    continue
+                descriptor = get_rule_input(call(
+                    events, 'list_targets_by_rule',
+                    Rule=rule['Name'])['Targets'])
+                if descriptor:
+                    yield descriptor
+
+    def recover(self, is_healthy):
+        """Close the open breakers of healthy stacks; return their keys.
+
+        is_healthy is called with the descriptor that last failed, or
+        with a tripped rule's input when its failure state is gone.
+        """
+        recovered = []
+        known = set()
+        for key, state in get_state_store().items('failures:'):
+            if not state['open']:
+                continue
+            known.add(state['descriptor'].get('event_name'))
+            try:
+                healthy = is_healthy(state['descriptor'])
+            except Exception:
+                log.exception(LogEvent('Health check failed', key=key))
+                continue
+            if healthy and self.close(key, state):
+                recovered.append(key.split(':', 1)[1])
+        try:
+            tripped = list(self.get_tripped_rules(known))
+        except Exception:
+            log.exception(LogEvent('Listing tripped rules failed'))
+            tripped = []
+        for descriptor in tripped:
+            try:
+                healthy = is_healthy(descriptor)
+            except Exception:
+                log.exception(LogEvent('Health check failed',
+                                       rule=descriptor.get('event_name')))
+                continue
+            if healthy and self.set_rule_state(descriptor, 'enable_rule'):
+                self.count('closed')
+                recovered.append(descriptor['stack_name'])
+        return recovered
+
+    def open_breakers(self):
+        """Return the keys of stacks whose breaker is open."""
+        return [key.split(':', 1)[1]
+                for key, state in get_state_store().items('failures:')
+                if state['open']]
+
+
+breaker = FailureBreaker(backoff_base, backoff_cap, breaker_threshold)
@@ -1,26 +1,59 @@
 """Create auto update CloudWatch events."""
 
-import boto3
 import cfnresponse
 import os
-import logging
 import json
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
-client = boto3.client('cloudformation')
-event = boto3.client('events')
-aws_lambda = boto3.client('lambda')
+import schedule_expression
+import schedule_table
+from stack_cache import stack_cache
+from rule_targets import RULE_PREFIX, get_input_transformer
+from aws_clients import call, flush_metrics, get_client, set_deadline
+from structured_logging import LogEvent, get_logger, start_invocation
 
 function_name = os.environ['FUNCTION_NAME']
 region = os.environ['REGION']
-account_id = boto3.client('sts').get_caller_identity().get('Account')
+# resolved lazily from the environment, the invocation context or sts
+account_id = os.environ.get('ACCOUNT_ID')
+function_arn = os.environ.get('FUNCTION_ARN')
+
+# 'rule' creates one auto-update-{stack} rule per stack, 'table' registers
+# stacks in the schedule table polled by a single dispatcher rule
+dispatch_mode = os.environ.get('DISPATCH_MODE', 'rule')
+dispatch_schedule = os.environ.get('DISPATCH_SCHEDULE', 'rate(1 minute)')
+DISPATCHER_NAME = 'auto-update-dispatcher'
+# seconds over which rules sharing an UpdateSchedule are spread; 0 disables
+# jitter is opt-in: turning it on rewrites every existing rule's schedule
+# on its next Update
+jitter_window = int(os.environ.get('JITTER_WINDOW', '0'))
+dispatcher_ready = False
+
+# 'statement' adds a resource policy statement per rule, 'shared' adds one
+# statement that lets every auto-update-* rule invoke the update function
+policy_mode = os.environ.get('POLICY_MODE', 'statement')
+# seconds the broker trusts what it knows of the resource policy
+policy_ttl = int(os.environ.get('POLICY_CACHE_TTL', '300'))
+SHARED_RULE_PATTERN = 'auto-update-*'
+
+# resource properties copied into each rule's target input
+TARGET_INPUT_PROPERTIES = ('ToggleParameter', 'ToggleValues',
+                           'FingerprintInputs', 'Region', 'AccountId')
+
+# time held back from the Lambda deadline to send the cfn response: one
+# full response attempt (5s connect, 15s read) plus time for steps to
+# return from the AWS call they are making; send() fits its retries into
+# whatever is left
+RESPONSE_MARGIN_MS = 25000
 
 
 # https://stackoverflow.com/questions/37703609/using-python-logging-with-aws-lambda
 # while len(logging.root.handlers) > 0:
 #     logging.root.removeHandler(logging.root.handlers[-1])
 # logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
-log = logging.getLogger(__name__)
-log.setLevel(logging.INFO)
+log = get_logger(__name__)
 
 
 class AWSLambda(object):
@@ -30,11 +63,16 @@ class AWSLambda(object):
         """Define AWS lambda function components."""
         self.name = function_name
         self.event_name = event_name
-        self.statement_id = "AWSEvents_{}_{}".format(self.event_name,
-                                                     self.name)
-        self.rule_arn = "arn:aws:events:{}:{}:rule/{}".format(region,
-                                                              account_id,
-                                                              self.event_name)
+        if policy_mode == 'shared':
+            # no rule name can produce this id, so it never collides
+            self.statement_id = "AWSEvents_auto-update_{}".format(self.name)
+            source_rule = SHARED_RULE_PATTERN
+        else:
+            self.statement_id = "AWSEvents_{}_{}".format(self.event_name,
+                                                         self.name)
+            source_rule = self.event_name
+        self.rule_arn = "arn:aws:events:{}:{}:rule/{}".format(
+            region, get_account_id(), source_rule)
         self.get_function_input = {'FunctionName': self.name}
         self.add_permission_input = {
             'FunctionName': self.name,
@@ -49,43 +87,95 @@ class AWSLambda(object):
         }
 
 
+class PolicyCache(object):
+    """Remember which statements the update function's policy holds."""
+
+    def __init__(self, ttl):
+        """Define an empty view of the policy."""
+        self.ttl = ttl
+        self.entries = {}
+        self.loaded = None
+        self.stats = {'hits': 0, 'misses': 0}
+        self.lock = threading.Lock()
+
+    def lookup(self, statement_id):
+        """Return whether a statement is in the policy, or None if unknown."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(statement_id)
+            if entry and now - entry['recorded'] < self.ttl:
+                self.stats['hits'] += 1
+                return entry['present']
+            if self.loaded is not None and now - self.loaded < self.ttl:
+                # a fresh copy of the whole policy did not have it
+                self.stats['hits'] += 1
+                return False
+            self.stats['misses'] += 1
+            return None
+
+    def load(self, statement_ids):
+        """Replace the view with every statement id of a fresh policy."""
+        now = time.monotonic()
+        with self.lock:
+            self.loaded = now
+            self.entries = {statement_id: {'present': True, 'recorded': now}
+                            for statement_id in statement_ids}
+
+    def record(self, statement_id, present):
+        """Note a statement just added or removed."""
+        with self.lock:
+            self.entries[statement_id] = {'present': present,
+                                          'recorded': time.monotonic()}
+
+    def clear(self):
+        """Forget the policy."""
+        with self.lock:
+            self.entries.clear()
+            self.loaded = None
+
+
+policy_cache = PolicyCache(policy_ttl)
+
+
+def get_rule_target(event_constant):
+    """Return a rule's target, adding the scheduled time to its input."""
+    return {
+        'Id': function_name,
+        'Arn': get_target_lambda_arn(),
+        'InputTransformer': get_input_transformer(event_constant),
+    }
+
+
 class CloudwatchEvent(object):
     """Define Cloudwatch event and associated operations."""
 
     def __init__(self, stack_name, interval, toggle_parameter,
-                 toggle_values):
+                 toggle_values, fingerprint_inputs=None, stack_target=None):
         """Define Cloudwatch event components."""
         self.stack_name = stack_name
-        self.name = "auto-update-{}".format(self.stack_name)
+        self.name = "{}{}".format(RULE_PREFIX, self.stack_name)
         self.interval = interval
+        self.schedule_expression = get_schedule_expression(stack_name,
+                                                           interval)
         self.toggle_parameter = toggle_parameter
         self.toggle_values = toggle_values
         self.description = "trigger for {} auto update".format(self.stack_name)
         self.target_function_name = function_name
-        self.target_lambda_arn = get_lambda_arn(
-         FunctionName=self.target_function_name)
         self.event_constant = {
              'event_name': self.name,
              'stack_name': self.stack_name,
              'toggle_parameter': self.toggle_parameter,
              'toggle_values': self.toggle_values
            }
+        if fingerprint_inputs is not None:
+            self.event_constant['fingerprint_inputs'] = fingerprint_inputs
+        self.event_constant.update(stack_target or {})
         self.rule_text = {
             'Name': self.name,
-            'ScheduleExpression': self.interval,
+            'ScheduleExpression': self.schedule_expression,
             'State': 'ENABLED',
             'Description': self.description
         }
-        self.put_targets_input = {
-             'Rule': self.name,
-             'Targets': [
-                {
-                    'Id': self.target_function_name,
-                    'Arn': self.target_lambda_arn,
-                    'Input': json.dumps(self.event_constant)
-                }
-             ]
-        }
         self.remove_targets_input = {
             'Rule': self.name,
             'Ids': [
@@ -96,11 +186,118 @@ class CloudwatchEvent(object):
             'Name': self.name
         }
 
+    @property
+    def put_targets_input(self):
+        """Return put_targets input, resolving the target arn on demand."""
+        return {
+             'Rule': self.name,
+             'Targets': [get_rule_target(self.event_constant)]
+        }
+
+
+class DispatcherEvent(object):
+    """Define the shared dispatcher rule that polls the schedule table."""
+
+    def __init__(self, schedule):
+        """Define dispatcher rule components."""
+        self.name = DISPATCHER_NAME
+        self.schedule = schedule
+        self.description = "dispatcher for scheduled stack auto updates"
+        self.target_function_name = function_name
+        self.event_constant = {
+             'event_name': self.name,
+             'dispatch': True
+           }
+        self.describe_rule_input = {
+            'Name': self.name
+        }
+        self.rule_text = {
+            'Name': self.name,
+            'ScheduleExpression': self.schedule,
+            'State': 'ENABLED',
+            'Description': self.description
+        }
+
+    @property
+    def put_targets_input(self):
+        """Return put_targets input, resolving the target arn on demand."""
+        return {
+             'Rule': self.name,
+             'Targets': [
+                {
+                    'Id': self.target_function_name,
+                    'Arn': get_target_lambda_arn(),
+                    'Input': json.dumps(self.event_constant)
+                }
+             ]
+        }
+
+
+def get_schedule_expression(stack_name, interval):
+    """Return the stack's UpdateSchedule shifted within the jitter window."""
+    if interval is None:
+        return None
+    return schedule_expression.jitter(interval, stack_name, jitter_window)
+
+
+def get_stack_target(properties):
+    """Return the region and account of a stack outside the broker's own."""
+    stack_target = {}
+    if properties.get('Region') and properties['Region'] != region:
+        stack_target['region'] = properties['Region']
+    if properties.get('AccountId') and (
+            properties['AccountId'] != get_account_id()):
+        stack_target['account_id'] = properties['AccountId']
+    return stack_target
+
+
+def target_input_changed(event):
+    """Return True if an Update changes the input the rule passes on."""
+    old = event.get('OldResourceProperties', {})
+    new = event['ResourceProperties']
+    return any(old.get(key) != new.get(key) for key in TARGET_INPUT_PROPERTIES)
+
+
+def target_is_legacy(rule_name):
+    """Return True if a rule's target still passes a constant input.
+
+    Such targets predate the scheduled time and are rewritten on Update.
+    """
+    targets = call(get_client('events'), 'list_targets_by_rule',
+                   Rule=rule_name)['Targets']
+    return not any('InputTransformer' in target for target in targets)
+
+
+def set_invocation_context(context):
+    """Take the account id from the invoked function's arn."""
+    global account_id
+    invoked_function_arn = getattr(context, 'invoked_function_arn', None)
+    if account_id is None and invoked_function_arn:
+        account_id = invoked_function_arn.split(':')[4]
+
+
+def get_account_id():
+    """Return the account id, asking sts only as a last resort."""
+    global account_id
+    if account_id is None:
+        account_id = call(get_client('sts'),
+                          'get_caller_identity').get('Account')
+    return account_id
+
+
+def get_target_lambda_arn():
+    """Return the update target's arn without a get_function call."""
+    global function_arn
+    if function_arn is None:
+        function_arn = "arn:aws:lambda:{}:{}:function:{}".format(
+            region, get_account_id(), function_name)
+    return function_arn
+
 
 def get_lambda_arn(**kwargs):
     """Return lambda function arn."""
-    response = aws_lambda.get_function(**kwargs)
-    log.info("get_lambda_name: {}".format(response))
+    response = call(get_client('lambda'), 'get_function', **kwargs)
+    log.info(LogEvent('get_lambda_name', response=response))
     lambda_arn = response['Configuration']['FunctionArn']
     return lambda_arn
 
@@ -108,9 +305,9 @@ def get_lambda_arn(**kwargs):
 def lambda_add_resource_policy(**kwargs):
     """Update lambda resource policy."""
     try:
-        response = aws_lambda.add_permission(**kwargs)
-        log.info("lambda_add_resource_policy: {}".format(response))
-    except aws_lambda.exceptions.ResourceConflictException as e:
+        response = call(get_client('lambda'), 'add_permission', **kwargs)
+        log.info(LogEvent('lambda_add_resource_policy', response=response))
+    except get_client('lambda').exceptions.ResourceConflictException as e:
         log.info('Resource policy already exists.')
         response = None
     return response
@@ -118,22 +315,71 @@ def lambda_add_resource_policy(**kwargs):
 
 def lambda_remove_resource_policy(**kwargs):
     """Remove lambda resource policy."""
-    response = aws_lambda.remove_permission(**kwargs)
-    log.info("lambda_remove_resource_policy: {}".format(response))
+    response = call(get_client('lambda'), 'remove_permission', **kwargs)
+    log.info(LogEvent('lambda_remove_resource_policy', response=response))
+    return response
+
+
+def load_policy():
+    """Return the statement ids of the update function's resource policy."""
+    lambda_client = get_client('lambda')
+    try:
+        response = call(lambda_client, 'get_policy',
+                        FunctionName=get_target_lambda_arn())
+        statement_ids = [statement['Sid'] for statement in
+                         json.loads(response['Policy'])['Statement']]
+    except lambda_client.exceptions.ResourceNotFoundException:
+        statement_ids = []
+    policy_cache.load(statement_ids)
+    return statement_ids
+
+
+def ensure_permission(aws_lambda_obj):
+    """Let a rule invoke the update function unless it already can."""
+    statement_id = aws_lambda_obj.statement_id
+    present = policy_cache.lookup(statement_id)
+    if present is None and policy_mode == 'shared':
+        # one get_policy per ttl answers for every rule
+        load_policy()
+        present = policy_cache.lookup(statement_id)
+    if present:
+        log.info(LogEvent('Resource policy already allows rule',
+                          rule=aws_lambda_obj.event_name))
+        return None
+    # an existing statement raises a conflict that is handled as success
+    response = lambda_add_resource_policy(
+        **aws_lambda_obj.add_permission_input)
+    policy_cache.record(statement_id, True)
+    return response
+
+
+def revoke_permission(aws_lambda_obj):
+    """Remove a rule's statement; the shared statement is kept."""
+    statement_id = aws_lambda_obj.statement_id
+    if policy_mode == 'shared' or policy_cache.lookup(statement_id) is False:
+        return None
+    lambda_client = get_client('lambda')
+    try:
+        response = lambda_remove_resource_policy(
+            **aws_lambda_obj.remove_permission_input)
+    except lambda_client.exceptions.ResourceNotFoundException:
+        log.info('Resource policy previously removed.')
+        response = None
+    policy_cache.record(statement_id, False)
     return response
 
 
 def create_event(**kwargs):
     """Create a cloudwatch event."""
-    response = event.put_rule(**kwargs)
-    log.info("create_event: {}".format(response))
+    response = call(get_client('events'), 'put_rule', **kwargs)
+    log.info(LogEvent('create_event', response=response))
     return response
 
 
 def put_targets(**kwargs):
     """Set Cloudwatch event target."""
-    response = event.put_targets(**kwargs)
-    log.info("put_targets: {}".format(response))
+    response = call(get_client('events'), 'put_targets', **kwargs)
+    log.info(LogEvent('put_targets', response=response))
     return response
 
 
@@ -143,9 +389,9 @@ def remove_event_targets(**kwargs):
     Cloudwatch events cannot be deleted if they ref a target
     """
     try:
-        response = event.remove_targets(**kwargs)
-        log.info("remove_targets: {}".format(response))
-    except event.exceptions.ResourceNotFoundException as e:
+        response = call(get_client('events'), 'remove_targets', **kwargs)
+        log.info(LogEvent('remove_targets', response=response))
+    except get_client('events').exceptions.ResourceNotFoundException as e:
         log.info('Event previously removed.')
         response = None
     return response
@@ -153,14 +399,72 @@ def remove_event_targets(**kwargs):
 
 def delete_event(**kwargs):
     """Delete target cloudwatch event."""
-    response = event.delete_rule(**kwargs)
-    log.info("delete_event: {}".format(response))
+    response = call(get_client('events'), 'delete_rule', **kwargs)
+    log.info(LogEvent('delete_event', response=response))
     return response
 
 
+def dispatcher_exists(**kwargs):
+    """Return True if the dispatcher rule has already been created."""
+    try:
+        response = call(get_client('events'), 'describe_rule', **kwargs)
+        log.info(LogEvent('dispatcher_exists', response=response))
+    except get_client('events').exceptions.ResourceNotFoundException as e:
+        return False
+    return True
+
+
+def ensure_dispatcher():
+    """Create the dispatcher rule, target and permission once."""
+    global dispatcher_ready
+    if dispatcher_ready:
+        return
+    if not dispatcher_exists(Name=DISPATCHER_NAME):
+        dispatcher_obj = DispatcherEvent(dispatch_schedule)
+        create_event(**dispatcher_obj.rule_text)
+        put_targets(**dispatcher_obj.put_targets_input)
+        ensure_permission(AWSLambda(dispatcher_obj.name))
+        log.info(LogEvent('Created dispatcher rule',
+                          rule=dispatcher_obj.name))
+    dispatcher_ready = True
+
+
+def get_time_budget(context):
+    """Return the seconds broker steps may run, or None without a limit."""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    remaining = context.get_remaining_time_in_millis() - RESPONSE_MARGIN_MS
+    return max(remaining, 0) / 1000.0
+
+
+def run_steps(context, *steps):
+    """Run independent broker steps concurrently within the time left.
+
+    Steps still running when this returns start no further AWS call and
+    are joined first, so none changes rules after the response is sent.
+    """
+    executor = ThreadPoolExecutor(max_workers=len(steps))
+    try:
+        futures = [executor.submit(step) for step in steps]
+        done, pending = wait(futures, timeout=get_time_budget(context),
+                             return_when=FIRST_EXCEPTION)
+        for future in done:
+            future.result()
+        if pending:
+            raise TimeoutError(
+                'Broker steps did not finish before the Lambda deadline.')
+        return [future.result() for future in futures]
+    finally:
+        set_deadline(time.time())
+        executor.shutdown(wait=True)
+        set_deadline(None)
+
+
 def lambda_handler(event, context):
     """Parse event."""
-    log.info("labmda_handler recieved event: {}".format(event))
+    start_invocation()
+    log.info(LogEvent('lambda_handler received event', event=event))
+    set_invocation_context(context)
     response_type = cfnresponse.FAILED
     try:
         response_value = event['ResourceProperties']
@@ -170,60 +474,88 @@ def lambda_handler(event, context):
         toggle_parameter = event['ResourceProperties']['ToggleParameter']
         interval = event['ResourceProperties']['UpdateSchedule']
         stack_name = event['ResourceProperties']['StackName']
+        fingerprint_inputs = event['ResourceProperties'].get(
+            'FingerprintInputs')
+        stack_target = get_stack_target(event['ResourceProperties'])
+        schedule = get_schedule_expression(stack_name, interval)
+        response_data['ScheduleExpression'] = schedule
         reason = None
 
         def cfn_delete_request():
             """Delete event."""
             log.info('Recieved Delete event')
+            if dispatch_mode == 'table':
+                schedule_table.delete_schedule(stack_name)
+                return cfnresponse.SUCCESS
             event_obj = CloudwatchEvent(stack_name, None, None, None)
             aws_lambda_obj = AWSLambda(event_obj.name)
-            try:
-                lambda_remove_resource_policy(
-                 **aws_lambda_obj.remove_permission_input)
-            except aws_lambda.exceptions.ResourceNotFoundException as e:
-                log.info('Resource policy previously removed.')
-
-            remove_event_targets(**event_obj.remove_targets_input)
-            try:
-                delete_event(**event_obj.delete_rule_input)
-            except event.exceptions.ResourceNotFoundException as e:
-                log.info('Event previously deleted.')
+            events_errors = get_client('events').exceptions
+
+            def remove_permission():
+                revoke_permission(aws_lambda_obj)
+
+            def remove_rule():
+                # a rule cannot be deleted while it still has targets
+                remove_event_targets(**event_obj.remove_targets_input)
+                try:
+                    delete_event(**event_obj.delete_rule_input)
+                except events_errors.ResourceNotFoundException:
+                    log.info('Event previously deleted.')
+
+            run_steps(context, remove_permission, remove_rule)
             return cfnresponse.SUCCESS
 
         def cfn_update_request():
             """Update event."""
             log.info('Recieved Update event')
+            if dispatch_mode == 'table':
+                schedule_table.put_schedule(
+                    stack_name, schedule, toggle_parameter, toggle_values,
+                    fingerprint_inputs=fingerprint_inputs,
+                    stack_target=stack_target)
+                return cfnresponse.SUCCESS
             event_obj = CloudwatchEvent(stack_name, interval, toggle_parameter,
-                                        toggle_values)
-            stack = client.describe_stacks(StackName=stack_name)['Stacks'][0]
-            if stack['StackStatus'] is not 'CREATE_IN_PROGRESS':
+                                        toggle_values, fingerprint_inputs,
+                                        stack_target)
+            # the broker cannot describe stacks in another region or account
+            if stack_target or stack_cache.get(stack_name)[
+                    'StackStatus'] != 'CREATE_IN_PROGRESS':
                 create_event(**event_obj.rule_text)
-                log.info('Succesfully updated auto-update rule: {}'.format(
-                 event_obj.name))
+                if (target_input_changed(event) or
+                        target_is_legacy(event_obj.name)):
+                    put_targets(**event_obj.put_targets_input)
+                log.info(LogEvent('Succesfully updated auto-update rule',
+                                  rule=event_obj.name))
 
             return cfnresponse.SUCCESS
 
         def cfn_create_request():
             """Create event."""
             log.info('Recieved Create event')
+            if dispatch_mode == 'table':
+                run_steps(
+                    context,
+                    lambda: schedule_table.put_schedule(
+                        stack_name, schedule, toggle_parameter,
+                        toggle_values, fingerprint_inputs=fingerprint_inputs,
+                        stack_target=stack_target),
+                    ensure_dispatcher)
+                return cfnresponse.SUCCESS
 
             event_obj = CloudwatchEvent(stack_name, interval, toggle_parameter,
-                                        toggle_values)
-            create_event(**event_obj.rule_text)
-            put_targets(**event_obj.put_targets_input)
-
+                                        toggle_values, fingerprint_inputs,
+                                        stack_target)
             aws_lambda_obj = AWSLambda(event_obj.name)
-            try:
-                lambda_add_resource_policy(
-                 **aws_lambda_obj.add_permission_input)
-            except aws_lambda.exceptions.ResourceConflictException as e:
-                log.info('Stale resource policy detected.')
-                lambda_remove_resource_policy(
-                 **aws_lambda_obj.remove_permission_input)
-                log.info('removed stale resource policy.')
-                lambda_add_resource_policy(
-                 **aws_lambda_obj.add_permission_input)
-                log.info('resource policy successfully added.')
+
+            def create_rule():
+                # targets can only be added once the rule exists
+                create_event(**event_obj.rule_text)
+                put_targets(**event_obj.put_targets_input)
+
+            def add_permission():
+                ensure_permission(aws_lambda_obj)
+
+            run_steps(context, create_rule, add_permission)
             return cfnresponse.SUCCESS
 
         if event['RequestType'] == "Delete":
@@ -244,9 +576,10 @@ def lambda_handler(event, context):
             log.exception('Unknown request type')
             raise Exception
     except Exception as e:
-        log.exception('Error: failed on event: {}'.format(event))
+        log.exception(LogEvent('Error: failed on event', event=event))
         print(str(e), e.args)
         raise
     finally:
         cfnresponse.send(event, context, response_type, response_data, reason,
                          "CustomResourcePhyiscalID")
+        flush_metrics()
@@ -5,44 +5,138 @@
 #  This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied.
 #  See the License for the specific language governing permissions and limitations under the License.
 
-from botocore.vendored import requests
 import json
+import random
+import time
+
+import urllib3
+
+import structured_logging
 
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
 
+# CloudFormation rejects response bodies larger than 4096 bytes
+MAX_RESPONSE_BYTES = 4096
+MAX_REASON_LENGTH = 512
 
-def send(event, context, responseStatus, responseData, reason=None, physicalResourceId=None, noEcho=False):
-    responseUrl = event['ResponseURL']
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_CAP = 8.0  # seconds
+CONNECT_TIMEOUT = 5.0  # seconds
+READ_TIMEOUT = 15.0  # seconds
+# time left for the function to return after the last attempt
+DEADLINE_MARGIN = 0.5  # seconds
+
+# one pool reused across warm invocations; urllib3's own retries are off so
+# the loop in send() decides what is retried
+http = urllib3.PoolManager(
+    timeout=urllib3.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT),
+    retries=False,
+    maxsize=2
+)
 
-    print(responseUrl)
 
+def buildBody(event, context, responseStatus, responseData, reason,
+              physicalResourceId, noEcho):
     responseBody = {}
     responseBody['Status'] = responseStatus
     if reason is None:
         responseBody['Reason'] = 'See the details in CloudWatch Log Stream: ' + context.log_stream_name
     else:
-        responseBody['Reason'] = reason
+        responseBody['Reason'] = reason[:MAX_REASON_LENGTH]
     responseBody['PhysicalResourceId'] = physicalResourceId or context.log_stream_name
     responseBody['StackId'] = event['StackId']
     responseBody['RequestId'] = event['RequestId']
     responseBody['LogicalResourceId'] = event['LogicalResourceId']
     responseBody['NoEcho'] = noEcho
     responseBody['Data'] = responseData
+    return responseBody
+
 
+def encodeBody(responseBody):
     json_responseBody = json.dumps(responseBody)
+    if len(json_responseBody.encode('utf-8')) <= MAX_RESPONSE_BYTES:
+        return json_responseBody
 
-    print("Response body:\n" + json_responseBody)
+    # drop Data rather than have CloudFormation reject the whole response
+    print("Response body exceeds {} bytes; omitting Data.".format(
+        MAX_RESPONSE_BYTES))
+    responseBody = dict(responseBody, Data={})
+    responseBody['Reason'] = (
+        responseBody['Reason'] + ' (response Data omitted: over {} bytes)'
+        .format(MAX_RESPONSE_BYTES))[:MAX_REASON_LENGTH]
+    return json.dumps(responseBody)
+
+
+def isRetryable(status):
+    return status >= 500 or status == 429
+
+
+def getDeadline(context):
+    # the epoch time send() must finish by, or None outside Lambda
+    try:
+        remaining = float(context.get_remaining_time_in_millis())
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return time.time() + remaining / 1000.0 - DEADLINE_MARGIN
+
+
+def getTimeout(deadline):
+    # an attempt's timeout, cut short so it ends by the deadline; None
+    # once the deadline has passed
+    if deadline is None:
+        return urllib3.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT)
+    left = deadline - time.time()
+    if left <= 0:
+        return None
+    return urllib3.Timeout(total=left, connect=min(CONNECT_TIMEOUT, left),
+                           read=min(READ_TIMEOUT, left))
+
+
+def send(event, context, responseStatus, responseData, reason=None, physicalResourceId=None, noEcho=False):
+    responseUrl = event['ResponseURL']
+
+    # failures are always logged in full; the url's signature never is
+    verbose = responseStatus == FAILED or structured_logging.is_sampled()
+    if verbose:
+        print(structured_logging.redact_url(responseUrl))
+
+    responseBody = buildBody(event, context, responseStatus, responseData,
+                             reason, physicalResourceId, noEcho)
+    json_responseBody = encodeBody(responseBody)
+
+    if verbose:
+        print("Response body:\n" + json_responseBody)
 
     headers = {
         'content-type': '',
-        'content-length': str(len(json_responseBody))
+        'content-length': str(len(json_responseBody.encode('utf-8')))
     }
 
-    try:
-        response = requests.put(responseUrl,
-                                data=json_responseBody,
-                                headers=headers)
-        print("Status code: " + response.reason)
-    except Exception as e:
-        print("send(..) failed executing requests.put(..): " + str(e))
+    # every attempt and backoff ends before the Lambda timeout would kill
+    # send() and leave CloudFormation waiting for a response
+    deadline = getDeadline(context)
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        timeout = getTimeout(deadline)
+        if timeout is None:
+            print("send(..) ran out of time after {} attempts".format(
+                attempt - 1))
+            return False
+        try:
+            response = http.request('PUT', responseUrl,
+                                    body=json_responseBody.encode('utf-8'),
+                                    headers=headers, timeout=timeout)
+            print("Status code: " + str(response.status))
+            if not isRetryable(response.status):
+                return response.status < 400
+        except urllib3.exceptions.HTTPError as e:
+            print("send(..) failed executing http.request(..): " + str(e))
+        if attempt < MAX_ATTEMPTS:
+            delay = random.uniform(
+                0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            if deadline is not None:
+                delay = max(0, min(delay, deadline - time.time()))
+            time.sleep(delay)
+    print("send(..) gave up after {} attempts".format(MAX_ATTEMPTS))
+    return False
@@ -0,0 +1,112 @@
+"""Stage toggle updates as change sets ahead of their scheduled run.
+
+In two-phase mode a staging sweep creates a change set with the toggled
+parameters for every dispatched stack due within ``stage_lead`` seconds,
+so CloudFormation works out the changes before the update window.  At the
+window the updater only executes it.  A change set is stale when the
+stack was updated after it was created, or when it no longer toggles the
+stack's current value; the sweep deletes and rebuilds stale and failed
+change sets, and the window falls back to update_stack.
+
+Change sets are named after the run they were staged for, so the window
+finds its change set without listing the stack's change sets.
+"""
+
+import os
+
+from botocore.exceptions import ClientError
+
+from aws_clients import call
+from structured_logging import LogEvent, get_logger
+
+log = get_logger(__name__)
+
+use_change_sets = os.environ.get('CHANGE_SETS', 'false').lower() == 'true'
+# how far ahead of a stack's next run its change set is staged
+stage_lead = int(os.environ.get('CHANGE_SET_LEAD', '3600'))
+
+CHANGE_SET_PREFIX = 'auto-update-'
+PENDING_STATUSES = frozenset(['CREATE_PENDING', 'CREATE_IN_PROGRESS'])
+# a missing stack, and some endpoints' missing change set, answer with a
+# ValidationError saying this instead of ChangeSetNotFoundException
+MISSING_ERROR = 'does not exist'
+
+
+def get_change_set_name(scheduled_at):
+    """Return the name of the change set staged for a scheduled run."""
+    return '{}{}'.format(CHANGE_SET_PREFIX, int(scheduled_at))
+
+
+def get_toggle_value(parameters, toggle_parameter):
+    """Return a parameter list's value for the toggle parameter."""
+    for parameter in parameters:
+        if parameter['ParameterKey'] == toggle_parameter:
+            return parameter.get('ParameterValue')
+    return None
+
+
+def is_missing(client, error):
+    """Return True if a call failed because the change set is not there."""
+    return (isinstance(error, client.exceptions.ChangeSetNotFoundException)
+            or MISSING_ERROR in str(error))
+
+
+def describe(client, stack_name, name):
+    """Return a stack's change set, or None if there is none by that name."""
+    try:
+        return call(client, 'describe_change_set', StackName=stack_name,
+                    ChangeSetName=name)
+    except ClientError as e:
+        if not is_missing(client, e):
+            raise
+        return None
+
+
+def is_pending(change_set):
+    """Return True if CloudFormation is still computing a change set."""
+    return change_set['Status'] in PENDING_STATUSES
+
+
+def is_fresh(change_set, stack, toggle_parameter, toggle_value):
+    """Return True if a change set still applies the stack's next toggle."""
+    if (change_set['Status'] != 'CREATE_COMPLETE' or
+            change_set.get('ExecutionStatus') != 'AVAILABLE'):
+        return False
+    updated = stack.get('LastUpdatedTime') or stack.get('CreationTime')
+    if updated is not None and updated > change_set['CreationTime']:
+        return False
+    return get_toggle_value(change_set.get('Parameters', []),
+                            toggle_parameter) == toggle_value
+
+
+def stage(client, update_stack_input, name):
+    """Create a change set from update_stack's input."""
+    response = call(client, 'create_change_set', ChangeSetName=name,
+                    ChangeSetType='UPDATE', **update_stack_input)
+    log.info(LogEvent('Staged change set', change_set=name,
+                      stack=update_stack_input['StackName']))
+    return response
+
+
+def delete(client, stack_name, name):
+    """Delete a stack's change set if it still exists."""
+    try:
+        call(client, 'delete_change_set', StackName=stack_name,
+             ChangeSetName=name)
+    except ClientError as e:
+        if not is_missing(client, e):
+            raise
+        return
+    log.info(LogEvent('Dropped change set', change_set=name,
+                      stack=stack_name))
+
+
+def execute(client, stack_name, name, client_request_token=None):
+    """Execute a staged change set."""
+    kwargs = {'StackName': stack_name, 'ChangeSetName': name}
+    if client_request_token is not None:
+        kwargs['ClientRequestToken'] = client_request_token
+    response = call(client, 'execute_change_set', **kwargs)
+    log.info(LogEvent('Executed change set', change_set=name,
+                      stack=stack_name))
+    return response
@@ -1,24 +1,56 @@
 """Update stacks."""
 
-import logging
 import os
+import threading
 from ast import literal_eval
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
+from datetime import datetime, timedelta, timezone
 
 import boto3
 
-client = boto3.client('cloudformation')
-cloudwatch = boto3.client('cloudwatch')
-sts = boto3.client('sts')
+import change_sets
+import dependencies
+import fingerprint
+import rollouts
+import schedule_expression
+import schedule_table
+import update_queue
+from stack_cache import stack_cache
+from state_store import get_state_store
+from structured_logging import LogEvent, get_logger, start_invocation
+from breaker import breaker
+from dispatch_cache import dispatch_cache, get_dispatch_key, is_token_reused
+from inflight import (BLOCKED, BUSY, READY, get_stack_state, is_busy_error,
+                      tracker)
+from aws_clients import (CLIENT_CONFIG, call, classify_error, flush_metrics,
+                         get_client)
+from instrumentation import instrument
 
 stack_update_arn = os.environ['STACK_UPDATE_ARN']
+# descriptors without a region or account are updated through this target
+home_region = os.environ.get('AWS_REGION')
+HOME_TARGET = (stack_update_arn, None)
+max_workers = int(os.environ.get('MAX_WORKERS', '8'))
+# batches at least this large prime the stack cache from one describe sweep
+prime_threshold = int(os.environ.get('STACK_CACHE_PRIME_THRESHOLD', '20'))
+# fleet-wide cap on stack updates in progress when draining the queue
+max_in_progress = int(os.environ.get('MAX_IN_PROGRESS', '10'))
+
+ASSUME_ROLE_DURATION = 3600  # in seconds. 900 (15min) or greater.
+# refresh cached role credentials this many seconds before they expire
+CREDENTIAL_REFRESH_MARGIN = 300
+# the state store key of the dependency-ordered rollout in progress; each
+# level's descriptors have their own item, so no item grows with the fleet
+ORDERED_ROLLOUT_KEY = 'ordered-rollout'
+ORDERED_LEVEL_KEY = 'ordered-rollout-level:{}'
 
 # https://stackoverflow.com/questions/37703609/using-python-logging-with-aws-lambda
 # while len(logging.root.handlers) > 0:
 #     logging.root.removeHandler(logging.root.handlers[-1])
 # logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
-log = logging.getLogger(__name__)
-log.setLevel(logging.INFO)
+log = get_logger(__name__)
 
 
 def get_assume_role_input(role_arn, duration):
@@ -32,8 +64,8 @@ def get_assume_role_input(role_arn, duration):
 
 def assume_role(**kwargs):
     """Assume stack update role."""
-    response = sts.assume_role(**kwargs)
-    log.info("assume_role: {}".format(response))
+    response = call(get_client('sts'), 'assume_role', **kwargs)
+    log.info(LogEvent('assume_role', response=response))
     return response
 
 
@@ -46,45 +78,88 @@ def get_elevated_session_input(response):
     }
 
 
-def get_elevated_session(**kwargs):
+def get_elevated_session(region_name=None, **kwargs):
     """Create new boto3 session with assumed role."""
-    update_stack_session = boto3.Session(**kwargs)
-    elevated_cfn_client = update_stack_session.client('cloudformation')
+    update_stack_session = boto3.Session(region_name=region_name, **kwargs)
+    elevated_cfn_client = instrument(update_stack_session.client(
+        'cloudformation', config=CLIENT_CONFIG))
     return elevated_cfn_client
 
 
-def get_metrics_input(event_name):
-    """Create get_metrics input."""
-    return {
-        'Namespace': 'AWS/Events',
-        'MetricName': 'Invocations',
-        'Dimensions': [
-            {
-                'Name': 'RuleName',
-                'Value': event_name,
-            },
-        ],
-        'StartTime': datetime.now() - timedelta(days=1),
-        'EndTime': datetime.now() + timedelta(days=1),
-        'Period': 86400,
-        'Statistics': [
-            'Sum',
-        ],
-        'Unit': 'Count'
-    }
+def get_account_role_arn(account_id):
+    """Return the stack update role of the same name in another account."""
+    return 'arn:aws:iam::{}:role/{}'.format(
+        account_id, stack_update_arn.split(':role/', 1)[1])
 
 
-def get_metrics(**kwargs):
-    """Get event invoke count."""
-    response = cloudwatch.get_metric_statistics(**kwargs)
-    log.info("get_metrics: {}".format(response))
-    return response
+def get_target(event):
+    """Return the (role arn, region) a descriptor's stack is updated with."""
+    role_arn = stack_update_arn
+    if event.get('account_id'):
+        role_arn = get_account_role_arn(event['account_id'])
+    region = event.get('region')
+    if region == home_region:
+        region = None
+    return (role_arn, region)
+
+
+def get_stack_key(event):
+    """Return a name for a descriptor's stack that is unique across targets."""
+    role_arn, region = target = get_target(event)
+    if target == HOME_TARGET:
+        return event['stack_name']
+    return '{}:{}:{}'.format(role_arn.split(':')[4], region or home_region,
+                             event['stack_name'])
+
+
+def get_key_descriptor(key):
+    """Return the descriptor fields a stack key was built from."""
+    parts = key.split(':')
+    if len(parts) == 1:
+        return {'stack_name': key}
+    account_id, region, stack_name = parts
+    return {'account_id': account_id, 'region': region,
+            'stack_name': stack_name}
+
+
+def get_scope(target):
+    """Return the stack cache scope of a target."""
+    return None if target == HOME_TARGET else target
 
 
-def get_parameters(stack_name):
+def get_describe_client(target):
+    """Return the client that describes a target's stacks.
+
+    The home target is described with the function's own client (None).
+    """
+    if target == HOME_TARGET:
+        return None
+    return get_elevated_client(target)
+
+
+def get_stack(event):
+    """Return a descriptor's stack summary from its target's cache."""
+    target = get_target(event)
+    return stack_cache.get(event['stack_name'], get_describe_client(target),
+                           get_scope(target))
+
+
+def get_current_stack_by_key(key):
+    """Return the stack summary behind a stack key, bypassing the cache.
+
+    Updates started from other execution environments are not in this
+    environment's cache.
+    """
+    descriptor = get_key_descriptor(key)
+    stack_cache.invalidate(descriptor['stack_name'],
+                           get_scope(get_target(descriptor)))
+    return get_stack(descriptor)
+
+
+def get_parameters(stack_name, target=HOME_TARGET):
     """Get stack's parameters."""
-    stack = client.describe_stacks(StackName=stack_name)['Stacks'][0]
-    return stack['Parameters']
+    return stack_cache.get(stack_name, get_describe_client(target),
+                           get_scope(target))['Parameters']
 
 
 def update_parameter(parameter, toggle_parameter, toggle_values):
@@ -96,6 +171,8 @@ def update_parameter(parameter, toggle_parameter, toggle_values):
     else:
         parameter.pop('ParameterValue')
         parameter['UsePreviousValue'] = True
+    # SSM-typed parameters report their value, which update_stack rejects
+    parameter.pop('ResolvedValue', None)
 
     return parameter
 
@@ -105,13 +182,14 @@ def update_parameters(parameter_list, toggle_parameter, toggle_values):
         update_parameter(parameter, toggle_parameter, toggle_values) for
         parameter in parameter_list
     ]
-    log.info("updated parameter list: {}".format(parameters))
+    log.info(LogEvent('updated parameter list', parameters=parameters))
     return parameters
 
 
-def get_update_stack_input(stack_name, stack_parameters):
+def get_update_stack_input(stack_name, stack_parameters,
+                           client_request_token=None):
     """Return input for a stack update."""
-    return {
+    update_stack_input = {
               'StackName': stack_name,
               'UsePreviousTemplate': True,
               'Parameters': stack_parameters,
@@ -120,67 +198,576 @@ def get_update_stack_input(stack_name, stack_parameters):
                     'CAPABILITY_NAMED_IAM'
                 ]
         }
+    if client_request_token is not None:
+        update_stack_input['ClientRequestToken'] = client_request_token
+    return update_stack_input
 
 
-def update_stack(elevated_cfn_client, **kwargs):
+def update_stack(elevated_cfn_client, target=HOME_TARGET, **kwargs):
     """Update a cloudformation stack."""
-    response = elevated_cfn_client.update_stack(**kwargs)
-    log.info('update_stack: {}'.format(update_stack))
+    try:
+        response = call(elevated_cfn_client, 'update_stack', **kwargs)
+    finally:
+        # the stack's status and update time are about to change
+        stack_cache.invalidate(kwargs['StackName'], get_scope(target))
     return response
 
 
 def force_stack_update(elevated_cfn_client, stack_name, toggle_parameter,
-                       toggle_values):
+                       toggle_values, target=HOME_TARGET,
+                       client_request_token=None):
     """Force update of cloudformation stack."""
     stack_parameters = update_parameters(
-        get_parameters(stack_name),
+        get_parameters(stack_name, target),
         toggle_parameter,
         toggle_values
     )
     response = (
-        update_stack(elevated_cfn_client,
-                     **get_update_stack_input(stack_name, stack_parameters))
+        update_stack(elevated_cfn_client, target,
+                     **get_update_stack_input(stack_name, stack_parameters,
+                                              client_request_token))
     )
-    log.info("update_stack: {}".format(response))
+    log.info(LogEvent('update_stack', response=response))
     return response
 
 
+class ElevatedClientCache(object):
+    """Reuse assumed-role cloudformation clients across warm invocations.
+
+    Credentials are kept per role, so one assume_role call serves every
+    region; clients are kept per region under those credentials. Each role
+    has its own lock, so assuming one role never waits on another.
+    """
+
+    def __init__(self, refresh_margin):
+        """Define the cache and its counters."""
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.entries = {}
+        self.role_locks = {}
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0}
+        self.lock = threading.Lock()
+
+    def count(self, counter):
+        """Increment a counter."""
+        with self.lock:
+            self.stats[counter] += 1
+
+    def get_role_lock(self, role_arn):
+        """Return the lock of one role, creating it on first use."""
+        with self.lock:
+            return self.role_locks.setdefault(role_arn, threading.Lock())
+
+    def is_fresh(self, entry):
+        """Return True while an entry's credentials outlive the margin."""
+        remaining = entry['expiration'] - datetime.now(timezone.utc)
+        return remaining > self.refresh_margin
+
+    def get(self, role_arn, duration, region=None):
+        """Return the elevated client, assuming the role when needed."""
+        with self.get_role_lock(role_arn):
+            entry = self.entries.get(role_arn)
+            if entry and self.is_fresh(entry):
+                self.count('hits')
+            else:
+                self.count('refreshes' if entry else 'misses')
+                assume_role_response = assume_role(
+                    **get_assume_role_input(role_arn, duration))
+                log.info(LogEvent('Assumed role', role_arn=role_arn,
+                                  seconds=duration))
+                entry = self.entries[role_arn] = {
+                    'session_input': get_elevated_session_input(
+                        assume_role_response),
+                    'clients': {},
+                    'expiration': assume_role_response['Credentials'][
+                        'Expiration']
+                }
+            client = entry['clients'].get(region)
+            if client is None:
+                client = entry['clients'][region] = get_elevated_session(
+                    region_name=region, **entry['session_input'])
+            return client
+
+    def clear(self):
+        """Drop every cached client."""
+        with self.lock:
+            self.entries.clear()
+
+
+elevated_clients = ElevatedClientCache(CREDENTIAL_REFRESH_MARGIN)
+
+
 def assumed_role_update_stack(stack_name, toggle_parameter, toggle_values,
-                              duration):
+                              duration, elevated_cfn_client=None,
+                              target=HOME_TARGET, client_request_token=None):
     """Update stack with assumed role."""
-    assume_role_input = get_assume_role_input(stack_update_arn, duration)
-    assume_role_response = assume_role(**assume_role_input)
-    log.info("Assumed StackUpdateRole for {} seconds".format(duration))
-
-    elevated_session_input = get_elevated_session_input(assume_role_response)
-    elevated_cfn_client = get_elevated_session(**elevated_session_input)
-    log.info("Retrieved elevated cfn client.")
+    if elevated_cfn_client is None:
+        role_arn, region = target
+        elevated_cfn_client = elevated_clients.get(role_arn, duration, region)
+        log.info("Retrieved elevated cfn client.")
 
     force_stack_update(elevated_cfn_client, stack_name, toggle_parameter,
-                       toggle_values)
-    log.info('CloudWatch successfully triggered update of stack: {}'.format(
-       stack_name))
+                       toggle_values, target, client_request_token)
+    log.info(LogEvent('CloudWatch successfully triggered update',
+                      stack=stack_name))
+
+
+def get_elevated_client(target):
+    """Return the assumed-role cloudformation client of a target."""
+    role_arn, region = target
+    return elevated_clients.get(role_arn, ASSUME_ROLE_DURATION, region)
+
+
+def get_toggled_parameters(stack, toggle_parameter, toggle_values):
+    """Return update_stack parameters without changing the cached ones."""
+    return update_parameters(
+        [dict(parameter) for parameter in stack['Parameters']],
+        toggle_parameter, toggle_values)
+
+
+def stage_change_set(descriptor):
+    """Create or rebuild a due stack's change set; return what was done."""
+    stack_name = descriptor['stack_name']
+    toggle_parameter = descriptor['toggle_parameter']
+    target = get_target(descriptor)
+    stack = get_stack(descriptor)
+    if get_stack_state(stack['StackStatus']) != READY:
+        return 'not_ready'
+    parameters = get_toggled_parameters(stack, toggle_parameter,
+                                        descriptor['toggle_values'])
+    client = get_elevated_client(target)
+    name = change_sets.get_change_set_name(descriptor['scheduled_at'])
+    outcome = 'staged'
+    change_set = change_sets.describe(client, stack_name, name)
+    if change_set is not None:
+        if change_sets.is_pending(change_set) or change_sets.is_fresh(
+                change_set, stack, toggle_parameter,
+                change_sets.get_toggle_value(parameters, toggle_parameter)):
+            return 'kept'
+        change_sets.delete(client, stack_name, name)
+        outcome = 'rebuilt'
+    change_sets.stage(client, get_update_stack_input(stack_name, parameters),
+                      name)
+    return outcome
+
+
+def stage_or_fail(descriptor):
+    """Stage one change set, returning 'failed' instead of raising."""
+    try:
+        return stage_change_set(descriptor)
+    except Exception:
+        log.exception(LogEvent('Staging change set failed',
+                               stack=descriptor))
+        return 'failed'
+
+
+def stage_change_sets(now=None, workers=None):
+    """Stage change sets for dispatched stacks due within the lead time."""
+    now = now or schedule_expression.utcnow()
+    # stacks already due are about to be claimed, and update as they are
+    start = schedule_expression.to_timestamp(now)
+    records = schedule_table.get_due_schedules(
+        now + timedelta(seconds=change_sets.stage_lead))
+    descriptors = [schedule_table.get_stack_descriptor(record)
+                   for record in records if record['next_run'] > start]
+    with ThreadPoolExecutor(max_workers=workers or max_workers) as executor:
+        outcomes = list(executor.map(stage_or_fail, descriptors))
+    results = dict((descriptor['stack_name'], outcome)
+                   for descriptor, outcome in zip(descriptors, outcomes))
+    log.info(LogEvent('stage', results=results))
+    return results
+
+
+def execute_staged_change_set(event, target, client_request_token=None):
+    """Execute an event's staged change set; return False if none is usable.
+
+    A stale change set is dropped, and the caller falls back to
+    update_stack.
+    """
+    if not change_sets.use_change_sets or 'scheduled_at' not in event:
+        return False
+    stack_name = event['stack_name']
+    toggle_parameter = event['toggle_parameter']
+    client = get_elevated_client(target)
+    name = change_sets.get_change_set_name(event['scheduled_at'])
+    change_set = change_sets.describe(client, stack_name, name)
+    if change_set is None:
+        return False
+    stack = get_stack(event)
+    parameters = get_toggled_parameters(stack, toggle_parameter,
+                                        event['toggle_values'])
+    if not change_sets.is_fresh(
+            change_set, stack, toggle_parameter,
+            change_sets.get_toggle_value(parameters, toggle_parameter)):
+        change_sets.delete(client, stack_name, name)
+        return False
+    try:
+        change_sets.execute(client, stack_name, name, client_request_token)
+    finally:
+        stack_cache.invalidate(stack_name, get_scope(target))
+    return True
+
+
+def get_update_result(stack_name, status, error=None):
+    """Return the per-stack result reported by the handler."""
+    return {
+        'stack_name': stack_name,
+        'status': status,
+        'error': error
+    }
+
+
+def update_target(event):
+    """Run a scheduled update for a single stack descriptor."""
+    stack_name = event['stack_name']
+    toggle_parameter = event['toggle_parameter']
+    toggle_values = event['toggle_values']
+    target = get_target(event)
+    key = get_stack_key(event)
+    dispatch_key = get_dispatch_key(event)
+    # a repeated delivery of a run that already started costs no api calls
+    if dispatch_key is not None and dispatch_cache.seen(dispatch_key):
+        return get_update_result(stack_name, 'DUPLICATE')
+    # a stack waiting out a failure backoff costs no api calls
+    if not breaker.allows(key):
+        return get_update_result(stack_name, 'BACKOFF')
+    try:
+        stack = get_stack(event)
+        # check the stack can take an update before any sts or parameter work
+        state = tracker.check(stack, key)
+        if state == BUSY:
+            tracker.defer(event, key)
+            return get_update_result(stack_name, 'DEFERRED',
+                                     stack['StackStatus'])
+        if state == BLOCKED:
+            breaker.failed(event, key, stack['StackStatus'])
+            return get_update_result(stack_name, 'SKIPPED',
+                                     stack['StackStatus'])
+        inputs_hash = None
+        if event.get('fingerprint_inputs') is not None:
+            inputs_hash = fingerprint.get_fingerprint(
+                stack, event['fingerprint_inputs'])
+            if fingerprint.is_applied(stack, inputs_hash, key):
+                breaker.succeeded(key)
+                return get_update_result(stack_name, 'UNCHANGED')
+        if not execute_staged_change_set(event, target, dispatch_key):
+            assumed_role_update_stack(stack_name, toggle_parameter,
+                                      toggle_values, ASSUME_ROLE_DURATION,
+                                      target=target,
+                                      client_request_token=dispatch_key)
+        tracker.started(key)
+        if dispatch_key is not None:
+            dispatch_cache.record(dispatch_key)
+        rollouts.started(key, stack_name, get_scope(target))
+        if inputs_hash is not None:
+            fingerprint.applied(key, inputs_hash)
+        breaker.succeeded(key)
+    except Exception as e:
+        if dispatch_key is not None and is_token_reused(e):
+            # another delivery of this run started the update
+            dispatch_cache.record(dispatch_key)
+            return get_update_result(stack_name, 'DUPLICATE')
+        if is_busy_error(e):
+            tracker.wasted(key)
+        elif classify_error(e) == 'fatal':
+            breaker.failed(event, key, e)
+        print(str(e), e.args)
+        log.exception(LogEvent('Scheduled update failed', stack=event))
+        return get_update_result(stack_name, 'FAILED', str(e))
+    return get_update_result(stack_name, 'UPDATED')
+
+
+def merge_retries(stacks, retries):
+    """Append due retries for stacks not already in the batch."""
+    keys = set(get_stack_key(stack) for stack in stacks)
+    return list(stacks) + [retry for retry in retries
+                           if get_stack_key(retry) not in keys]
+
+
+def group_by_target(stacks):
+    """Return {target: [(index, descriptor)]} in first-seen target order."""
+    groups = OrderedDict()
+    for index, stack in enumerate(stacks):
+        groups.setdefault(get_target(stack), []).append((index, stack))
+    return groups
+
+
+def interleave(groups):
+    """Order descriptors round-robin across targets.
+
+    Each target has its own API limits, so alternating targets keeps every
+    worker busy instead of queueing the whole pool behind one region.
+    """
+    return [item for batch in zip_longest(*groups.values())
+            for item in batch if item is not None]
+
+
+def prime_targets(groups):
+    """Prime the stack cache of each target with a large enough batch."""
+    for target, group in groups.items():
+        if len(group) >= prime_threshold:
+            stack_cache.prime([stack['stack_name'] for _, stack in group],
+                              get_describe_client(target), get_scope(target))
+
+
+def update_indexed_target(item):
+    """Update an (index, descriptor) pair, keeping the index."""
+    index, stack = item
+    return index, update_target(stack)
+
+
+def update_targets(stacks, workers=None, retries=None):
+    """Update a list of stack descriptors on a bounded worker pool.
+
+    Descriptors may name other regions and accounts; results come back in
+    the order the descriptors were given. Every due retry slot joins the
+    batch unless retries are given.
+    """
+    if retries is None:
+        retries = tracker.pop_due_retries()
+    stacks = merge_retries(stacks, retries)
+    if not stacks:
+        return []
+    groups = group_by_target(stacks)
+    prime_targets(groups)
+    workers = max(1, min(workers or max_workers, len(stacks)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = [result for _, result in sorted(
+            executor.map(update_indexed_target, interleave(groups)),
+            key=lambda item: item[0])]
+    log.info(LogEvent('update_targets', results=results))
+    log.info(LogEvent('caches', elevated_clients=elevated_clients.stats,
+                      stack_cache=stack_cache.stats,
+                      in_flight=tracker.stats,
+                      dispatch=dispatch_cache.stats,
+                      fingerprint_inputs=fingerprint.resolver.stats))
+    return results
+
+
+def submit_updates(stacks, workers=None):
+    """Queue stack descriptors when a queue is configured, else update."""
+    queue = update_queue.get_update_queue()
+    if queue is None:
+        return update_targets(stacks, workers)
+    queue.send(stacks)
+    log.info(LogEvent('Queued stack updates', count=len(stacks)))
+    return [get_update_result(stack['stack_name'], 'QUEUED')
+            for stack in stacks]
+
+
+def receive_updates(queue, capacity, busy):
+    """Take up to capacity queued intents for distinct, idle stacks.
+
+    Returns the selected messages and the receipts of duplicate intents.
+    Intents received beyond capacity are released for the next drain.
+    """
+    selected, duplicates, extra = [], [], []
+    keys = set(busy)
+    while len(selected) < capacity:
+        messages = queue.receive(capacity - len(selected))
+        if not messages:
+            break
+        for message in messages:
+            key = get_stack_key(message['intent'])
+            if key in keys:
+                duplicates.append(message['id'])
+            elif len(selected) < capacity:
+                keys.add(key)
+                selected.append(message)
+            else:
+                extra.append(message['id'])
+    if extra:
+        queue.release(extra)
+    return selected, duplicates
+
+
+def drain_queue():
+    """Update queued stacks without exceeding max_in_progress updates."""
+    queue = update_queue.get_update_queue()
+    if queue is None:
+        return []
+    # deferred retries wait their turn under the same cap
+    retries = tracker.pop_due_retries()
+    if retries:
+        queue.send(retries)
+    # markers from every environment, checked against current statuses
+    busy = tracker.active(get_current_stack_by_key)
+    capacity = max_in_progress - len(busy)
+    if capacity <= 0:
+        log.info(LogEvent('Queue not drained', in_progress=len(busy)))
+        return []
+    selected, duplicates = receive_updates(queue, capacity, busy)
+    # an intent for a stack already queued or updating adds nothing
+    queue.delete(duplicates)
+    results = update_targets([message['intent'] for message in selected])
+    queue.delete([message['id'] for message in selected])
+    log.info(LogEvent('Drained queued updates', drained=len(selected),
+                      duplicates=len(duplicates)))
+    return results
+
+
+def get_rollout_levels(stacks, workers=None):
+    """Return a batch's descriptors in levels, each after its producers.
+
+    Exports are regional, so each target is ordered on its own; their
+    levels run side by side.
+    """
+    levels = []
+    for target, group in group_by_target(stacks).items():
+        client = get_describe_client(target) or get_client('cloudformation')
+        by_name = OrderedDict((stack['stack_name'], stack)
+                              for _, stack in group)
+        producers = dependencies.get_producers(client, set(by_name),
+                                               workers or max_workers)
+        for index, stack_names in enumerate(
+                dependencies.get_levels(producers)):
+            if index == len(levels):
+                levels.append([])
+            levels[index].extend(by_name[name] for name in stack_names)
+    return levels
+
+
+def start_ordered_rollout(stacks):
+    """Plan a dependency-ordered rollout and update its first level."""
+    levels = get_rollout_levels(stacks)
+    log.info(LogEvent('ordered rollout', levels=[
+        [stack['stack_name'] for stack in level] for level in levels]))
+    store = get_state_store()
+    for index, level in enumerate(levels):
+        store.set(ORDERED_LEVEL_KEY.format(index), level)
+    store.set(ORDERED_ROLLOUT_KEY, {'levels': len(levels), 'level': -1})
+    return advance_ordered_rollout()
+
+
+def is_updating(stack_key):
+    """Return True while a stack's current status is in progress."""
+    try:
+        stack = get_current_stack_by_key(stack_key)
+    except Exception:
+        # the stack has been deleted; there is nothing to wait for
+        return False
+    return get_stack_state(stack['StackStatus']) == BUSY
+
+
+def advance_ordered_rollout():
+    """Update the rollout's next level once its current one has finished.
+
+    A level has finished when none of its stacks is updating, by its
+    current status, or waiting in a retry slot; the level's deferred
+    stacks are retried here, as their slots come due. The plan is in the state
+    store, so any execution environment can advance it, and a
+    conditional write lets only one tick start each level.
+    """
+    store = get_state_store()
+    plan = store.get(ORDERED_ROLLOUT_KEY)
+    if plan is None:
+        return None
+    if plan['level'] >= 0:
+        keys = set(get_stack_key(stack) for stack in store.get(
+            ORDERED_LEVEL_KEY.format(plan['level'])))
+        if keys & set(tracker.retrying()):
+            # slots of later levels stay put until their level starts
+            update_targets([], retries=tracker.pop_due_retries(keys=keys))
+        waiting = keys & set(tracker.retrying())
+        waiting.update(key for key in keys - waiting if is_updating(key))
+        if waiting:
+            return {'level': plan['level'], 'waiting': sorted(waiting)}
+    level = plan['level'] + 1
+    if not store.replace(ORDERED_ROLLOUT_KEY, plan,
+                         dict(plan, level=level)):
+        log.info('Ordered rollout already advanced by another tick.')
+        return None
+    if level == plan['levels']:
+        store.delete(ORDERED_ROLLOUT_KEY)
+        for index in range(level):
+            store.delete(ORDERED_LEVEL_KEY.format(index))
+        return {'level': level, 'finished': True}
+    stacks = store.get(ORDERED_LEVEL_KEY.format(level))
+    retries = tracker.pop_due_retries(
+        keys=set(get_stack_key(stack) for stack in stacks))
+    return {'level': level,
+            'results': update_targets(stacks, retries=retries)}
+
+
+def dispatch_due_stacks():
+    """Update every stack the schedule table reports as due."""
+    stacks = schedule_table.claim_due_stacks()
+    log.info(LogEvent('Dispatcher claimed due stacks', count=len(stacks)))
+    return submit_updates(stacks)
+
+
+def get_events_client(target):
+    """Return the client that reads a followed update's stack events."""
+    target = tuple(target) if target else HOME_TARGET
+    return get_describe_client(target) or get_client('cloudformation')
+
+
+def track_rollouts():
+    """Follow started updates and return the rollout duration summary."""
+    finished = rollouts.follow(get_events_client)
+    summary = rollouts.get_summary()
+    log.info(LogEvent('rollouts', finished=len(finished), summary=summary))
+    return summary
+
+
+def is_healthy(descriptor):
+    """Return True if a stack can take its descriptor's toggle update."""
+    stack_cache.invalidate(descriptor['stack_name'],
+                           get_scope(get_target(descriptor)))
+    stack = get_stack(descriptor)
+    if get_stack_state(stack['StackStatus']) != READY:
+        return False
+    values = dict((parameter['ParameterKey'], parameter.get('ParameterValue'))
+                  for parameter in stack.get('Parameters', []))
+    return values.get(descriptor['toggle_parameter']) in \
+        descriptor['toggle_values']
+
+
+def retry_deferred():
+    """Update deferred stacks whose retry slot is due.
+
+    Slots are also taken by any later update; this covers stacks whose
+    rule fires rarely. With a queue, the drain tick retries them instead.
+    """
+    if update_queue.get_update_queue() is not None:
+        return []
+    return update_targets([])
+
+
+def recover_stacks():
+    """Close the breakers of stacks that are healthy again."""
+    recovered = breaker.recover(is_healthy)
+    retried = retry_deferred()
+    log.info(LogEvent('recover', recovered=recovered, retried=retried,
+                      still_open=breaker.open_breakers()))
+    return recovered
 
 
 def lambda_handler(event, context):
     """Parse event."""
-    log.info('recieved event: {}'.format(event))
+    start_invocation()
+    log.info(LogEvent('received event', event=event))
     try:
-        event_name = event['event_name']
-        stack_name = event['stack_name']
-        toggle_parameter = event['toggle_parameter']
-        toggle_values = event['toggle_values']
-        stack = client.describe_stacks(StackName=stack_name)['Stacks'][0]
-        # prevent update if trigger is being run for the first time
-        metrics = get_metrics(**get_metrics_input(event_name))
-        invoke_update_metric = metrics['Datapoints']
-        if (
-            not invoke_update_metric
-            or stack['StackStatus'] != "CREATE_IN_PROGRESS"
-         ):
-            duration = 3600  # in seconds. 900 (15min) or greater.
-            assumed_role_update_stack(stack_name, toggle_parameter,
-                                      toggle_values, duration)
+        if event.get('drain'):
+            return drain_queue()
+        elif event.get('dispatch'):
+            return dispatch_due_stacks()
+        elif event.get('track'):
+            return track_rollouts()
+        elif event.get('recover'):
+            return recover_stacks()
+        elif event.get('stage'):
+            return stage_change_sets()
+        elif 'rollout' in event:
+            return start_ordered_rollout(event['rollout'])
+        elif event.get('advance'):
+            return advance_ordered_rollout()
+        elif 'stacks' in event:
+            return submit_updates(event['stacks'],
+                                  event.get('max_workers'))
+        return submit_updates([event])
     except Exception as e:
         print(str(e), e.args)
-        log.exception('CloudWatch triggerd update failed.')
+        log.exception(LogEvent('CloudWatch triggerd update failed',
+                               event=event))
+    finally:
+        flush_metrics()
@@ -0,0 +1,85 @@
+"""Order a batch of stacks by their cross-stack exports and imports.
+
+A stack that imports another stack's export should update after it, or it
+picks up the old value and needs another cycle.  ``get_producers`` reads
+which stacks of a batch import from which, and ``get_levels`` groups the
+batch so every stack comes after its producers; each level can update in
+parallel once the one before it has finished.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from botocore.exceptions import ClientError
+
+from aws_clients import paginate
+from structured_logging import LogEvent, get_logger
+
+log = get_logger(__name__)
+
+# list_imports answers an unused export with a ValidationError saying this
+NOT_IMPORTED = 'is not imported by any stack'
+
+
+def get_stack_name(stack_id):
+    """Return the stack name inside a stack id."""
+    return stack_id.split(':stack/', 1)[1].split('/', 1)[0]
+
+
+def list_exports(client):
+    """Return {export name: exporting stack name} for a region."""
+    return dict((export['Name'], get_stack_name(export['ExportingStackId']))
+                for page in paginate(client, 'list_exports')
+                for export in page['Exports'])
+
+
+def list_importers(client, export_name):
+    """Return the names of the stacks that import an export."""
+    try:
+        return [stack_name for page in paginate(
+            client, 'list_imports', ExportName=export_name)
+            for stack_name in page['Imports']]
+    except ClientError as e:
+        if NOT_IMPORTED not in str(e):
+            raise
+        return []
+
+
+def get_producers(client, stack_names, workers):
+    """Return {stack name: batch stacks it imports from} for a batch."""
+    exports = dict((export_name, stack_name) for export_name, stack_name
+                   in list_exports(client).items()
+                   if stack_name in stack_names)
+    producers = dict((stack_name, set()) for stack_name in stack_names)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        importers = executor.map(partial(list_importers, client), exports)
+        for export_name, stacks in zip(exports, importers):
+            for stack_name in stacks:
+                if stack_name in producers and \
+                        stack_name != exports[export_name]:
+                    producers[stack_name].add(exports[export_name])
+    return producers
+
+
+def get_levels(producers):
+    """Return stack names in levels, each stack after its producers.
+
+    Stacks in an import cycle cannot be ordered, so they share the last
+    level.
+    """
+    remaining = dict((stack_name, set(stacks))
+                     for stack_name, stacks in producers.items())
+    levels = []
+    while remaining:
+        ready = sorted(stack_name for stack_name, waiting
+                       in remaining.items() if not waiting)
+        if not ready:
+            log.warning(LogEvent('Import cycle', stacks=sorted(remaining)))
+            levels.append(sorted(remaining))
+            break
+        levels.append(ready)
+        for stack_name in ready:
+            del remaining[stack_name]
+        for waiting in remaining.values():
+            waiting.difference_update(ready)
+    return levels
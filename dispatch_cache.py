@@ -0,0 +1,86 @@
+"""Recognise repeated deliveries of one scheduled run.
+
+EventBridge delivers scheduled events at least once, and a repeated
+delivery would flip a stack's toggle a second time.  Each run gets a key
+from its rule name and scheduled time.  The key is the update's
+ClientRequestToken, so CloudFormation turns down a second update for the
+same run; the cache remembers runs whose update started, so repeats
+return before any STS or CloudFormation call.
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+from rule_targets import SCHEDULED_TIME_KEY
+from state_store import get_state_store
+
+# EventBridge retries a delivery for up to 24 hours
+dispatch_ttl = int(os.environ.get('DISPATCH_TTL', '86400'))
+
+# expired keys are swept at most this often
+EVICT_INTERVAL = 300
+TOKEN_PREFIX = 'auto-update-'
+TOKEN_REUSED_CODE = 'TokenAlreadyExistsException'
+
+
+def get_dispatch_key(event):
+    """Return a run's idempotency key, or None without a scheduled time.
+
+    Dispatched stacks carry the run they were claimed for, and rule
+    inputs carry the time EventBridge scheduled the delivery.
+    """
+    scheduled = event.get('scheduled_at', event.get(SCHEDULED_TIME_KEY))
+    if scheduled is None:
+        return None
+    digest = hashlib.sha256('{}|{}'.format(
+        event['event_name'], scheduled).encode('utf-8')).hexdigest()
+    return '{}{}'.format(TOKEN_PREFIX, digest[:40])
+
+
+def is_token_reused(error):
+    """Return True if CloudFormation has seen a request token before."""
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') == TOKEN_REUSED_CODE
+
+
+class DispatchCache(object):
+    """Remember the runs whose update has started, for a TTL."""
+
+    def __init__(self, ttl):
+        """Define the cache and its counters."""
+        self.ttl = ttl
+        self.stats = {'duplicates': 0}
+        self.evicted_at = 0
+        self.lock = threading.Lock()
+
+    def seen(self, dispatch_key, now=None):
+        """Return True if a run's update has already started."""
+        now = now or time.time()
+        self.evict(now)
+        expires = get_state_store().get('dispatch:{}'.format(dispatch_key))
+        if expires is None or expires <= now:
+            return False
+        with self.lock:
+            self.stats['duplicates'] += 1
+        return True
+
+    def record(self, dispatch_key, now=None):
+        """Remember that a run's update has started."""
+        get_state_store().set('dispatch:{}'.format(dispatch_key),
+                              (now or time.time()) + self.ttl)
+
+    def evict(self, now):
+        """Drop expired keys, at most once per EVICT_INTERVAL."""
+        with self.lock:
+            if now - self.evicted_at < EVICT_INTERVAL:
+                return
+            self.evicted_at = now
+        store = get_state_store()
+        for key, expires in store.items('dispatch:'):
+            if expires <= now:
+                store.delete(key)
+
+
+dispatch_cache = DispatchCache(dispatch_ttl)
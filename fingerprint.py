@@ -0,0 +1,138 @@
+"""Fingerprint a stack's upstream inputs to skip updates that change nothing.
+
+A stack opts in with ``FingerprintInputs`` on its custom resource, e.g.::
+
+    FingerprintInputs:
+      SsmParameters: [/my-app/release]
+      AmiFilters:
+        - Owners: [amazon]
+          Filters: [{Name: name, Values: [amzn2-ami-hvm-*-x86_64-gp2]}]
+      StackParameters: true
+
+The fingerprint hashes the current values of the listed SSM parameters, the
+newest image each AMI filter finds and, unless ``StackParameters`` is false,
+the SSM parameters behind the stack's own SSM-typed parameters.  The
+fingerprint applied by the last update is kept in the schedule table.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import schedule_table
+from aws_clients import call, get_client
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+lookup_ttl = int(os.environ.get('FINGERPRINT_TTL', '60'))
+
+# get_parameters accepts at most ten names per call
+SSM_BATCH_SIZE = 10
+
+# only a stack whose last update succeeded has its fingerprint applied
+APPLIED_STATUSES = frozenset(['CREATE_COMPLETE', 'UPDATE_COMPLETE'])
+
+
+class InputResolver(object):
+    """Look up SSM parameters and AMIs, sharing results across stacks."""
+
+    def __init__(self, ttl):
+        """Define an empty lookup cache."""
+        self.ttl = ttl
+        self.lookups = {}
+        self.stats = {'hits': 0, 'misses': 0}
+        self.lock = threading.Lock()
+
+    def cached(self, key):
+        """Return (True, value) for a fresh lookup, else (False, None)."""
+        with self.lock:
+            entry = self.lookups.get(key)
+            if entry and time.time() - entry['loaded'] <= self.ttl:
+                self.stats['hits'] += 1
+                return True, entry['value']
+            self.stats['misses'] += 1
+            return False, None
+
+    def store(self, key, value):
+        """Cache a looked up value."""
+        with self.lock:
+            self.lookups[key] = {'value': value, 'loaded': time.time()}
+
+    def get_ssm_values(self, names):
+        """Return {name: value} for SSM parameters; missing ones are None."""
+        values = {}
+        missing = []
+        for name in names:
+            found, value = self.cached(('ssm', name))
+            if found:
+                values[name] = value
+            else:
+                missing.append(name)
+        for index in range(0, len(missing), SSM_BATCH_SIZE):
+            batch = missing[index:index + SSM_BATCH_SIZE]
+            response = call(get_client('ssm'), 'get_parameters', Names=batch)
+            loaded = {parameter['Name']: parameter['Value']
+                      for parameter in response['Parameters']}
+            for name in batch:
+                values[name] = loaded.get(name)
+                self.store(('ssm', name), values[name])
+        return values
+
+    def get_latest_image(self, query):
+        """Return the id of the newest image a describe_images query finds."""
+        key = ('ami', json.dumps(query, sort_keys=True))
+        found, image_id = self.cached(key)
+        if found:
+            return image_id
+        images = call(get_client('ec2'), 'describe_images',
+                      **query)['Images']
+        image_id = max(images, key=lambda image: image['CreationDate'])[
+            'ImageId'] if images else None
+        self.store(key, image_id)
+        return image_id
+
+    def clear(self):
+        """Drop every cached lookup."""
+        with self.lock:
+            self.lookups.clear()
+
+
+resolver = InputResolver(lookup_ttl)
+
+
+def get_ssm_parameter_names(stack, inputs):
+    """Return the SSM parameters a stack's fingerprint depends on."""
+    names = set(inputs.get('SsmParameters', []))
+    # custom resource properties arrive as strings
+    if str(inputs.get('StackParameters', True)).lower() != 'false':
+        names.update(parameter['ParameterValue']
+                     for parameter in stack.get('Parameters', [])
+                     if 'ResolvedValue' in parameter)
+    return sorted(names)
+
+
+def get_fingerprint(stack, inputs):
+    """Return a hash of the current values of a stack's inputs."""
+    document = {
+        'ssm': resolver.get_ssm_values(get_ssm_parameter_names(stack, inputs)),
+        'images': [resolver.get_latest_image(query)
+                   for query in inputs.get('AmiFilters', [])],
+    }
+    return hashlib.sha256(
+        json.dumps(document, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def is_applied(stack, fingerprint, stack_key=None):
+    """Return True if the stack's last update already used the inputs."""
+    if stack['StackStatus'] not in APPLIED_STATUSES:
+        return False
+    return schedule_table.get_applied_fingerprint(
+        stack_key or stack['StackName']) == fingerprint
+
+
+def applied(stack_key, fingerprint):
+    """Record the fingerprint of the update just started on a stack."""
+    schedule_table.set_applied_fingerprint(stack_key, fingerprint)
@@ -0,0 +1,156 @@
+"""Track in-flight stack updates and defer stacks that cannot update yet."""
+
+import os
+import re
+import threading
+import time
+
+import schedule_table
+from state_store import get_state_store
+from structured_logging import LogEvent, get_logger
+
+log = get_logger(__name__)
+
+retry_delay = int(os.environ.get('DEFER_SECONDS', '300'))
+# forget an in-flight marker that was never cleared after this long
+in_flight_ttl = int(os.environ.get('IN_FLIGHT_TTL', '21600'))
+
+UPDATABLE_STATUSES = frozenset([
+    'CREATE_COMPLETE',
+    'UPDATE_COMPLETE',
+    'UPDATE_ROLLBACK_COMPLETE',
+    'IMPORT_COMPLETE',
+    'IMPORT_ROLLBACK_COMPLETE',
+])
+
+# update_stack's answer when the stack is not in an updatable state
+BUSY_ERROR = re.compile(r'is in \w+ state')
+
+READY = 'ready'
+BUSY = 'busy'
+BLOCKED = 'blocked'
+
+
+def get_stack_state(status):
+    """Return READY, BUSY or BLOCKED for a stack status."""
+    if status in UPDATABLE_STATUSES:
+        return READY
+    if status.endswith('_IN_PROGRESS'):
+        return BUSY
+    return BLOCKED
+
+
+def is_busy_error(error):
+    """Return True if update_stack failed because of the stack's state."""
+    return bool(BUSY_ERROR.search(str(error)))
+
+
+class InFlightTracker(object):
+    """Register started updates and hold busy stacks in retry slots."""
+
+    def __init__(self, delay, ttl):
+        """Define the tracker and its counters."""
+        self.delay = delay
+        self.ttl = ttl
+        self.stats = {'skipped': 0, 'deferred': 0, 'wasted': 0,
+                      'retried': 0}
+        self.lock = threading.Lock()
+
+    def count(self, counter):
+        """Increment a counter."""
+        with self.lock:
+            self.stats[counter] += 1
+
+    def check(self, stack, stack_key=None):
+        """Return the stack's state, retiring finished in-flight markers.
+
+        stack_key names stacks outside the home account and region; it
+        defaults to the stack name.
+        """
+        state = get_stack_state(stack['StackStatus'])
+        key = 'inflight:{}'.format(stack_key or stack['StackName'])
+        started = get_state_store().get(key)
+        if started is not None and (
+                state != BUSY or time.time() - started > self.ttl):
+            get_state_store().delete(key)
+        if state == BLOCKED:
+            self.count('skipped')
+        return state
+
+    def started(self, stack_key):
+        """Record an update started on a stack; it fills any retry slot."""
+        store = get_state_store()
+        store.set('inflight:{}'.format(stack_key), time.time())
+        store.delete('deferred:{}'.format(stack_key))
+
+    def in_flight(self):
+        """Return the keys of stacks with a registered update."""
+        return [key.split(':', 1)[1]
+                for key, _ in get_state_store().items('inflight:')]
+
+    def retrying(self):
+        """Return the keys of stacks held in a retry slot."""
+        return [key.split(':', 1)[1]
+                for key, _ in get_state_store().items('deferred:')]
+
+    def active(self, get_stack):
+        """Return the in-flight stack keys still updating, retiring the rest.
+
+        get_stack is called with each stack key.
+        """
+        store = get_state_store()
+        active = []
+        for key, started in store.items('inflight:'):
+            stack_key = key.split(':', 1)[1]
+            try:
+                status = get_stack(stack_key)['StackStatus']
+            except Exception:
+                # the stack has been deleted since its update started
+                status = None
+            if (status is not None and get_stack_state(status) == BUSY and
+                    time.time() - started <= self.ttl):
+                active.append(stack_key)
+            else:
+                store.delete(key)
+        return active
+
+    def defer(self, descriptor, stack_key=None):
+        """Hold a busy stack's update for a later retry."""
+        stack_key = stack_key or descriptor['stack_name']
+        retry_at = time.time() + self.delay
+        self.count('deferred')
+        if descriptor.get('dispatched'):
+            schedule_table.defer_schedule(descriptor['stack_name'], retry_at)
+        else:
+            get_state_store().set(
+                'deferred:{}'.format(stack_key),
+                {'retry_at': retry_at, 'descriptor': descriptor})
+        log.info(LogEvent('Deferred update', stack=stack_key,
+                          seconds=self.delay))
+
+    def pop_due_retries(self, now=None, keys=None):
+        """Remove and return the deferred descriptors now due.
+
+        With keys, only the slots of those stack keys are taken.
+        """
+        now = now or time.time()
+        store = get_state_store()
+        due = []
+        for key, slot in store.items('deferred:'):
+            if keys is not None and key.split(':', 1)[1] not in keys:
+                continue
+            # take() hands a slot shared between environments to only one
+            if slot['retry_at'] <= now and store.take(key) is not None:
+                due.append(slot['descriptor'])
+        with self.lock:
+            self.stats['retried'] += len(due)
+        return due
+
+    def wasted(self, stack_key):
+        """Count an update_stack call rejected because of stack state."""
+        self.count('wasted')
+        log.info(LogEvent('update_stack was rejected by stack state',
+                          stack=stack_key))
+
+
+tracker = InFlightTracker(retry_delay, in_flight_ttl)
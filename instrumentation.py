@@ -0,0 +1,164 @@
+"""Time AWS calls with botocore event hooks and emit them as EMF logs.
+
+``instrument`` attaches hooks to a client so every API call attempt records
+its latency and error code.  ``emit`` prints the invocation's summary as one
+CloudWatch embedded metric format (EMF) document per operation and starts a
+fresh summary; ``aws_clients.flush_metrics`` adds the throttle and retry
+counts of its call layer first.
+"""
+
+import json
+import os
+import threading
+import time
+
+metrics_namespace = os.environ.get('METRICS_NAMESPACE', 'CfnUpdateScheduler')
+function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+
+# EMF accepts at most 100 values per metric in one document
+MAX_VALUES = 100
+
+METRIC_UNITS = [
+    ('Latency', 'Milliseconds'),
+    ('Calls', 'Count'),
+    ('Errors', 'Count'),
+    ('Throttles', 'Count'),
+    ('Retries', 'Count'),
+]
+
+
+class CallRecorder(object):
+    """Collect per-operation call figures for one invocation."""
+
+    def __init__(self):
+        """Define an empty summary."""
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def get_operation(self, service, operation):
+        """Return the figures of one operation, creating them if needed."""
+        return self.operations.setdefault((service, operation), {
+            'latencies': [],
+            'calls': 0,
+            'errors': {},
+            'throttles': 0,
+            'retries': 0,
+        })
+
+    def record(self, service, operation, latency, error_code=None):
+        """Record one completed call attempt."""
+        with self.lock:
+            figures = self.get_operation(service, operation)
+            figures['latencies'].append(round(latency * 1000, 2))
+            figures['calls'] += 1
+            if error_code:
+                figures['errors'][error_code] = (
+                    figures['errors'].get(error_code, 0) + 1)
+
+    def add_counts(self, service, operation, throttles, retries):
+        """Add the throttles and retries counted by the call layer."""
+        with self.lock:
+            figures = self.get_operation(service, operation)
+            figures['throttles'] += throttles
+            figures['retries'] += retries
+
+    def drain(self):
+        """Return the summary and start a new one."""
+        with self.lock:
+            operations, self.operations = self.operations, {}
+        return operations
+
+
+recorder = CallRecorder()
+
+
+def before_call(model, context, **kwargs):
+    """Stamp the start and the operation of an API call."""
+    context['instrumentation_start'] = time.perf_counter()
+    context['instrumentation_operation'] = (model.service_model.service_name,
+                                            model.name)
+
+
+def record_call(context, error_code):
+    """Record the latency of the call stamped in a request context."""
+    start = context.pop('instrumentation_start', None)
+    operation = context.pop('instrumentation_operation', None)
+    if start is None or operation is None:
+        return
+    recorder.record(operation[0], operation[1], time.perf_counter() - start,
+                    error_code)
+
+
+def after_call(context, parsed=None, **kwargs):
+    """Record an API call's latency and error code."""
+    error_code = None
+    if parsed and 'Error' in parsed:
+        error_code = parsed['Error'].get('Code')
+    record_call(context, error_code)
+
+
+def after_call_error(context, exception=None, **kwargs):
+    """Record the latency of a call that raised before any response.
+
+    botocore passes only the exception and request context to this event.
+    """
+    error_code = type(exception).__name__ if exception is not None else None
+    record_call(context, error_code)
+
+
+def instrument(client):
+    """Attach the timing hooks to a client and return it."""
+    events = client.meta.events
+    events.register('before-call.*.*', before_call,
+                    unique_id='instrumentation-before-call')
+    events.register('after-call.*.*', after_call,
+                    unique_id='instrumentation-after-call')
+    events.register('after-call-error.*.*', after_call_error,
+                    unique_id='instrumentation-after-call-error')
+    return client
+
+
+def get_documents(operations, timestamp=None):
+    """Return the EMF documents for a drained summary."""
+    timestamp = timestamp or int(time.time() * 1000)
+    documents = []
+    for (service, operation), figures in sorted(operations.items()):
+        latencies = figures['latencies'] or [0]
+        for offset in range(0, len(latencies), MAX_VALUES):
+            first = offset == 0
+            document = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': metrics_namespace,
+                        'Dimensions': [['Function', 'Service', 'Operation']],
+                        'Metrics': [
+                            {'Name': name, 'Unit': unit}
+                            for name, unit in METRIC_UNITS
+                            if first or name == 'Latency'
+                        ],
+                    }],
+                },
+                'Function': function_name,
+                'Service': service,
+                'Operation': operation,
+                'Latency': latencies[offset:offset + MAX_VALUES],
+            }
+            if first:
+                document.update({
+                    'Calls': figures['calls'],
+                    'Errors': sum(figures['errors'].values()),
+                    'Throttles': figures['throttles'],
+                    'Retries': figures['retries'],
+                    'ErrorCodes': figures['errors'],
+                })
+            documents.append(document)
+    return documents
+
+
+def emit():
+    """Print this invocation's call summary as EMF and reset it."""
+    documents = get_documents(recorder.drain())
+    for document in documents:
+        print(json.dumps(document, separators=(',', ':')))
+    return documents
@@ -0,0 +1,195 @@
+"""Reconcile auto-update-* rules, targets and permissions with live stacks.
+
+Custom resource events change one stack's rule at a time, so a failed
+Delete or manual drift leaves rules, targets or permission statements
+behind.  A sweep lists every rule and its targets once, indexes them
+against the live stacks and the target function's resource policy, and
+then repairs the differences concurrently:
+
+* rules whose stack is gone lose their targets, the rule and its
+  permission statement,
+* targets pointing anywhere but the update function are removed, and
+  re-pointed at the function when the rule has no good target left,
+* permission statements whose rule is gone are removed, and missing ones
+  are added for rules that still fire.
+
+Rules for stacks in another region or account cannot be checked from here
+and are reported as unverified.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_clients import call, flush_metrics, get_client, paginate
+from cfn_auto_update_broker import (
+    DISPATCHER_NAME, AWSLambda, get_rule_target, get_target_lambda_arn,
+    load_policy, set_invocation_context)
+from rule_targets import RULE_PREFIX, get_rule_input
+from structured_logging import LogEvent, get_logger, start_invocation
+
+log = get_logger(__name__)
+
+# statements the broker adds in either policy mode start with this
+STATEMENT_PREFIX = 'AWSEvents_auto-update'
+# concurrent list_targets_by_rule calls and repairs
+reconcile_workers = int(os.environ.get('RECONCILE_WORKERS', '8'))
+
+
+def list_rules():
+    """Return {name: rule} for every auto-update rule but the dispatcher."""
+    rules = {}
+    for page in paginate(get_client('events'), 'list_rules',
+                         NamePrefix=RULE_PREFIX):
+        for rule in page['Rules']:
+            if rule['Name'] != DISPATCHER_NAME:
+                rules[rule['Name']] = rule
+    return rules
+
+
+def list_targets(rule_name):
+    """Return every target of a rule."""
+    targets = []
+    for page in paginate(get_client('events'), 'list_targets_by_rule',
+                         Rule=rule_name):
+        targets.extend(page['Targets'])
+    return targets
+
+
+def list_stack_names():
+    """Return the names of every live stack."""
+    return set(stack['StackName'] for page in paginate(
+        get_client('cloudformation'), 'describe_stacks')
+        for stack in page['Stacks'])
+
+
+def plan(rules, targets, stack_names, statement_ids):
+    """Return the repairs that bring rules and permissions in line."""
+    function_arn = get_target_lambda_arn()
+    changes = {'orphaned_rules': [], 'stale_targets': {},
+               'retargeted_rules': {}, 'orphaned_permissions': [],
+               'missing_permissions': [], 'unverified_rules': []}
+    expected_ids = set([AWSLambda(DISPATCHER_NAME).statement_id])
+    # in the shared policy mode every rule maps to the one statement
+    missing_ids = set()
+    for rule_name in sorted(rules):
+        rule_targets = targets[rule_name]
+        rule_input = get_rule_input(rule_targets)
+        if rule_input.get('region') or rule_input.get('account_id'):
+            changes['unverified_rules'].append(rule_name)
+        elif rule_input.get('stack_name', rule_name[len(RULE_PREFIX):]) \
+                not in stack_names:
+            changes['orphaned_rules'].append(rule_name)
+            continue
+        statement_id = AWSLambda(rule_name).statement_id
+        expected_ids.add(statement_id)
+        if statement_id not in statement_ids | missing_ids:
+            missing_ids.add(statement_id)
+            changes['missing_permissions'].append(rule_name)
+        stale = [target for target in rule_targets
+                 if target['Arn'] != function_arn]
+        if stale:
+            changes['stale_targets'][rule_name] = [
+                target['Id'] for target in stale]
+        if len(stale) == len(rule_targets) and rule_input:
+            changes['retargeted_rules'][rule_name] = rule_input
+    # this includes the statements of orphaned rules, and per-rule
+    # statements left over from before a switch to the shared policy mode
+    changes['orphaned_permissions'] = sorted(
+        statement_id for statement_id in statement_ids
+        if statement_id.startswith(STATEMENT_PREFIX) and
+        statement_id not in expected_ids)
+    return changes
+
+
+def delete_rule(rule_name, target_ids):
+    """Delete an orphaned rule and its targets."""
+    if target_ids:
+        call(get_client('events'), 'remove_targets', Rule=rule_name,
+             Ids=target_ids)
+    call(get_client('events'), 'delete_rule', Name=rule_name)
+
+
+def remove_permission(statement_id):
+    """Remove a statement from the update function's resource policy."""
+    lambda_client = get_client('lambda')
+    try:
+        call(lambda_client, 'remove_permission',
+             FunctionName=get_target_lambda_arn(), StatementId=statement_id)
+    except lambda_client.exceptions.ResourceNotFoundException:
+        log.info(LogEvent('Permission previously removed',
+                          statement_id=statement_id))
+
+
+def add_permission(rule_name):
+    """Let a rule invoke the update function."""
+    aws_lambda_obj = AWSLambda(rule_name)
+    call(get_client('lambda'), 'add_permission',
+         **aws_lambda_obj.add_permission_input)
+
+
+def repair_targets(rule_name, stale_ids, rule_input):
+    """Drop a rule's stale targets, re-pointing its input if it has none."""
+    events = get_client('events')
+    if stale_ids:
+        call(events, 'remove_targets', Rule=rule_name, Ids=stale_ids)
+    if rule_input is not None:
+        call(events, 'put_targets', Rule=rule_name,
+             Targets=[get_rule_target(rule_input)])
+
+
+def get_repairs(changes, targets):
+    """Return the calls that apply a plan, one per rule or statement."""
+    repairs = []
+    for rule_name in changes['orphaned_rules']:
+        repairs.append((delete_rule, rule_name, [
+            target['Id'] for target in targets[rule_name]]))
+    for rule_name in set(changes['stale_targets']) | set(
+            changes['retargeted_rules']):
+        repairs.append((repair_targets, rule_name,
+                        changes['stale_targets'].get(rule_name, []),
+                        changes['retargeted_rules'].get(rule_name)))
+    for statement_id in changes['orphaned_permissions']:
+        repairs.append((remove_permission, statement_id))
+    for rule_name in changes['missing_permissions']:
+        repairs.append((add_permission, rule_name))
+    return repairs
+
+
+def apply_repair(repair):
+    """Run one repair, returning the error message if it failed."""
+    function, args = repair[0], repair[1:]
+    try:
+        function(*args)
+    except Exception as e:
+        log.exception(LogEvent('Repair failed', repair=repair))
+        return '{}{}: {}'.format(function.__name__, args, e)
+    return None
+
+
+def reconcile(dry_run=False, workers=None):
+    """Sweep every auto-update rule and return the differences found."""
+    workers = workers or reconcile_workers
+    rules = list_rules()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list stacks after rules so a rule's new stack is always seen
+        targets = dict(zip(rules, executor.map(list_targets, rules)))
+        stack_names = list_stack_names()
+        statement_ids = set(load_policy())
+        changes = plan(rules, targets, stack_names, statement_ids)
+        errors = []
+        if not dry_run:
+            errors = [error for error in executor.map(
+                apply_repair, get_repairs(changes, targets)) if error]
+    report = dict(changes, rules=len(rules), dry_run=dry_run, errors=errors)
+    log.info(LogEvent('reconcile', report=report))
+    return report
+
+
+def lambda_handler(event, context):
+    """Run a reconciliation sweep."""
+    start_invocation()
+    set_invocation_context(context)
+    try:
+        return reconcile(bool((event or {}).get('dry_run')))
+    finally:
+        flush_metrics()
@@ -0,0 +1,217 @@
+"""Follow started stack updates to completion and keep their durations.
+
+``started`` registers an update once update_stack has accepted it.
+``follow`` then reads each update's new stack events, newest first, and
+stops at the last event it saw before, so history is never read twice.
+When the stack reaches a terminal status, it records the rollout's
+duration, outcome and time spent per resource. It also prints the
+duration as an EMF metric, so CloudWatch can chart rollout percentiles.
+``get_summary`` returns the p50/p95/p99 durations of the kept history and
+the stacks whose updates are getting slower. Rollouts live in the state
+store, so with the shared store every update is followed and summarized
+whichever execution environment started it.
+"""
+
+import json
+import os
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import instrumentation
+from aws_clients import paginate
+from state_store import get_state_store
+from structured_logging import LogEvent, get_logger
+
+log = get_logger(__name__)
+
+track_rollouts = os.environ.get('TRACK_ROLLOUTS', 'false').lower() == 'true'
+# completed rollouts kept per stack
+history_length = int(os.environ.get('ROLLOUT_HISTORY', '20'))
+# stop following an update that has not finished after this long
+rollout_ttl = int(os.environ.get('ROLLOUT_TTL', '21600'))
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+STACK_RESOURCE_TYPE = 'AWS::CloudFormation::Stack'
+OUTCOMES = {
+    'UPDATE_COMPLETE': 'succeeded',
+    'UPDATE_ROLLBACK_COMPLETE': 'rolled_back',
+    'UPDATE_ROLLBACK_FAILED': 'rollback_failed',
+}
+# events this much older than the update_stack call predate the update
+CLOCK_SKEW = 60
+# the slowest resources kept with each completed rollout
+RESOURCE_LIMIT = 10
+# a stack is slowing when its last update took this much longer than the
+# median of its earlier ones
+SLOWING_FACTOR = 1.5
+SLOWING_MIN_HISTORY = 3
+
+
+def to_seconds(moment):
+    """Return the epoch seconds of an aware datetime."""
+    return (moment - EPOCH).total_seconds()
+
+
+def percentile(samples, fraction):
+    """Return the nearest-rank percentile of a list of samples."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = max(0, int(round(fraction * len(ordered) + 0.5)) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def started(stack_key, stack_name, target=None):
+    """Start following an update update_stack has just accepted."""
+    if not track_rollouts:
+        return
+    get_state_store().set('rollout:{}'.format(stack_key), {
+        'stack_name': stack_name,
+        'target': list(target) if target else None,
+        'requested': time.time(),
+        'started': None,
+        'last_event_id': None,
+        'resources': {},
+        'resource_seconds': {},
+    })
+
+
+def get_new_events(client, rollout):
+    """Return the stack events not seen before, oldest first."""
+    oldest = rollout['requested'] - CLOCK_SKEW
+    events = []
+    for page in paginate(client, 'describe_stack_events',
+                         StackName=rollout['stack_name']):
+        for event in page['StackEvents']:
+            if (event['EventId'] == rollout['last_event_id'] or
+                    to_seconds(event['Timestamp']) < oldest):
+                return events[::-1]
+            events.append(event)
+    return events[::-1]
+
+
+def apply_events(rollout, events):
+    """Update a rollout from new events; return its outcome once final."""
+    for event in events:
+        rollout['last_event_id'] = event['EventId']
+        status = event['ResourceStatus']
+        logical_id = event['LogicalResourceId']
+        moment = to_seconds(event['Timestamp'])
+        # events inside the clock skew window can belong to the previous
+        # update, so nothing counts before this update's UPDATE_IN_PROGRESS
+        if (event['ResourceType'] == STACK_RESOURCE_TYPE and
+                logical_id == rollout['stack_name']):
+            if status == 'UPDATE_IN_PROGRESS' and rollout['started'] is None:
+                rollout['started'] = moment
+            elif status in OUTCOMES and rollout['started'] is not None:
+                rollout['finished'] = moment
+                return OUTCOMES[status]
+        elif rollout['started'] is None:
+            continue
+        elif status.endswith('_IN_PROGRESS'):
+            rollout['resources'].setdefault(logical_id, moment)
+        elif logical_id in rollout['resources']:
+            begun = rollout['resources'].pop(logical_id)
+            rollout['resource_seconds'][logical_id] = (
+                rollout['resource_seconds'].get(logical_id, 0) +
+                moment - begun)
+    return None
+
+
+def get_document(stack_key, record):
+    """Return the EMF document of a completed rollout."""
+    return {
+        '_aws': {
+            'Timestamp': int(record['finished'] * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': instrumentation.metrics_namespace,
+                'Dimensions': [['Function', 'Outcome']],
+                'Metrics': [{'Name': 'RolloutDuration', 'Unit': 'Seconds'}],
+            }],
+        },
+        'Function': instrumentation.function_name,
+        'Outcome': record['outcome'],
+        'StackName': stack_key,
+        'RolloutDuration': record['duration'],
+    }
+
+
+def complete(stack_key, rollout, outcome):
+    """Move a finished rollout into its stack's history."""
+    finished = rollout.get('finished', time.time())
+    slowest = sorted(rollout['resource_seconds'].items(),
+                     key=lambda item: item[1], reverse=True)
+    record = {
+        'finished': finished,
+        'duration': round(finished - (rollout['started'] or
+                                      rollout['requested']), 3),
+        'outcome': outcome,
+        'resources': {logical_id: round(seconds, 3)
+                      for logical_id, seconds in slowest[:RESOURCE_LIMIT]},
+    }
+    store = get_state_store()
+    history_key = 'rollout-history:{}'.format(stack_key)
+    history = store.get(history_key, []) + [record]
+    store.set(history_key, history[-history_length:])
+    print(json.dumps(get_document(stack_key, record)))
+    log.info(LogEvent('Rollout finished', stack=stack_key, rollout=record))
+    return record
+
+
+def follow(get_client):
+    """Read new events of every followed update; return finished ones.
+
+    get_client is called with the (role arn, region) target an update was
+    started through, or None for the home target.
+    """
+    store = get_state_store()
+    finished = []
+    for key, rollout in store.items('rollout:'):
+        stack_key = key.split(':', 1)[1]
+        try:
+            events = get_new_events(get_client(rollout['target']), rollout)
+        except Exception:
+            log.exception(LogEvent('Reading stack events failed',
+                                   stack=stack_key))
+            continue
+        outcome = apply_events(rollout, events)
+        if outcome is None and time.time() - rollout['requested'] > \
+                rollout_ttl:
+            outcome = 'unknown'
+        if outcome is None:
+            store.set(key, rollout)
+        # an overlapping track tick may have completed it already
+        elif store.take(key) is not None:
+            finished.append(complete(stack_key, rollout, outcome))
+    return finished
+
+
+def is_slowing(history):
+    """Return True if the last rollout was much slower than earlier ones."""
+    durations = [record['duration'] for record in history
+                 if record['outcome'] == 'succeeded']
+    if len(durations) < SLOWING_MIN_HISTORY:
+        return False
+    return durations[-1] > SLOWING_FACTOR * percentile(durations[:-1], 0.5)
+
+
+def get_summary():
+    """Return rollout duration percentiles, outcomes and slowing stacks."""
+    durations = []
+    outcomes = Counter()
+    slowing = []
+    for key, history in get_state_store().items('rollout-history:'):
+        durations.extend(record['duration'] for record in history)
+        outcomes.update(record['outcome'] for record in history)
+        if is_slowing(history):
+            slowing.append(key.split(':', 1)[1])
+    return {
+        'count': len(durations),
+        'p50': percentile(durations, 0.5),
+        'p95': percentile(durations, 0.95),
+        'p99': percentile(durations, 0.99),
+        'outcomes': dict(outcomes),
+        'slowing': sorted(slowing),
+        'in_progress': len(get_state_store().items('rollout:')),
+    }
@@ -0,0 +1,41 @@
+"""Build and read the targets of auto-update-* rules.
+
+The broker writes these targets, and the reconciliation sweep and the
+failure breaker read them back, so their format is kept in one place.
+"""
+
+import json
+
+RULE_PREFIX = 'auto-update-'
+
+# each rule's input carries the scheduled time of the run it delivers;
+# EventBridge keeps that time on every repeated delivery of the run
+SCHEDULED_TIME_KEY = 'scheduled_time'
+SCHEDULED_TIME_PATHS = {'time': '$.time'}
+
+
+def get_input_transformer(event_constant):
+    """Return the input transformer adding the scheduled time to an input."""
+    template = dict(event_constant)
+    template[SCHEDULED_TIME_KEY] = '<time>'
+    return {
+        'InputPathsMap': SCHEDULED_TIME_PATHS,
+        'InputTemplate': json.dumps(template),
+    }
+
+
+def get_rule_input(targets):
+    """Return the parsed input of the first target that carries one.
+
+    Rules created before inputs carried the scheduled time have a constant
+    Input instead of an input template.
+    """
+    for target in targets:
+        if target.get('InputTransformer'):
+            rule_input = json.loads(
+                target['InputTransformer']['InputTemplate'])
+            rule_input.pop(SCHEDULED_TIME_KEY, None)
+            return rule_input
+        if target.get('Input'):
+            return json.loads(target['Input'])
+    return {}
@@ -0,0 +1,369 @@
+"""Evaluate, jitter and preview CloudWatch Events schedule expressions."""
+
+import argparse
+import calendar
+import hashlib
+import re
+from datetime import datetime, timedelta, timezone
+
+RATE_PATTERN = re.compile(r'^rate\(\s*(\d+)\s+([a-z]+)\s*\)$')
+CRON_PATTERN = re.compile(r'^cron\((.*)\)$')
+
+RATE_UNITS = {
+    'minute': 60,
+    'minutes': 60,
+    'hour': 3600,
+    'hours': 3600,
+    'day': 86400,
+    'days': 86400,
+}
+
+MONTH_NAMES = {
+    name: index + 1 for index, name in enumerate(
+        ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+         'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC'])
+}
+DAY_NAMES = {
+    name: index + 1 for index, name in enumerate(
+        ['SUN', 'MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT'])
+}
+
+# (low, high, names) for minute, hour, day-of-month, month, day-of-week, year
+CRON_FIELDS = [
+    (0, 59, {}),
+    (0, 23, {}),
+    (1, 31, {}),
+    (1, 12, MONTH_NAMES),
+    (1, 7, DAY_NAMES),
+    (1970, 2199, {}),
+]
+
+# day-of-month N W runs on the weekday nearest day N, L on the last day
+NEAREST_WEEKDAY_PATTERN = re.compile(r'^(\d+)W$')
+# day-of-week D L runs on the month's last weekday D, D#N on its Nth
+LAST_WEEKDAY_PATTERN = re.compile(r'^(\w+)L$')
+NTH_WEEKDAY_PATTERN = re.compile(r'^(\w+)#([1-5])$')
+
+# how far ahead to search for a matching cron day before giving up
+CRON_SEARCH_DAYS = 366 * 5
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def utcnow():
+    """Return the current time as an aware UTC datetime."""
+    return datetime.now(timezone.utc)
+
+
+def from_timestamp(timestamp):
+    """Return an aware UTC datetime for an epoch timestamp."""
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+def to_timestamp(moment):
+    """Return the epoch timestamp of an aware datetime."""
+    return int((moment - EPOCH).total_seconds())
+
+
+def _parse_value(token, names):
+    """Parse a single cron value, accepting symbolic names."""
+    token = token.upper()
+    if token in names:
+        return names[token]
+    if not token.isdigit():
+        raise ValueError('Unsupported cron value: {}'.format(token))
+    return int(token)
+
+
+def _parse_field(text, low, high, names):
+    """Expand one cron field into the set of values it matches."""
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError('Invalid cron step: {}'.format(text))
+        if part in ('*', '?'):
+            start, end = low, high
+        elif '-' in part:
+            start_text, end_text = part.split('-', 1)
+            start = _parse_value(start_text, names)
+            end = _parse_value(end_text, names)
+        else:
+            start = _parse_value(part, names)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise ValueError('Cron field out of range: {}'.format(text))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def _get_last_day(moment):
+    """Return the number of days in a moment's month."""
+    return calendar.monthrange(moment.year, moment.month)[1]
+
+
+def _get_weekday(moment):
+    """Return a moment's weekday in the cron() Sunday-first numbering."""
+    return (moment.weekday() + 1) % 7 + 1
+
+
+def _get_nearest_weekday(moment, day):
+    """Return the Monday-Friday day nearest a day of the moment's month.
+
+    The result never leaves the month, the same way cron() W does.
+    """
+    last_day = _get_last_day(moment)
+    weekday = moment.replace(day=day).weekday()
+    if weekday == 5:
+        return day - 1 if day > 1 else day + 2
+    if weekday == 6:
+        return day + 1 if day < last_day else day - 2
+    return day
+
+
+def _parse_day_rule(token):
+    """Return a date test for an L or W day-of-month token, or None."""
+    if token == 'L':
+        return lambda moment: moment.day == _get_last_day(moment)
+    if token == 'LW':
+        return lambda moment: moment.day == _get_nearest_weekday(
+            moment, _get_last_day(moment))
+    match = NEAREST_WEEKDAY_PATTERN.match(token)
+    if match:
+        day = int(match.group(1))
+        if not 1 <= day <= 31:
+            raise ValueError('Cron field out of range: {}'.format(token))
+        return lambda moment: day <= _get_last_day(moment) and (
+            moment.day == _get_nearest_weekday(moment, day))
+    return None
+
+
+def _parse_weekday_rule(token):
+    """Return a date test for an L or # day-of-week token, or None."""
+    if token == 'L':
+        return lambda moment: _get_weekday(moment) == DAY_NAMES['SAT']
+    match = LAST_WEEKDAY_PATTERN.match(token)
+    if match:
+        weekday = _parse_value(match.group(1), DAY_NAMES)
+        return lambda moment: _get_weekday(moment) == weekday and (
+            moment.day + 7 > _get_last_day(moment))
+    match = NTH_WEEKDAY_PATTERN.match(token)
+    if match:
+        weekday = _parse_value(match.group(1), DAY_NAMES)
+        week = int(match.group(2))
+        return lambda moment: _get_weekday(moment) == weekday and (
+            (moment.day - 1) // 7 + 1 == week)
+    return None
+
+
+def _parse_day_field(text, low, high, names, parse_rule):
+    """Expand a day field into its plain values and its L/W/# tests."""
+    values = set()
+    rules = []
+    plain = []
+    for part in text.upper().split(','):
+        rule = parse_rule(part)
+        if rule is None:
+            plain.append(part)
+        else:
+            rules.append(rule)
+    if plain:
+        values = _parse_field(','.join(plain), low, high, names)
+    return values, rules
+
+
+class CronSchedule(object):
+    """Define a parsed cron() schedule expression."""
+
+    def __init__(self, text):
+        """Parse the six cron fields."""
+        fields = text.split()
+        if len(fields) != 6:
+            raise ValueError(
+                'cron() expressions take six fields: {}'.format(text))
+        if '?' not in (fields[2], fields[4]):
+            raise ValueError(
+                'cron() day-of-month or day-of-week must be "?": {}'.format(
+                    text))
+        self.fields = fields
+        (self.minutes, self.hours, _, self.months, _, self.years) = [
+            _parse_field(field, low, high, names) if index not in (2, 4)
+            else None
+            for index, (field, (low, high, names)) in enumerate(
+                zip(fields, CRON_FIELDS))
+        ]
+        self.days, self.day_rules = _parse_day_field(
+            fields[2], *CRON_FIELDS[2] + (_parse_day_rule,))
+        self.weekdays, self.weekday_rules = _parse_day_field(
+            fields[4], *CRON_FIELDS[4] + (_parse_weekday_rule,))
+        self.any_day = fields[2] == '?'
+        self.any_weekday = fields[4] == '?'
+
+    def matches_day(self, moment):
+        """Return True when the schedule fires on the moment's date."""
+        if moment.year not in self.years or moment.month not in self.months:
+            return False
+        if not self.any_day and moment.day not in self.days and not any(
+                rule(moment) for rule in self.day_rules):
+            return False
+        if not self.any_weekday and (
+                _get_weekday(moment) not in self.weekdays and not any(
+                    rule(moment) for rule in self.weekday_rules)):
+            return False
+        return True
+
+    def next_after(self, after):
+        """Return the first fire time strictly after the given moment."""
+        start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        for _ in range(CRON_SEARCH_DAYS):
+            if self.matches_day(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days=1)
+        raise ValueError('cron() expression never fires: {}'.format(
+            ' '.join(self.fields)))
+
+
+def parse(expression):
+    """Return ('rate', seconds) or ('cron', CronSchedule) for an expression."""
+    expression = expression.strip()
+    match = RATE_PATTERN.match(expression)
+    if match:
+        value, unit = int(match.group(1)), match.group(2)
+        if unit not in RATE_UNITS or value < 1:
+            raise ValueError('Invalid rate() expression: {}'.format(
+                expression))
+        return 'rate', value * RATE_UNITS[unit]
+    match = CRON_PATTERN.match(expression)
+    if match:
+        return 'cron', CronSchedule(match.group(1))
+    raise ValueError('Unsupported schedule expression: {}'.format(expression))
+
+
+def next_fire_time(expression, after, anchor=None):
+    """Return the first time the expression fires strictly after a moment.
+
+    rate() schedules repeat relative to ``anchor`` (the time the schedule was
+    registered), the same way CloudWatch Events anchors them to rule creation.
+    """
+    kind, schedule = parse(expression)
+    if kind == 'cron':
+        return schedule.next_after(after)
+    anchor = anchor or after
+    elapsed = (after - anchor).total_seconds()
+    periods = int(elapsed // schedule) + 1 if elapsed >= 0 else 1
+    return anchor + timedelta(seconds=periods * schedule)
+
+
+def get_offset(stack_name, window):
+    """Return a stack's stable offset in whole minutes below window seconds.
+
+    The offset comes from a hash of the stack name, so it survives rule
+    updates and Lambda restarts, and stacks spread evenly over the window.
+    """
+    window_minutes = int(window) // 60
+    if window_minutes < 1:
+        return 0
+    digest = hashlib.sha256(stack_name.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % window_minutes
+
+
+def _jitter_rate(period, offset):
+    """Return a cron() firing every period at offset, or None if it can't."""
+    minutes = period // 60
+    if minutes < 60 and 60 % minutes == 0:
+        offset %= minutes
+        return 'cron({}/{} * * * ? *)'.format(offset, minutes)
+    if minutes % 60 == 0 and MINUTES_PER_DAY % minutes == 0:
+        offset %= minutes
+        hours = minutes // 60
+        hour_field = offset // 60 if hours == 24 else '{}/{}'.format(
+            offset // 60, hours)
+        return 'cron({} {} * * ? *)'.format(offset % 60, hour_field)
+    # cron() can't repeat every N days or uneven minutes, so keep the rate
+    return None
+
+
+def _jitter_cron(schedule, offset):
+    """Return a cron() shifted later by offset minutes, or None if it can't.
+
+    Only single-value minute fields are shifted.  With a single-value hour
+    the shift may move the hour, but it wraps within the same day so that
+    day-of-month and day-of-week keep their meaning.
+    """
+    minute, hour = schedule.fields[:2]
+    if not minute.isdigit():
+        return None
+    if hour.isdigit():
+        start = int(hour) * 60 + int(minute)
+        shifted = start + offset % (MINUTES_PER_DAY - start)
+        minute, hour = str(shifted % 60), str(shifted // 60)
+    else:
+        minute = str((int(minute) + offset) % 60)
+    return 'cron({})'.format(' '.join([minute, hour] + schedule.fields[2:]))
+
+
+def jitter(expression, stack_name, window):
+    """Return the expression shifted by the stack's offset within a window.
+
+    rate() schedules that divide an hour or a day become the equivalent
+    cron() with the offset built in.  Expressions that can't be shifted
+    without changing their cadence, or that this module can't parse, are
+    returned unchanged.
+    """
+    offset = get_offset(stack_name, window)
+    if not offset:
+        return expression
+    try:
+        kind, schedule = parse(expression)
+    except ValueError:
+        return expression
+    if kind == 'rate':
+        jittered = _jitter_rate(schedule, offset)
+    else:
+        jittered = _jitter_cron(schedule, offset)
+    return jittered or expression
+
+
+def preview(expression, stack_name, window, count=5, after=None):
+    """Return the jittered expression and its next fire times."""
+    jittered = jitter(expression, stack_name, window)
+    moment = after or utcnow()
+    anchor = moment
+    fire_times = []
+    for _ in range(count):
+        moment = next_fire_time(jittered, moment, anchor=anchor)
+        fire_times.append(moment)
+    return jittered, fire_times
+
+
+def main():
+    """Print the jittered schedule and fire times of each stack."""
+    parser = argparse.ArgumentParser(
+        description='Preview jittered auto-update schedules.')
+    parser.add_argument('expression', help='e.g. "rate(1 day)"')
+    parser.add_argument('stack_names', nargs='+')
+    parser.add_argument('--window', type=int, default=3600,
+                        help='jitter window in seconds (default 3600)')
+    parser.add_argument('--count', type=int, default=3,
+                        help='fire times to show per stack (default 3)')
+    args = parser.parse_args()
+    for stack_name in args.stack_names:
+        jittered, fire_times = preview(args.expression, stack_name,
+                                       args.window, args.count)
+        print('{}: {}'.format(stack_name, jittered))
+        for fire_time in fire_times:
+            print('    {}'.format(fire_time.isoformat()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""Store stack update schedules and the input fingerprints they applied."""
+
+import json
+import os
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+import schedule_expression
+from aws_clients import call, get_client, paginate
+from rule_targets import RULE_PREFIX
+from structured_logging import LogEvent, get_logger
+
+table_name = os.environ.get('SCHEDULE_TABLE')
+# stacks claimed per dispatcher tick; update_stack's rate limit and the
+# function timeout bound how many one invocation can start, so the rest
+# stay due for the next tick instead of being skipped for a period
+dispatch_batch = int(os.environ.get('DISPATCH_BATCH', '100'))
+
+# every schedule item lives in one partition of the due-index so a single
+# query returns the due batch in next_run order
+SCHEDULE_SHARD = 'schedule'
+DUE_INDEX = 'due-index'
+# where a stack outside the updater's own region and account lives
+STACK_TARGET_KEYS = ('region', 'account_id')
+# record fields a schedule update removes when they are no longer set
+OPTIONAL_KEYS = ('fingerprint_inputs',) + STACK_TARGET_KEYS
+
+log = get_logger(__name__)
+
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+
+def to_item(record):
+    """Serialize a schedule record into a DynamoDB item."""
+    return {key: serializer.serialize(value)
+            for key, value in record.items()}
+
+
+def from_item(item):
+    """Deserialize a DynamoDB item into a schedule record."""
+    record = {key: deserializer.deserialize(value)
+              for key, value in item.items()}
+    for key in ('next_run', 'anchor'):
+        if key in record:
+            record[key] = int(record[key])
+    return record
+
+
+def get_schedule_record(stack_name, schedule, toggle_parameter,
+                        toggle_values, now=None, fingerprint_inputs=None,
+                        stack_target=None):
+    """Return the schedule record stored for a stack."""
+    now = now or schedule_expression.utcnow()
+    next_run = schedule_expression.next_fire_time(schedule, now, anchor=now)
+    record = {
+        'stack_name': stack_name,
+        'shard': SCHEDULE_SHARD,
+        'schedule': schedule,
+        'toggle_parameter': toggle_parameter,
+        'toggle_values': json.dumps(toggle_values),
+        'anchor': schedule_expression.to_timestamp(now),
+        'next_run': schedule_expression.to_timestamp(next_run),
+    }
+    if fingerprint_inputs is not None:
+        record['fingerprint_inputs'] = json.dumps(fingerprint_inputs)
+    record.update(stack_target or {})
+    return record
+
+
+def put_schedule(stack_name, schedule, toggle_parameter, toggle_values,
+                 now=None, fingerprint_inputs=None, stack_target=None):
+    """Register or replace a stack's update schedule.
+
+    Only the schedule fields are written, so the fingerprint of the last
+    applied update survives a custom resource Update.
+    """
+    record = get_schedule_record(stack_name, schedule, toggle_parameter,
+                                 toggle_values, now, fingerprint_inputs,
+                                 stack_target)
+    fields = sorted(key for key in record if key != 'stack_name')
+    update_expression = 'SET {}'.format(', '.join(
+        '#{0} = :{0}'.format(key) for key in fields))
+    removed = [key for key in OPTIONAL_KEYS if key not in record]
+    if removed:
+        update_expression += ' REMOVE {}'.format(', '.join(
+            '#{}'.format(key) for key in removed))
+    response = call(
+        get_client('dynamodb'), 'update_item',
+        TableName=table_name,
+        Key=to_item({'stack_name': stack_name}),
+        UpdateExpression=update_expression,
+        ExpressionAttributeNames={'#{}'.format(key): key
+                                  for key in fields + removed},
+        ExpressionAttributeValues=to_item({
+            ':{}'.format(key): record[key] for key in fields})
+    )
+    log.info(LogEvent('put_schedule', record=record))
+    return response
+
+
+def delete_schedule(stack_name):
+    """Remove a stack's update schedule."""
+    response = call(
+        get_client('dynamodb'), 'delete_item',
+        TableName=table_name,
+        Key=to_item({'stack_name': stack_name})
+    )
+    log.info(LogEvent('delete_schedule', stack=stack_name))
+    return response
+
+
+def get_due_schedules(now, limit=None):
+    """Return the schedule records due at or before now, oldest first.
+
+    With a limit, at most that many records are read.
+    """
+    kwargs = {'Limit': limit} if limit else {}
+    pages = paginate(
+        get_client('dynamodb'), 'query',
+        input_token='ExclusiveStartKey',
+        output_token='LastEvaluatedKey',
+        TableName=table_name,
+        IndexName=DUE_INDEX,
+        KeyConditionExpression='shard = :shard AND next_run <= :now',
+        ExpressionAttributeValues=to_item({
+            ':shard': SCHEDULE_SHARD,
+            ':now': schedule_expression.to_timestamp(now),
+        }),
+        **kwargs
+    )
+    records = []
+    for page in pages:
+        records.extend(from_item(item) for item in page['Items'])
+        if limit and len(records) >= limit:
+            return records[:limit]
+    return records
+
+
+def claim_schedule(record, now):
+    """Advance a due record to its next run; return False if already taken.
+
+    The conditional write keeps overlapping dispatcher ticks from both
+    updating the same stack.
+    """
+    next_run = schedule_expression.next_fire_time(
+        record['schedule'], now,
+        anchor=schedule_expression.from_timestamp(record['anchor']))
+    try:
+        call(
+            get_client('dynamodb'), 'update_item',
+            TableName=table_name,
+            Key=to_item({'stack_name': record['stack_name']}),
+            UpdateExpression='SET next_run = :next',
+            ConditionExpression='next_run = :due',
+            ExpressionAttributeValues=to_item({
+                ':next': schedule_expression.to_timestamp(next_run),
+                ':due': record['next_run'],
+            })
+        )
+    except get_client('dynamodb').exceptions.ConditionalCheckFailedException:
+        log.info(LogEvent('Schedule already claimed',
+                          stack=record['stack_name']))
+        return False
+    return True
+
+
+def defer_schedule(stack_name, retry_at):
+    """Move a stack's next run to a retry time.
+
+    Returns None if the schedule was deleted in the meantime.
+    """
+    try:
+        response = call(
+            get_client('dynamodb'), 'update_item',
+            TableName=table_name,
+            Key=to_item({'stack_name': stack_name}),
+            UpdateExpression='SET next_run = :retry',
+            ConditionExpression='attribute_exists(stack_name)',
+            ExpressionAttributeValues=to_item({':retry': int(retry_at)})
+        )
+    except get_client('dynamodb').exceptions.ConditionalCheckFailedException:
+        log.info(LogEvent('Schedule was deleted; not deferred',
+                          stack=stack_name))
+        return None
+    log.info(LogEvent('defer_schedule', stack=stack_name,
+                      retry_at=retry_at))
+    return response
+
+
+def get_stack_descriptor(record):
+    """Return the updater event for a schedule record."""
+    descriptor = {
+        'event_name': '{}{}'.format(RULE_PREFIX, record['stack_name']),
+        'stack_name': record['stack_name'],
+        'toggle_parameter': record['toggle_parameter'],
+        'toggle_values': json.loads(record['toggle_values']),
+        'dispatched': True,
+        # names the run, so a staged change set can be found for it
+        'scheduled_at': record['next_run'],
+    }
+    if 'fingerprint_inputs' in record:
+        descriptor['fingerprint_inputs'] = json.loads(
+            record['fingerprint_inputs'])
+    for key in STACK_TARGET_KEYS:
+        if key in record:
+            descriptor[key] = record[key]
+    return descriptor
+
+
+def claim_due_stacks(now=None, limit=None):
+    """Claim the longest-due schedules and return the stacks to update.
+
+    At most limit (default dispatch_batch) schedules are claimed; the rest
+    stay due and are claimed by the next tick.
+    """
+    now = now or schedule_expression.utcnow()
+    due = get_due_schedules(now, limit or dispatch_batch)
+    claimed = [get_stack_descriptor(record) for record in due
+               if claim_schedule(record, now)]
+    log.info(LogEvent('claim_due_stacks', due=len(due),
+                      claimed=len(claimed)))
+    return claimed
+
+
+def get_applied_fingerprint(stack_name):
+    """Return the input fingerprint of a stack's last update, if any."""
+    response = call(
+        get_client('dynamodb'), 'get_item',
+        TableName=table_name,
+        Key=to_item({'stack_name': stack_name}),
+        ProjectionExpression='applied_fingerprint'
+    )
+    return from_item(response.get('Item', {})).get('applied_fingerprint')
+
+
+def set_applied_fingerprint(stack_name, fingerprint):
+    """Record the input fingerprint of the update started on a stack.
+
+    Stacks on per-stack rules have no schedule record, so this creates an
+    item holding only the fingerprint; without a shard it stays out of the
+    due-index.
+    """
+    response = call(
+        get_client('dynamodb'), 'update_item',
+        TableName=table_name,
+        Key=to_item({'stack_name': stack_name}),
+        UpdateExpression='SET applied_fingerprint = :fingerprint',
+        ExpressionAttributeValues=to_item({':fingerprint': fingerprint})
+    )
+    log.info(LogEvent('set_applied_fingerprint', stack=stack_name,
+                      fingerprint=fingerprint))
+    return response
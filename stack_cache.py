@@ -0,0 +1,109 @@
+"""Cache CloudFormation stack metadata shared by the broker and updater.
+
+Stacks in the Lambda's own account and region live in the default scope
+and are described with its own client.  Stacks reached through another
+account or region are cached under a scope of their own, usually the
+(role arn, region) target, and are described with a client passed in for
+that target.
+"""
+
+import copy
+import os
+import threading
+import time
+
+from aws_clients import call, get_client, paginate
+from structured_logging import LogEvent, get_logger
+
+log = get_logger(__name__)
+
+stack_cache_ttl = int(os.environ.get('STACK_CACHE_TTL', '60'))  # seconds
+
+# describe_stacks fields kept per stack
+SUMMARY_KEYS = ('StackName', 'StackId', 'StackStatus', 'Parameters',
+                'LastUpdatedTime', 'CreationTime')
+
+
+def summarize(stack):
+    """Return the cached subset of a describe_stacks entry."""
+    return {key: stack[key] for key in SUMMARY_KEYS if key in stack}
+
+
+class StackCache(object):
+    """Serve stack status, parameters and update time from one describe."""
+
+    def __init__(self, ttl):
+        """Define the cache and its counters."""
+        self.ttl = ttl
+        self.entries = {}
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0,
+                      'primed': 0}
+        self.lock = threading.Lock()
+
+    def store(self, stack, loaded=None, scope=None):
+        """Cache a describe_stacks entry, replacing an outdated one."""
+        summary = summarize(stack)
+        key = (scope, summary['StackName'])
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['stack'].get('LastUpdatedTime') != summary.get(
+                    'LastUpdatedTime'):
+                self.stats['invalidations'] += 1
+            self.entries[key] = {
+                'stack': summary,
+                'loaded': loaded or time.monotonic()
+            }
+        return summary
+
+    def lookup(self, stack_name, scope=None):
+        """Return a fresh cached summary, or None."""
+        with self.lock:
+            entry = self.entries.get((scope, stack_name))
+            if entry and time.monotonic() - entry['loaded'] < self.ttl:
+                self.stats['hits'] += 1
+                return entry['stack']
+            self.stats['misses'] += 1
+            return None
+
+    def get(self, stack_name, client=None, scope=None):
+        """Return a copy of a stack's summary, describing it on a miss.
+
+        Callers get a deep copy because update_parameter edits the
+        parameter dicts in place.
+        """
+        summary = self.lookup(stack_name, scope)
+        if summary is None:
+            response = call(client or get_client('cloudformation'),
+                            'describe_stacks', StackName=stack_name)
+            summary = self.store(response['Stacks'][0], scope=scope)
+        return copy.deepcopy(summary)
+
+    def invalidate(self, stack_name, scope=None):
+        """Forget a stack, e.g. after starting an update on it."""
+        with self.lock:
+            if self.entries.pop((scope, stack_name), None) is not None:
+                self.stats['invalidations'] += 1
+
+    def prime(self, stack_names=None, client=None, scope=None):
+        """Load every stack (or the named ones) from one paginated sweep."""
+        wanted = set(stack_names) if stack_names is not None else None
+        loaded = time.monotonic()
+        count = 0
+        for page in paginate(client or get_client('cloudformation'),
+                             'describe_stacks'):
+            for stack in page['Stacks']:
+                if wanted is None or stack['StackName'] in wanted:
+                    self.store(stack, loaded, scope)
+                    count += 1
+        with self.lock:
+            self.stats['primed'] += count
+        log.info(LogEvent('Primed stack cache', stacks=count))
+        return count
+
+    def clear(self):
+        """Drop every cached stack."""
+        with self.lock:
+            self.entries.clear()
+
+
+stack_cache = StackCache(stack_cache_ttl)
@@ -0,0 +1,210 @@
+"""Keep small pieces of updater state between invocations."""
+
+import json
+import os
+import threading
+
+from aws_clients import call, get_client, paginate
+from structured_logging import LogEvent, get_logger
+
+log = get_logger(__name__)
+
+# 'dynamodb', as deployed, shares state between every execution
+# environment via STATE_TABLE; for local runs, 'memory' keeps it for the
+# life of the process and 'file' persists it to STATE_FILE
+state_store_type = os.environ.get('STATE_STORE', 'dynamodb')
+state_file = os.environ.get('STATE_FILE',
+                            '/tmp/cfn-update-scheduler-state.json')
+state_table = os.environ.get('STATE_TABLE')
+
+
+def get_kind(key):
+    """Return the part of a key before its first colon."""
+    return key.split(':', 1)[0]
+
+
+def to_json(value):
+    """Serialize a value the same way every time, for conditional writes."""
+    return json.dumps(value, sort_keys=True)
+
+
+class MemoryStateStore(object):
+    """Store JSON-serializable state in memory."""
+
+    def __init__(self):
+        """Define an empty store."""
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value stored under a key."""
+        with self.lock:
+            return self.values.get(key, default)
+
+    def set(self, key, value):
+        """Store a value under a key."""
+        with self.lock:
+            self.values[key] = value
+            self.save()
+
+    def replace(self, key, expected, value):
+        """Store a value only if the key still holds expected.
+
+        Returns False, storing nothing, when another caller changed it.
+        """
+        with self.lock:
+            if self.values.get(key) != expected:
+                return False
+            self.values[key] = value
+            self.save()
+            return True
+
+    def items(self, prefix=''):
+        """Return (key, value) pairs whose key starts with a prefix."""
+        with self.lock:
+            return [(key, value) for key, value in self.values.items()
+                    if key.startswith(prefix)]
+
+    def delete(self, key):
+        """Remove a key if it is present."""
+        self.take(key)
+
+    def take(self, key):
+        """Remove a key and return its value, or None if it was absent.
+
+        Only one of several callers taking the same key gets its value.
+        """
+        with self.lock:
+            value = self.values.pop(key, None)
+            if value is not None:
+                self.save()
+            return value
+
+    def save(self):
+        """Persist the values; memory stores have nothing to do."""
+
+
+class FileStateStore(MemoryStateStore):
+    """Store JSON-serializable state in a local file."""
+
+    def __init__(self, path):
+        """Load any state already written to the file."""
+        super(FileStateStore, self).__init__()
+        self.path = path
+        try:
+            with open(self.path) as handle:
+                self.values = json.load(handle)
+        except (IOError, ValueError):
+            self.values = {}
+
+    def save(self):
+        """Write every value to the file atomically."""
+        temp_path = '{}.tmp'.format(self.path)
+        with open(temp_path, 'w') as handle:
+            json.dump(self.values, handle)
+        os.rename(temp_path, self.path)
+
+
+class DynamoDBStateStore(object):
+    """Store JSON-serializable state in a DynamoDB table.
+
+    Items are partitioned by the key's kind (the part before its first
+    colon), so a prefix lookup is a single query.
+    """
+
+    def __init__(self, table):
+        """Define the store on a table keyed by kind and key."""
+        self.table = table
+
+    def get_key(self, key):
+        """Return the DynamoDB primary key of a state key."""
+        return {'kind': {'S': get_kind(key)}, 'key': {'S': key}}
+
+    def get(self, key, default=None):
+        """Return the value stored under a key."""
+        response = call(get_client('dynamodb'), 'get_item',
+                        TableName=self.table, Key=self.get_key(key),
+                        ConsistentRead=True)
+        if 'Item' not in response:
+            return default
+        return json.loads(response['Item']['value']['S'])
+
+    def set(self, key, value):
+        """Store a value under a key."""
+        item = dict(self.get_key(key), value={'S': to_json(value)})
+        call(get_client('dynamodb'), 'put_item', TableName=self.table,
+             Item=item)
+
+    def replace(self, key, expected, value):
+        """Store a value only if the key still holds expected.
+
+        Returns False, storing nothing, when another caller changed it.
+        """
+        dynamodb = get_client('dynamodb')
+        try:
+            call(dynamodb, 'put_item', TableName=self.table,
+                 Item=dict(self.get_key(key), value={'S': to_json(value)}),
+                 ConditionExpression='#value = :expected',
+                 ExpressionAttributeNames={'#value': 'value'},
+                 ExpressionAttributeValues={
+                     ':expected': {'S': to_json(expected)}})
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def items(self, prefix=''):
+        """Return (key, value) pairs whose key starts with a prefix.
+
+        The prefix must name a kind, such as 'inflight:'.
+        """
+        pages = paginate(
+            get_client('dynamodb'), 'query',
+            input_token='ExclusiveStartKey',
+            output_token='LastEvaluatedKey',
+            TableName=self.table,
+            ConsistentRead=True,
+            KeyConditionExpression='kind = :kind AND begins_with(#key, '
+                                   ':prefix)',
+            ExpressionAttributeNames={'#key': 'key'},
+            ExpressionAttributeValues={':kind': {'S': get_kind(prefix)},
+                                       ':prefix': {'S': prefix}}
+        )
+        return [(item['key']['S'], json.loads(item['value']['S']))
+                for page in pages for item in page['Items']]
+
+    def delete(self, key):
+        """Remove a key if it is present."""
+        self.take(key)
+
+    def take(self, key):
+        """Remove a key and return its value, or None if it was absent.
+
+        Only one of several callers taking the same key gets its value.
+        """
+        response = call(get_client('dynamodb'), 'delete_item',
+                        TableName=self.table, Key=self.get_key(key),
+                        ReturnValues='ALL_OLD')
+        attributes = response.get('Attributes', {})
+        if 'value' not in attributes:
+            return None
+        return json.loads(attributes['value']['S'])
+
+
+STATE_STORES = {
+    'memory': lambda: MemoryStateStore(),
+    'file': lambda: FileStateStore(state_file),
+    'dynamodb': lambda: DynamoDBStateStore(state_table),
+}
+
+state_store = None
+state_store_lock = threading.Lock()
+
+
+def get_state_store():
+    """Return the configured state store, creating it on first use."""
+    global state_store
+    with state_store_lock:
+        if state_store is None:
+            state_store = STATE_STORES[state_store_type]()
+            log.info(LogEvent('Using state store', type=state_store_type))
+        return state_store
@@ -0,0 +1,123 @@
+"""Format log records lazily, redact secrets and sample success-path logs.
+
+Call sites log ``LogEvent`` objects instead of pre-formatted strings, so an
+API response is only rendered when its record is actually emitted.  With
+``LOG_MODE=structured`` every rendered event is a JSON object whose fields
+are truncated to ``LOG_FIELD_LENGTH`` characters, and INFO records are kept
+for only ``LOG_SAMPLE_RATE`` of invocations.  Warnings and errors are never
+sampled or truncated.  Secrets are redacted in every mode.
+"""
+
+import json
+import logging
+import os
+import random
+import re
+
+# 'full' keeps the plain "name: value" messages, 'structured' emits JSON
+log_mode = os.environ.get('LOG_MODE', 'full')
+sample_rate = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+field_length = int(os.environ.get('LOG_FIELD_LENGTH', '512'))
+
+REDACTED = '***'
+SECRET_KEY_PATTERN = re.compile(
+    r'secret|password|sessiontoken|credentials|authorization', re.I)
+# pre-signed S3 urls carry their signature in the query string
+URL_KEYS = frozenset(['ResponseURL'])
+
+# whether the current invocation keeps its INFO records
+sampled = True
+
+
+def start_invocation():
+    """Decide whether this invocation's INFO records are kept."""
+    global sampled
+    sampled = log_mode != 'structured' or random.random() < sample_rate
+    return sampled
+
+
+def is_sampled():
+    """Return True if this invocation's INFO records are kept."""
+    return sampled
+
+
+def redact_url(url):
+    """Strip the query string, and any signature in it, from a url."""
+    return url.split('?', 1)[0] + ('?' + REDACTED if '?' in url else '')
+
+
+def redact(value):
+    """Return a copy of a value with every secret replaced."""
+    if isinstance(value, dict):
+        redacted = {}
+        for key, item in value.items():
+            if SECRET_KEY_PATTERN.search(str(key)):
+                redacted[key] = REDACTED
+            elif key in URL_KEYS and isinstance(item, str):
+                redacted[key] = redact_url(item)
+            else:
+                redacted[key] = redact(item)
+        return redacted
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+def truncate(text, length):
+    """Cut text down to a length, noting how much was dropped."""
+    if length is None or len(text) <= length:
+        return text
+    return '{}...<{} more>'.format(text[:length], len(text) - length)
+
+
+class LogEvent(object):
+    """A log message whose fields are formatted only when emitted."""
+
+    def __init__(self, name, **fields):
+        """Define the event name and its fields."""
+        self.name = name
+        self.fields = fields
+
+    def render(self, structured=False, length=None):
+        """Return the redacted message, truncating each field to length."""
+        fields = [(key, truncate(str(redact(value)), length))
+                  for key, value in sorted(self.fields.items())]
+        if structured:
+            return json.dumps(dict(fields, message=self.name))
+        if len(fields) == 1:
+            return '{}: {}'.format(self.name, fields[0][1])
+        return '{}: {}'.format(self.name, ', '.join(
+            '{}={}'.format(key, value) for key, value in fields))
+
+    def __str__(self):
+        """Render the full message."""
+        return self.render()
+
+
+class SamplingFilter(logging.Filter):
+    """Drop INFO records of unsampled invocations and render LogEvents."""
+
+    def filter(self, record):
+        """Return False for dropped records, rendering kept LogEvents."""
+        error_path = record.levelno >= logging.WARNING
+        if not error_path and not sampled:
+            return False
+        if isinstance(record.msg, LogEvent):
+            structured = log_mode == 'structured'
+            record.msg = record.msg.render(
+                structured, None if error_path or not structured
+                else field_length)
+            record.args = ()
+        return True
+
+
+sampling_filter = SamplingFilter()
+
+
+def get_logger(name):
+    """Return an INFO logger that samples, redacts and renders lazily."""
+    log = logging.getLogger(name)
+    log.setLevel(logging.INFO)
+    if sampling_filter not in log.filters:
+        log.addFilter(sampling_filter)
+    return log
@@ -0,0 +1,58 @@
+"""Shared pytest configuration."""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# keep boto3 away from real credentials and endpoints
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_SECURITY_TOKEN', 'testing')
+os.environ.setdefault('AWS_SESSION_TOKEN', 'testing')
+os.environ.setdefault('STACK_UPDATE_ARN',
+                      'arn:aws:iam::123456789012:role/StackUpdateRole')
+os.environ.setdefault('SCHEDULE_TABLE', 'cfn-update-scheduler-test-schedule')
+os.environ.setdefault('STATE_TABLE', 'cfn-update-scheduler-test-state')
+# tests that share state between environments use the state_table fixture
+os.environ.setdefault('STATE_STORE', 'memory')
+os.environ.setdefault('FUNCTION_NAME',
+                      'cfn-update-scheduler-dev-cwe_update_target')
+os.environ.setdefault('REGION', 'us-east-1')
+
+import boto3  # noqa: E402
+import pytest  # noqa: E402
+from moto import mock_dynamodb  # noqa: E402
+
+import aws_clients  # noqa: E402
+import state_store  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_rate_limits():
+    """Give every test full token buckets."""
+    aws_clients.buckets.clear()
+    yield
+
+
+@pytest.fixture
+def state_table():
+    """Create the shared state table and return its name.
+
+    Each DynamoDBStateStore on it stands in for one execution environment.
+    """
+    with mock_dynamodb():
+        boto3.client('dynamodb').create_table(
+            TableName=state_store.state_table,
+            AttributeDefinitions=[
+                {'AttributeName': 'kind', 'AttributeType': 'S'},
+                {'AttributeName': 'key', 'AttributeType': 'S'},
+            ],
+            KeySchema=[
+                {'AttributeName': 'kind', 'KeyType': 'HASH'},
+                {'AttributeName': 'key', 'KeyType': 'RANGE'},
+            ],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        yield state_store.state_table
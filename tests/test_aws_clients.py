@@ -0,0 +1,115 @@
+"""Perform unit test on aws_clients.py."""
+
+import mock
+import pytest
+from botocore.exceptions import ClientError
+
+import aws_clients
+
+
+def get_error(code, status=400):
+    """Return a ClientError carrying an error code."""
+    return ClientError({'Error': {'Code': code, 'Message': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status}},
+                       'DescribeStacks')
+
+
+def get_fake_client(method_name, side_effect):
+    """Return a client stand-in whose method follows a side effect."""
+    client = mock.Mock()
+    client.meta.service_model.service_name = 'cloudformation'
+    client.meta.region_name = 'us-east-1'
+    setattr(client, method_name, mock.Mock(side_effect=side_effect))
+    return client
+
+
+@pytest.fixture(autouse=True)
+def no_sleep():
+    """Skip backoff delays and start each test with fresh counters."""
+    aws_clients.call_stats.reset()
+    with mock.patch.object(aws_clients.time, 'sleep'):
+        yield
+
+
+class TestClassifyError(object):
+    """Validate error classification."""
+
+    @pytest.mark.parametrize('error, kind', [
+        (get_error('Throttling'), 'throttle'),
+        (get_error('Unknown', 429), 'throttle'),
+        (get_error('InternalFailure', 500), 'transient'),
+        (get_error('ValidationError'), 'fatal'),
+        (ValueError('bad toggle'), 'fatal'),
+    ])
+    def test_classify_error(self, error, kind):
+        """Test each error maps to its retry class."""
+        assert aws_clients.classify_error(error) == kind
+
+
+class TestCall(object):
+    """Validate the retry loop and counters."""
+
+    def test_retries_throttling(self):
+        """Test throttled calls are retried until they succeed."""
+        client = get_fake_client('describe_stacks', [
+            get_error('Throttling'), get_error('Throttling'),
+            {'Stacks': []}])
+        assert aws_clients.call(client, 'describe_stacks') == {'Stacks': []}
+        assert aws_clients.call_stats.snapshot()[
+            'cloudformation:describe_stacks'] == {
+                'calls': 3, 'throttles': 2, 'retries': 2, 'failures': 0}
+
+    def test_fatal_errors_are_not_retried(self):
+        """Test fatal errors raise on the first attempt."""
+        client = get_fake_client('update_stack',
+                                 [get_error('ValidationError')])
+        with pytest.raises(ClientError):
+            aws_clients.call(client, 'update_stack', StackName='test')
+        assert client.update_stack.call_count == 1
+
+    def test_update_stack_is_retried_only_with_a_token(self):
+        """Test a transient update_stack failure repeats under its token."""
+        client = get_fake_client('update_stack', [
+            get_error('InternalFailure', 500), {}])
+        aws_clients.call(client, 'update_stack', StackName='test',
+                         ClientRequestToken='run')
+        assert client.update_stack.call_count == 2
+
+        client = get_fake_client('update_stack', [
+            get_error('Throttling'), get_error('InternalFailure', 500), {}])
+        with pytest.raises(ClientError):
+            aws_clients.call(client, 'update_stack', StackName='test')
+        assert client.update_stack.call_count == 2
+
+    def test_gives_up_after_max_attempts(self):
+        """Test persistent throttling eventually raises."""
+        client = get_fake_client(
+            'describe_stacks',
+            [get_error('Throttling')] * aws_clients.MAX_ATTEMPTS)
+        with pytest.raises(ClientError):
+            aws_clients.call(client, 'describe_stacks')
+        counters = aws_clients.call_stats.snapshot()[
+            'cloudformation:describe_stacks']
+        assert counters['failures'] == 1
+        assert counters['retries'] == aws_clients.MAX_ATTEMPTS - 1
+
+    def test_paginate(self):
+        """Test pages are followed until no token is returned."""
+        client = get_fake_client('describe_stacks', [
+            {'Stacks': [1], 'NextToken': 'a'}, {'Stacks': [2]}])
+        pages = list(aws_clients.paginate(client, 'describe_stacks'))
+        assert [page['Stacks'] for page in pages] == [[1], [2]]
+        client.describe_stacks.assert_called_with(NextToken='a')
+
+
+class TestTokenBucket(object):
+    """Validate the adaptive rate."""
+
+    def test_throttle_halves_rate_and_success_recovers(self):
+        """Test the rate drops on throttles and recovers on success."""
+        bucket = aws_clients.TokenBucket(10, 10)
+        bucket.throttled()
+        assert bucket.rate == 5
+        for _ in range(20):
+            bucket.succeeded()
+        assert bucket.rate == 10
@@ -2,11 +2,15 @@
 
 import zipfile
 import io
+import json
+import threading
+import time
 import mock
+from mock import Mock, patch
 import pytest
 import boto3
 import os
-from moto import mock_events, mock_sts, mock_lambda
+from moto import mock_events, mock_iam, mock_sts, mock_lambda
 from ast import literal_eval
 import sys
 
@@ -30,7 +34,8 @@ from cfn_auto_update_broker import (get_lambda_arn,
                                     delete_event,
                                     lambda_add_resource_policy,
                                     lambda_remove_resource_policy,
-                                    lambda_handler)
+                                    lambda_handler,
+                                    run_steps)
 
 mock = mock_sts()
 mock.start()
@@ -58,6 +63,11 @@ def lambda_handler(event, context):
     return _process_lambda(pfunc)
 
 
+def get_rule_input(target):
+    """Return the input template of a rule's target."""
+    return json.loads(target['InputTransformer']['InputTemplate'])
+
+
 class TestGetFunction(object):
     """Create mock lambda function."""
 
@@ -230,3 +240,235 @@ class TestEventActions(object):
 # def test_lambda_handler(event, context):
 #     """Test delete_event."""
 #     lambda_handler(event, context)
+
+
+class TestLazyResolution(object):
+    """Validate account and target arn resolution without API calls."""
+
+    @pytest.fixture
+    def reset(self):
+        """Forget any account id learned by earlier tests."""
+        import cfn_auto_update_broker
+        with patch.multiple(cfn_auto_update_broker, account_id=None,
+                                 function_arn=None):
+            yield cfn_auto_update_broker
+
+    def test_account_from_context(self, reset):
+        """Test the account id is read from the invoked function arn."""
+        context = Mock(invoked_function_arn=(
+            'arn:aws:lambda:us-east-1:210987654321:function:broker'))
+        reset.set_invocation_context(context)
+        assert reset.get_account_id() == '210987654321'
+        assert reset.get_target_lambda_arn() == (
+            'arn:aws:lambda:us-east-1:210987654321:function:{}'.format(
+                function_name))
+
+    def test_delete_event_makes_no_lookup(self, reset):
+        """Test building a Delete event object makes no API calls."""
+        with patch.object(reset, 'get_client') as get_client:
+            event_obj = reset.CloudwatchEvent('test-stack', None, None, None)
+            assert event_obj.delete_rule_input == {
+                'Name': 'auto-update-test-stack'}
+        assert not get_client.called
+
+
+class TestRunSteps(object):
+    """Validate concurrent broker steps."""
+
+    def test_steps_run_concurrently(self):
+        """Test independent steps overlap instead of running in turn."""
+        barrier = threading.Barrier(2, timeout=5)
+        assert run_steps(None, barrier.wait, barrier.wait) is not None
+
+    def test_deadline(self):
+        """Test steps running at the deadline fail and make no more calls."""
+        import aws_clients
+        events = Mock()
+        events.meta.service_model.service_name = 'events'
+        events.meta.region_name = region
+
+        def step():
+            # still running when run_steps gives up on it
+            time.sleep(0.2)
+            aws_clients.call(events, 'put_rule', Name='auto-update-test')
+
+        context = Mock()
+        context.get_remaining_time_in_millis.return_value = 100
+        with pytest.raises(TimeoutError):
+            run_steps(context, step)
+        assert not events.put_rule.called
+        assert aws_clients.call_deadline is None
+
+    def test_errors_propagate(self):
+        """Test a failing step fails the request."""
+
+        def fail():
+            raise ValueError('boom')
+        with pytest.raises(ValueError):
+            run_steps(None, fail, lambda: None)
+
+
+class TestHandlerRequests(object):
+    """Validate Create and Delete against moto."""
+
+    @pytest.fixture
+    def handler_env(self):
+        """Create the target function and silence the cfn response."""
+        import cfn_auto_update_broker
+        with mock_sts(), mock_events(), mock_lambda(), mock_iam():
+            role = boto3.client('iam').create_role(
+                RoleName='lambda-role', AssumeRolePolicyDocument='{}',
+                Path='/')['Role']['Arn']
+            boto3.client('lambda', region_name='us-east-1').create_function(
+                FunctionName=function_name, Runtime='python3.9',
+                Role=role, Handler='lambda_function.lambda_handler',
+                Code={'ZipFile': get_test_zip_file1()})
+            with patch.object(cfn_auto_update_broker.cfnresponse, 'send'), \
+                    patch.multiple(cfn_auto_update_broker, account_id=None,
+                                   function_arn=None):
+                cfn_auto_update_broker.policy_cache.clear()
+                yield cfn_auto_update_broker
+
+    def get_request(self, request_type):
+        """Return a custom resource request."""
+        return {
+            'RequestType': request_type,
+            'ResponseURL': 'https://example.com/response',
+            'StackId': 'stack-id',
+            'RequestId': 'request-id',
+            'LogicalResourceId': 'AutoUpdateStack',
+            'ResourceProperties': {
+                'ToggleValues': ['A', 'B'],
+                'ToggleParameter': 'ForceUpdateToggle',
+                'UpdateSchedule': 'rate(1 day)',
+                'StackName': 'test-stack',
+            },
+        }
+
+    def test_create_then_delete(self, handler_env):
+        """Test Create makes the rule and target and Delete removes them."""
+        context = Mock(invoked_function_arn=(
+            'arn:aws:lambda:us-east-1:123456789012:function:broker'))
+        context.get_remaining_time_in_millis.return_value = 60000
+        events = boto3.client('events', region_name='us-east-1')
+
+        handler_env.lambda_handler(self.get_request('Create'), context)
+        targets = events.list_targets_by_rule(Rule='auto-update-test-stack')
+        assert targets['Targets'][0]['Arn'].endswith(function_name)
+        rule = events.describe_rule(Name='auto-update-test-stack')
+        assert rule['ScheduleExpression'] == 'rate(1 day)'
+
+        handler_env.lambda_handler(self.get_request('Delete'), context)
+        rules = events.list_rules(NamePrefix='auto-update-')['Rules']
+        assert rules == []
+
+    def test_jitter_is_opt_in(self, handler_env):
+        """Test schedules are only shifted when a window is configured."""
+        assert handler_env.get_schedule_expression(
+            'test-stack', 'rate(1 day)') == 'rate(1 day)'
+        with patch.object(handler_env, 'jitter_window', 3600):
+            assert handler_env.get_schedule_expression(
+                'test-stack', 'rate(1 day)') == 'cron(54 0 * * ? *)'
+
+    def test_update_passes_new_inputs_to_target(self, handler_env):
+        """Test an Update that changes the rule input rewrites the target."""
+        context = Mock(invoked_function_arn=(
+            'arn:aws:lambda:us-east-1:123456789012:function:broker'))
+        context.get_remaining_time_in_millis.return_value = 60000
+        handler_env.lambda_handler(self.get_request('Create'), context)
+
+        request = self.get_request('Update')
+        request['OldResourceProperties'] = dict(request['ResourceProperties'])
+        request['ResourceProperties']['FingerprintInputs'] = {
+            'SsmParameters': ['/app/release']}
+        with patch.object(handler_env.stack_cache, 'get',
+                          return_value={'StackStatus': 'CREATE_COMPLETE'}):
+            handler_env.lambda_handler(request, context)
+
+        target = boto3.client('events').list_targets_by_rule(
+            Rule='auto-update-test-stack')['Targets'][0]
+        assert get_rule_input(target)['fingerprint_inputs'] == {
+            'SsmParameters': ['/app/release']}
+
+    def test_update_rewrites_legacy_target(self, handler_env):
+        """Test a schedule-only Update rewrites a constant-input target."""
+        context = Mock(invoked_function_arn=(
+            'arn:aws:lambda:us-east-1:123456789012:function:broker'))
+        context.get_remaining_time_in_millis.return_value = 60000
+        handler_env.lambda_handler(self.get_request('Create'), context)
+        events = boto3.client('events')
+        target = events.list_targets_by_rule(
+            Rule='auto-update-test-stack')['Targets'][0]
+        events.put_targets(Rule='auto-update-test-stack', Targets=[{
+            'Id': target['Id'], 'Arn': target['Arn'],
+            'Input': json.dumps(get_rule_input(target))}])
+
+        request = self.get_request('Update')
+        request['OldResourceProperties'] = dict(request['ResourceProperties'])
+        request['ResourceProperties']['UpdateSchedule'] = 'rate(2 days)'
+        with patch.object(handler_env.stack_cache, 'get',
+                          return_value={'StackStatus': 'CREATE_COMPLETE'}):
+            handler_env.lambda_handler(request, context)
+
+        target = events.list_targets_by_rule(
+            Rule='auto-update-test-stack')['Targets'][0]
+        assert 'InputTransformer' in target
+
+    def test_remote_stack_target(self, handler_env):
+        """Test a stack in another region is scheduled without a describe."""
+        context = Mock(invoked_function_arn=(
+            'arn:aws:lambda:us-east-1:123456789012:function:broker'))
+        context.get_remaining_time_in_millis.return_value = 60000
+        request = self.get_request('Create')
+        request['ResourceProperties'].update(
+            Region='us-west-2', AccountId='123456789012')
+        handler_env.lambda_handler(request, context)
+
+        update = self.get_request('Update')
+        update['ResourceProperties'] = dict(request['ResourceProperties'])
+        update['OldResourceProperties'] = dict(request['ResourceProperties'])
+        with patch.object(handler_env.stack_cache, 'get') as get:
+            handler_env.lambda_handler(update, context)
+        get.assert_not_called()
+
+        target = boto3.client('events').list_targets_by_rule(
+            Rule='auto-update-test-stack')['Targets'][0]
+        rule_input = get_rule_input(target)
+        assert rule_input['scheduled_time'] == '<time>'
+        assert rule_input['region'] == 'us-west-2'
+        assert 'account_id' not in rule_input
+
+    def test_shared_policy_statement(self, handler_env):
+        """Test the shared policy mode adds one statement for every rule."""
+        context = Mock(invoked_function_arn=(
+            'arn:aws:lambda:us-east-1:123456789012:function:broker'))
+        context.get_remaining_time_in_millis.return_value = 60000
+        add = patch.object(handler_env, 'lambda_add_resource_policy',
+                           wraps=handler_env.lambda_add_resource_policy)
+        remove = patch.object(handler_env, 'lambda_remove_resource_policy')
+        with patch.object(handler_env, 'policy_mode', 'shared'), \
+                add as add_permission, remove as remove_permission:
+            for stack_name in ('stack-1', 'stack-2'):
+                request = self.get_request('Create')
+                request['ResourceProperties']['StackName'] = stack_name
+                handler_env.lambda_handler(request, context)
+            handler_env.lambda_handler(self.get_request('Delete'), context)
+        assert add_permission.call_count == 1
+        remove_permission.assert_not_called()
+
+        policy = json.loads(boto3.client('lambda').get_policy(
+            FunctionName=function_name)['Policy'])
+        assert len(policy['Statement']) == 1
+        assert json.dumps(policy['Statement'][0]).find(
+            'rule/auto-update-*') != -1
+
+    def test_known_statement_is_not_added_again(self, handler_env):
+        """Test a repeated Create skips add_permission for its statement."""
+        context = Mock(invoked_function_arn=(
+            'arn:aws:lambda:us-east-1:123456789012:function:broker'))
+        context.get_remaining_time_in_millis.return_value = 60000
+        with patch.object(handler_env, 'lambda_add_resource_policy',
+                          wraps=handler_env.lambda_add_resource_policy) as add:
+            handler_env.lambda_handler(self.get_request('Create'), context)
+            handler_env.lambda_handler(self.get_request('Create'), context)
+        assert add.call_count == 1
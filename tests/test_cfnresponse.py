@@ -0,0 +1,89 @@
+"""Perform unit test on cfnresponse.py."""
+
+import json
+
+import mock
+import pytest
+import urllib3
+
+import cfnresponse
+
+EVENT = {
+    'ResponseURL': 'https://example.com/response',
+    'StackId': 'stack-id',
+    'RequestId': 'request-id',
+    'LogicalResourceId': 'AutoUpdateStack',
+}
+
+
+@pytest.fixture
+def http():
+    """Replace the pooled connection and skip backoff delays."""
+    with mock.patch.object(cfnresponse, 'http') as http, \
+            mock.patch.object(cfnresponse.time, 'sleep'):
+        yield http
+
+
+def get_context():
+    """Return a Lambda context stand-in."""
+    return mock.Mock(log_stream_name='log-stream')
+
+
+class TestSend(object):
+    """Validate the custom resource response sender."""
+
+    def test_success(self, http):
+        """Test a single PUT carries the response body."""
+        http.request.return_value = mock.Mock(status=200)
+        assert cfnresponse.send(EVENT, get_context(), cfnresponse.SUCCESS,
+                                {'Key': 'Value'})
+        method, url = http.request.call_args[0]
+        body = json.loads(http.request.call_args[1]['body'])
+        assert (method, url) == ('PUT', EVENT['ResponseURL'])
+        assert body['Status'] == 'SUCCESS'
+        assert body['Data'] == {'Key': 'Value'}
+
+    def test_retries_transient_errors(self, http):
+        """Test server errors and connection failures are retried."""
+        http.request.side_effect = [
+            mock.Mock(status=503),
+            urllib3.exceptions.ProtocolError('reset'),
+            mock.Mock(status=200),
+        ]
+        assert cfnresponse.send(EVENT, get_context(), cfnresponse.SUCCESS,
+                                {})
+        assert http.request.call_count == 3
+
+    def test_client_errors_are_not_retried(self, http):
+        """Test an expired presigned URL fails without retrying."""
+        http.request.return_value = mock.Mock(status=403)
+        assert not cfnresponse.send(EVENT, get_context(),
+                                    cfnresponse.SUCCESS, {})
+        assert http.request.call_count == 1
+
+    def test_oversized_data_is_dropped(self, http):
+        """Test the body stays under the CloudFormation size limit."""
+        http.request.return_value = mock.Mock(status=200)
+        cfnresponse.send(EVENT, get_context(), cfnresponse.SUCCESS,
+                         {'Big': 'x' * 5000})
+        body = http.request.call_args[1]['body']
+        assert len(body) <= cfnresponse.MAX_RESPONSE_BYTES
+        assert json.loads(body)['Data'] == {}
+
+    def test_retries_end_before_the_lambda_timeout(self, http):
+        """Test attempts stop once the invocation's time is used up."""
+        clock = [0]
+
+        def request(*args, **kwargs):
+            # each attempt takes ten seconds
+            clock[0] += 10
+            return mock.Mock(status=503)
+        http.request.side_effect = request
+        context = get_context()
+        context.get_remaining_time_in_millis.return_value = 20000
+        with mock.patch.object(cfnresponse.time, 'time',
+                               side_effect=lambda: clock[0]):
+            assert not cfnresponse.send(EVENT, context,
+                                        cfnresponse.SUCCESS, {})
+        assert http.request.call_count == 2
+        assert http.request.call_args[1]['timeout'].total == 9.5
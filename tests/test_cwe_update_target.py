@@ -0,0 +1,665 @@
+"""Perform unit test on cwe_update_target.py."""
+
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import boto3
+import mock
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_cloudformation, mock_events, mock_sts
+
+import breaker
+import change_sets
+import cwe_update_target
+import dependencies
+import dispatch_cache
+import stack_cache
+import state_store
+import update_queue
+
+TEMPLATE = json.dumps({
+    'AWSTemplateFormatVersion': '2010-09-09',
+    'Parameters': {
+        'ForceUpdateToggle': {
+            'Type': 'String',
+            'Default': 'A',
+            'AllowedValues': ['A', 'B']
+        },
+        'InstanceType': {'Type': 'String', 'Default': 't2.micro'}
+    },
+    'Resources': {
+        'Queue': {'Type': 'AWS::SQS::Queue'}
+    }
+})
+
+
+def get_descriptor(stack_name):
+    """Return the rule input for a stack."""
+    return {
+        'event_name': 'auto-update-{}'.format(stack_name),
+        'stack_name': stack_name,
+        'toggle_parameter': 'ForceUpdateToggle',
+        'toggle_values': ['A', 'B']
+    }
+
+
+def get_toggle(cfn, stack_name):
+    """Return a stack's current toggle value."""
+    stack = cfn.describe_stacks(StackName=stack_name)['Stacks'][0]
+    return {parameter['ParameterKey']: parameter['ParameterValue']
+            for parameter in stack['Parameters']}['ForceUpdateToggle']
+
+
+@pytest.fixture
+def cfn():
+    """Create mock stacks."""
+    store = mock.patch.object(state_store, 'state_store',
+                              state_store.MemoryStateStore())
+    with mock_cloudformation(), mock_sts(), store:
+        cwe_update_target.elevated_clients.clear()
+        cwe_update_target.stack_cache.clear()
+        cfn = boto3.client('cloudformation')
+        for stack_name in ('stack-a', 'stack-b', 'stack-c'):
+            cfn.create_stack(
+                StackName=stack_name,
+                TemplateBody=TEMPLATE,
+                Parameters=[
+                    {'ParameterKey': 'ForceUpdateToggle',
+                     'ParameterValue': 'A'},
+                    {'ParameterKey': 'InstanceType',
+                     'ParameterValue': 't2.micro'}
+                ]
+            )
+        yield cfn
+
+
+class TestUpdateTargets(object):
+    """Validate single and multi-stack updates."""
+
+    def test_single_stack_event(self, cfn):
+        """Test a rule event updates its stack."""
+        results = cwe_update_target.lambda_handler(
+            get_descriptor('stack-a'), None)
+        assert results == [{'stack_name': 'stack-a', 'status': 'UPDATED',
+                            'error': None}]
+        assert get_toggle(cfn, 'stack-a') == 'B'
+
+    def test_stack_list_event(self, cfn):
+        """Test every stack in a list is updated and reported."""
+        event = {
+            'stacks': [get_descriptor(name)
+                       for name in ('stack-a', 'stack-b', 'stack-c')],
+            'max_workers': 2
+        }
+        results = cwe_update_target.lambda_handler(event, None)
+        assert [result['status'] for result in results] == ['UPDATED'] * 3
+        for name in ('stack-a', 'stack-b', 'stack-c'):
+            assert get_toggle(cfn, name) == 'B'
+
+    def test_one_describe_per_stack(self, cfn):
+        """Test status and parameters come from a single describe."""
+        before = dict(cwe_update_target.stack_cache.stats)
+        cwe_update_target.lambda_handler(get_descriptor('stack-a'), None)
+        stats = cwe_update_target.stack_cache.stats
+        assert stats['misses'] - before['misses'] == 1
+        assert stats['hits'] - before['hits'] == 1
+
+    def test_failures_are_reported_per_stack(self, cfn):
+        """Test one failing stack does not stop the batch."""
+        event = {'stacks': [get_descriptor('missing-stack'),
+                            get_descriptor('stack-b')]}
+        results = cwe_update_target.lambda_handler(event, None)
+        assert results[0]['status'] == 'FAILED'
+        assert results[1]['status'] == 'UPDATED'
+
+
+class TestElevatedClientCache(object):
+    """Validate assumed-role client reuse."""
+
+    def test_reuses_client(self, cfn):
+        """Test warm calls reuse the cached client."""
+        cache = cwe_update_target.ElevatedClientCache(300)
+        role_arn = cwe_update_target.stack_update_arn
+        first = cache.get(role_arn, 3600)
+        assert cache.get(role_arn, 3600) is first
+        assert cache.stats == {'hits': 1, 'misses': 1, 'refreshes': 0}
+
+    def test_refreshes_before_expiry(self, cfn):
+        """Test credentials inside the refresh margin are replaced."""
+        cache = cwe_update_target.ElevatedClientCache(300)
+        role_arn = cwe_update_target.stack_update_arn
+        first = cache.get(role_arn, 3600)
+        cache.entries[role_arn]['expiration'] = (
+            datetime.now(timezone.utc) + timedelta(seconds=60))
+        assert cache.get(role_arn, 3600) is not first
+        assert cache.stats == {'hits': 0, 'misses': 1, 'refreshes': 1}
+
+    def test_roles_are_assumed_in_parallel(self, cfn):
+        """Test assuming one role does not wait on another."""
+        barrier = threading.Barrier(2, timeout=5)
+        assume_role = cwe_update_target.assume_role
+
+        def assume_together(**kwargs):
+            # both calls must be in assume_role at once to pass the barrier
+            barrier.wait()
+            return assume_role(**kwargs)
+        cache = cwe_update_target.ElevatedClientCache(300)
+        role_arns = ['arn:aws:iam::{}:role/StackUpdateRole'.format(account)
+                     for account in ('111111111111', '222222222222')]
+        with mock.patch.object(cwe_update_target, 'assume_role',
+                               side_effect=assume_together), \
+                ThreadPoolExecutor(max_workers=2) as executor:
+            clients = list(executor.map(
+                lambda role_arn: cache.get(role_arn, 3600), role_arns))
+        assert clients[0] is not clients[1]
+        assert cache.stats['misses'] == 2
+
+    def test_batch_assumes_role_once(self, cfn):
+        """Test a batch of stacks shares one assume_role call."""
+        event = {'stacks': [get_descriptor(name)
+                            for name in ('stack-a', 'stack-b', 'stack-c')]}
+        stats = cwe_update_target.elevated_clients.stats
+        before = dict(stats)
+        cwe_update_target.lambda_handler(event, None)
+        assert stats['misses'] - before['misses'] == 1
+        assert stats['hits'] - before['hits'] == 2
+
+
+def create_stack(cfn, stack_name):
+    """Create a stack whose toggle starts at A."""
+    cfn.create_stack(
+        StackName=stack_name,
+        TemplateBody=TEMPLATE,
+        Parameters=[
+            {'ParameterKey': 'ForceUpdateToggle', 'ParameterValue': 'A'},
+            {'ParameterKey': 'InstanceType', 'ParameterValue': 't2.micro'}
+        ]
+    )
+
+
+class TestFanOut(object):
+    """Validate updates across regions and accounts."""
+
+    def test_other_region_stack(self, cfn):
+        """Test a descriptor naming a region updates the stack there."""
+        west = boto3.client('cloudformation', region_name='us-west-2')
+        create_stack(west, 'stack-west')
+        descriptor = dict(get_descriptor('stack-west'), region='us-west-2')
+        results = cwe_update_target.lambda_handler(descriptor, None)
+        assert results[0]['status'] == 'UPDATED'
+        assert get_toggle(west, 'stack-west') == 'B'
+
+    def test_one_assume_role_per_account(self, cfn):
+        """Test each region gets its own client from shared credentials."""
+        cache = cwe_update_target.ElevatedClientCache(300)
+        role_arn = cwe_update_target.stack_update_arn
+        home = cache.get(role_arn, 3600)
+        west = cache.get(role_arn, 3600, 'us-west-2')
+        assert west is not home
+        assert west.meta.region_name == 'us-west-2'
+        assert cache.get(role_arn, 3600, 'us-west-2') is west
+        assert cache.stats == {'hits': 2, 'misses': 1, 'refreshes': 0}
+
+    def test_stack_keys(self):
+        """Test stacks outside the home target get qualified keys."""
+        descriptor = dict(get_descriptor('stack-a'), account_id='210987654321',
+                          region='eu-west-1')
+        key = cwe_update_target.get_stack_key(descriptor)
+        assert key == '210987654321:eu-west-1:stack-a'
+        assert cwe_update_target.get_stack_key(
+            get_descriptor('stack-a')) == 'stack-a'
+        assert cwe_update_target.get_target(descriptor) == (
+            'arn:aws:iam::210987654321:role/StackUpdateRole', 'eu-west-1')
+        assert cwe_update_target.get_key_descriptor(key) == {
+            'account_id': '210987654321', 'region': 'eu-west-1',
+            'stack_name': 'stack-a'}
+
+    def test_batch_interleaves_targets(self, cfn):
+        """Test targets alternate in the pool but results keep order."""
+        west = boto3.client('cloudformation', region_name='us-west-2')
+        for stack_name in ('stack-x', 'stack-y'):
+            create_stack(west, stack_name)
+        stacks = [get_descriptor('stack-a'), get_descriptor('stack-b'),
+                  dict(get_descriptor('stack-x'), region='us-west-2'),
+                  dict(get_descriptor('stack-y'), region='us-west-2')]
+        order = [stack['stack_name'] for _, stack in
+                 cwe_update_target.interleave(
+                     cwe_update_target.group_by_target(stacks))]
+        assert order == ['stack-a', 'stack-x', 'stack-b', 'stack-y']
+        results = cwe_update_target.update_targets(stacks)
+        assert [result['stack_name'] for result in results] == [
+            'stack-a', 'stack-b', 'stack-x', 'stack-y']
+        assert set(result['status'] for result in results) == {'UPDATED'}
+
+
+def set_status(cfn, stack_name, status):
+    """Cache a stack as if it were in another status."""
+    stack = cfn.describe_stacks(StackName=stack_name)['Stacks'][0]
+    stack['StackStatus'] = status
+    cwe_update_target.stack_cache.store(stack)
+
+
+class TestInFlight(object):
+    """Validate state pre-checks and retry slots."""
+
+    def test_busy_stack_is_deferred_without_sts(self, cfn):
+        """Test a busy stack is deferred before assuming the role."""
+        set_status(cfn, 'stack-a', 'UPDATE_IN_PROGRESS')
+        with mock.patch.object(cwe_update_target, 'assume_role') as assume:
+            results = cwe_update_target.lambda_handler(
+                get_descriptor('stack-a'), None)
+        assert results[0]['status'] == 'DEFERRED'
+        assert not assume.called
+        assert get_toggle(cfn, 'stack-a') == 'A'
+
+    def test_deferred_stack_is_retried(self, cfn):
+        """Test a deferred stack joins a later batch once due."""
+        set_status(cfn, 'stack-a', 'UPDATE_IN_PROGRESS')
+        cwe_update_target.lambda_handler(get_descriptor('stack-a'), None)
+        cwe_update_target.stack_cache.clear()
+        retries = cwe_update_target.tracker.pop_due_retries(float('inf'))
+        results = cwe_update_target.update_targets(
+            [get_descriptor('stack-b')] + retries)
+        assert [result['status'] for result in results] == [
+            'UPDATED', 'UPDATED']
+        assert get_toggle(cfn, 'stack-a') == 'B'
+
+    def test_recover_tick_retries_deferred(self, cfn):
+        """Test a due retry slot is taken without another rule firing."""
+        set_status(cfn, 'stack-a', 'UPDATE_IN_PROGRESS')
+        with mock.patch.object(cwe_update_target.tracker, 'delay', 0):
+            cwe_update_target.lambda_handler(get_descriptor('stack-a'), None)
+        cwe_update_target.stack_cache.clear()
+        with mock_events():
+            cwe_update_target.lambda_handler({'recover': True}, None)
+        assert get_toggle(cfn, 'stack-a') == 'B'
+        assert cwe_update_target.tracker.retrying() == []
+
+    def test_failed_stack_is_skipped(self, cfn):
+        """Test a stack that cannot be updated is skipped."""
+        set_status(cfn, 'stack-a', 'UPDATE_ROLLBACK_FAILED')
+        results = cwe_update_target.lambda_handler(
+            get_descriptor('stack-a'), None)
+        assert results[0] == {'stack_name': 'stack-a', 'status': 'SKIPPED',
+                              'error': 'UPDATE_ROLLBACK_FAILED'}
+
+    def test_file_store_survives_reload(self, tmpdir):
+        """Test the file store reloads earlier state."""
+        path = str(tmpdir.join('state.json'))
+        state_store.FileStateStore(path).set('inflight:stack', 1.0)
+        assert state_store.FileStateStore(path).items('inflight:') == [
+            ('inflight:stack', 1.0)]
+
+
+def get_mismatched_descriptor(stack_name):
+    """Return a rule input whose toggle values miss the stack's value."""
+    return dict(get_descriptor(stack_name), toggle_values=['B', 'C'])
+
+
+class TestBreaker(object):
+    """Validate failure backoff and the per-stack breaker."""
+
+    def test_failing_stack_backs_off(self, cfn):
+        """Test a failed stack is not retried before its backoff ends."""
+        descriptor = get_mismatched_descriptor('stack-a')
+        results = cwe_update_target.update_targets([descriptor])
+        assert results[0]['status'] == 'FAILED'
+        with mock.patch.object(cwe_update_target, 'get_stack') as get_stack:
+            results = cwe_update_target.update_targets([descriptor])
+        assert results[0]['status'] == 'BACKOFF'
+        assert not get_stack.called
+
+    def test_breaker_disables_and_recovers_rule(self, cfn):
+        """Test repeated failures disable the rule until the stack heals."""
+        descriptor = get_mismatched_descriptor('stack-a')
+        with mock_events(), mock.patch.multiple(
+                breaker.breaker, base=0, threshold=2):
+            events = boto3.client('events')
+            events.put_rule(Name=descriptor['event_name'],
+                            ScheduleExpression='rate(1 day)')
+            for _ in range(2):
+                cwe_update_target.update_targets([descriptor])
+            assert events.describe_rule(
+                Name=descriptor['event_name'])['State'] == 'DISABLED'
+
+            # the stack still holds a value the rule cannot toggle
+            assert cwe_update_target.lambda_handler(
+                {'recover': True}, None) == []
+            cfn.update_stack(
+                StackName='stack-a', UsePreviousTemplate=True, Parameters=[
+                    {'ParameterKey': 'ForceUpdateToggle',
+                     'ParameterValue': 'B'},
+                    {'ParameterKey': 'InstanceType',
+                     'UsePreviousValue': True}])
+            assert cwe_update_target.lambda_handler(
+                {'recover': True}, None) == ['stack-a']
+            assert events.describe_rule(
+                Name=descriptor['event_name'])['State'] == 'ENABLED'
+            assert breaker.breaker.open_breakers() == []
+
+    def test_failures_add_up_across_environments(self, state_table):
+        """Test failures seen by different environments open the breaker."""
+        descriptor = dict(get_descriptor('stack-a'), dispatched=True)
+        with mock.patch.object(breaker.breaker, 'threshold', 2):
+            for _ in range(2):
+                with mock.patch.object(
+                        state_store, 'state_store',
+                        state_store.DynamoDBStateStore(state_table)):
+                    breaker.breaker.failed(descriptor, 'stack-a', 'boom')
+        with mock.patch.object(state_store, 'state_store',
+                               state_store.DynamoDBStateStore(state_table)):
+            assert breaker.breaker.open_breakers() == ['stack-a']
+
+    def test_tripped_rule_recovers_without_its_state(self, cfn):
+        """Test recover finds breaker-disabled rules through list_rules."""
+        descriptor = get_mismatched_descriptor('stack-a')
+        with mock_events(), mock.patch.multiple(
+                breaker.breaker, base=0, threshold=1):
+            events = boto3.client('events')
+            for rule_input in (descriptor, get_descriptor('stack-b')):
+                events.put_rule(Name=rule_input['event_name'],
+                                ScheduleExpression='rate(1 day)')
+                events.put_targets(Rule=rule_input['event_name'], Targets=[{
+                    'Id': 'updater', 'Arn': 'arn:aws:lambda:us-east-1:'
+                    '123456789012:function:updater',
+                    'Input': json.dumps(rule_input)}])
+            # stack-b's rule was disabled by hand, not by the breaker
+            events.disable_rule(Name='auto-update-stack-b')
+            cwe_update_target.update_targets([descriptor])
+            # the failure state is lost, e.g. with a recycled container
+            state_store.state_store.delete('failures:stack-a')
+
+            cfn.update_stack(
+                StackName='stack-a', UsePreviousTemplate=True, Parameters=[
+                    {'ParameterKey': 'ForceUpdateToggle',
+                     'ParameterValue': 'B'},
+                    {'ParameterKey': 'InstanceType',
+                     'UsePreviousValue': True}])
+            assert cwe_update_target.lambda_handler(
+                {'recover': True}, None) == ['stack-a']
+            states = {rule['Name']: rule['State'] for rule in
+                      events.list_rules(NamePrefix='auto-update-')['Rules']}
+            assert states == {'auto-update-stack-a': 'ENABLED',
+                              'auto-update-stack-b': 'DISABLED'}
+
+
+def get_staged_descriptor(stack_name):
+    """Return a dispatched stack's descriptor for a scheduled run."""
+    return dict(get_descriptor(stack_name), dispatched=True,
+                scheduled_at=1514764800)
+
+
+def get_change_set(cfn, stack_name, toggle_value, age=0):
+    """Return a complete change set created some seconds after the stack.
+
+    moto cannot create change sets with UsePreviousTemplate, so these
+    tests serve describe_change_set themselves.
+    """
+    stack = cfn.describe_stacks(StackName=stack_name)['Stacks'][0]
+    return {
+        'Status': 'CREATE_COMPLETE',
+        'ExecutionStatus': 'AVAILABLE',
+        'CreationTime': stack['CreationTime'] + timedelta(seconds=age),
+        'Parameters': [{'ParameterKey': 'ForceUpdateToggle',
+                        'ParameterValue': toggle_value}],
+    }
+
+
+@pytest.fixture
+def staged():
+    """Replace the change set calls and enable two-phase updates."""
+    calls = mock.patch.multiple(
+        change_sets, use_change_sets=True, describe=mock.DEFAULT,
+        stage=mock.DEFAULT, delete=mock.DEFAULT, execute=mock.DEFAULT)
+    with calls as mocks:
+        yield mocks
+
+
+class TestChangeSets(object):
+    """Validate two-phase updates through staged change sets."""
+
+    def test_stage_creates_then_keeps(self, cfn, staged):
+        """Test staging creates a change set once it is missing."""
+        descriptor = get_staged_descriptor('stack-a')
+        staged['describe'].return_value = None
+        assert cwe_update_target.stage_change_set(descriptor) == 'staged'
+        update_input = staged['stage'].call_args[0][1]
+        assert update_input['Parameters'][0] == {
+            'ParameterKey': 'ForceUpdateToggle', 'ParameterValue': 'B'}
+        assert staged['stage'].call_args[0][2] == \
+            'auto-update-1514764800'
+        staged['describe'].return_value = get_change_set(
+            cfn, 'stack-a', 'B', 1)
+        assert cwe_update_target.stage_change_set(descriptor) == 'kept'
+        staged['describe'].return_value = get_change_set(
+            cfn, 'stack-a', 'A', 1)
+        assert cwe_update_target.stage_change_set(descriptor) == 'rebuilt'
+        assert staged['delete'].called
+
+    def test_staged_change_set_is_executed(self, cfn, staged):
+        """Test the window executes the change set staged ahead of it."""
+        staged['describe'].return_value = get_change_set(
+            cfn, 'stack-a', 'B', 1)
+        with mock.patch.object(cwe_update_target,
+                               'assumed_role_update_stack') as update:
+            results = cwe_update_target.update_targets(
+                [get_staged_descriptor('stack-a')])
+        assert results[0]['status'] == 'UPDATED'
+        assert staged['execute'].called
+        assert not update.called
+
+    def test_stale_change_set_is_dropped(self, cfn, staged):
+        """Test a stack updated since staging falls back to update_stack."""
+        staged['describe'].return_value = get_change_set(
+            cfn, 'stack-a', 'B', -1)
+        results = cwe_update_target.update_targets(
+            [get_staged_descriptor('stack-a')])
+        assert results[0]['status'] == 'UPDATED'
+        assert staged['delete'].called
+        assert not staged['execute'].called
+        assert get_toggle(cfn, 'stack-a') == 'B'
+
+
+class TestOrderedRollout(object):
+    """Validate dependency-ordered rollouts."""
+
+    def test_levels_wait_for_producers(self, cfn):
+        """Test a level only starts once the one before it has finished."""
+        producers = {'stack-a': set(), 'stack-b': {'stack-a'},
+                     'stack-c': {'stack-a'}}
+        stacks = [get_descriptor(stack_name)
+                  for stack_name in ('stack-c', 'stack-b', 'stack-a')]
+        with mock.patch.object(dependencies, 'get_producers',
+                               return_value=producers):
+            progress = cwe_update_target.lambda_handler(
+                {'rollout': stacks}, None)
+        assert progress['level'] == 0
+        assert [result['stack_name'] for result in progress['results']] == [
+            'stack-a']
+
+        with mock.patch.object(stack_cache, 'call',
+                               side_effect=describe_in_progress('stack-a')):
+            assert cwe_update_target.lambda_handler(
+                {'advance': True}, None) == {'level': 0,
+                                             'waiting': ['stack-a']}
+        assert get_toggle(cfn, 'stack-b') == 'A'
+
+        progress = cwe_update_target.lambda_handler({'advance': True}, None)
+        assert [result['stack_name'] for result in progress['results']] == [
+            'stack-b', 'stack-c']
+        assert cwe_update_target.lambda_handler({'advance': True}, None) == {
+            'level': 2, 'finished': True}
+        assert cwe_update_target.advance_ordered_rollout() is None
+        assert not list(state_store.get_state_store().items('ordered-'))
+
+    def test_only_the_current_level_is_retried(self, cfn):
+        """Test a later level's due retry waits for its own level."""
+        producers = {'stack-a': set(), 'stack-b': {'stack-a'},
+                     'stack-c': {'stack-a'}}
+        stacks = [get_descriptor(stack_name)
+                  for stack_name in ('stack-c', 'stack-b', 'stack-a')]
+        set_status(cfn, 'stack-a', 'UPDATE_IN_PROGRESS')
+        tracker = cwe_update_target.tracker
+        with mock.patch.object(tracker, 'delay', 0), \
+                mock.patch.object(dependencies, 'get_producers',
+                                  return_value=producers):
+            progress = cwe_update_target.start_ordered_rollout(stacks)
+            tracker.defer(get_descriptor('stack-c'), 'stack-c')
+        assert progress['results'][0]['status'] == 'DEFERRED'
+        cwe_update_target.stack_cache.clear()
+
+        with mock.patch.object(cwe_update_target, 'is_updating',
+                               return_value=True):
+            assert cwe_update_target.advance_ordered_rollout() == {
+                'level': 0, 'waiting': ['stack-a']}
+        assert get_toggle(cfn, 'stack-a') == 'B'
+        assert get_toggle(cfn, 'stack-c') == 'A'
+        assert tracker.retrying() == ['stack-c']
+
+    def test_plan_is_shared_between_environments(self, cfn, state_table):
+        """Test another environment advances the plan, and only once."""
+        producers = {'stack-a': set(), 'stack-b': {'stack-a'}}
+        stacks = [get_descriptor(stack_name)
+                  for stack_name in ('stack-b', 'stack-a')]
+        with mock.patch.object(state_store, 'state_store',
+                               state_store.DynamoDBStateStore(state_table)), \
+                mock.patch.object(dependencies, 'get_producers',
+                                  return_value=producers):
+            cwe_update_target.start_ordered_rollout(stacks)
+        other = state_store.DynamoDBStateStore(state_table)
+        plan = other.get(cwe_update_target.ORDERED_ROLLOUT_KEY)
+        assert plan == {'levels': 2, 'level': 0}
+        assert other.get(cwe_update_target.ORDERED_LEVEL_KEY.format(1)) == [
+            get_descriptor('stack-b')]
+
+        # a slower tick read the same plan before this one advanced it
+        with mock.patch.object(state_store, 'state_store', other):
+            progress = cwe_update_target.advance_ordered_rollout()
+            assert progress['level'] == 1
+            assert not other.replace(cwe_update_target.ORDERED_ROLLOUT_KEY,
+                                     plan, dict(plan, level=1))
+        assert get_toggle(cfn, 'stack-b') == 'B'
+
+
+def get_delivery(stack_name, scheduled_time='2018-01-01T00:00:00Z'):
+    """Return a rule delivery for a scheduled run."""
+    return dict(get_descriptor(stack_name), scheduled_time=scheduled_time)
+
+
+class TestDispatchDedupe(object):
+    """Validate that repeated deliveries of a run update once."""
+
+    def test_repeated_delivery_updates_once(self, cfn):
+        """Test a second delivery of a run makes no api calls."""
+        update_stack = mock.patch.object(
+            cwe_update_target, 'update_stack',
+            wraps=cwe_update_target.update_stack)
+        with update_stack as update:
+            results = cwe_update_target.update_targets(
+                [get_delivery('stack-a')])
+        assert results[0]['status'] == 'UPDATED'
+        token = update.call_args[1]['ClientRequestToken']
+        assert token == dispatch_cache.get_dispatch_key(
+            get_delivery('stack-a'))
+
+        with mock.patch.object(cwe_update_target, 'get_stack') as get_stack:
+            results = cwe_update_target.update_targets(
+                [get_delivery('stack-a')])
+        assert results[0]['status'] == 'DUPLICATE'
+        assert not get_stack.called
+        assert get_toggle(cfn, 'stack-a') == 'B'
+
+        # moto rejects a second toggle flip; only the dedupe is under test
+        cwe_update_target.stack_cache.clear()
+        with mock.patch.object(cwe_update_target,
+                               'assumed_role_update_stack'):
+            results = cwe_update_target.update_targets(
+                [get_delivery('stack-a', '2018-01-02T00:00:00Z')])
+        assert results[0]['status'] == 'UPDATED'
+
+    def test_reused_token_is_a_duplicate(self, cfn):
+        """Test a run another delivery started is not counted as failed."""
+        error = ClientError({'Error': {
+            'Code': 'TokenAlreadyExistsException',
+            'Message': 'ClientRequestToken already exists'}}, 'UpdateStack')
+        with mock.patch.object(cwe_update_target,
+                               'assumed_role_update_stack',
+                               side_effect=error):
+            results = cwe_update_target.update_targets(
+                [get_delivery('stack-a')])
+        assert results[0]['status'] == 'DUPLICATE'
+        assert breaker.breaker.allows('stack-a')
+
+    def test_expired_keys_are_evicted(self, cfn):
+        """Test keys are forgotten once their TTL has passed."""
+        cache = dispatch_cache.DispatchCache(60)
+        cache.record('run', now=1000)
+        assert cache.seen('run', now=1030)
+        assert not cache.seen('run', now=2000)
+        assert state_store.state_store.items('dispatch:') == []
+
+
+def describe_in_progress(stack_name):
+    """Return a call() stand-in that shows a stack mid-update."""
+    call = stack_cache.call
+
+    def describe(client, method_name, **kwargs):
+        response = call(client, method_name, **kwargs)
+        if kwargs.get('StackName') == stack_name:
+            response['Stacks'][0]['StackStatus'] = 'UPDATE_IN_PROGRESS'
+        return response
+    return describe
+
+
+@pytest.fixture
+def queue(cfn):
+    """Buffer updates in a fresh in-memory queue."""
+    memory_queue = update_queue.MemoryQueue(300)
+    with mock.patch.multiple(update_queue, update_queue_type='memory',
+                             update_queue=memory_queue):
+        yield memory_queue
+
+
+class TestUpdateQueue(object):
+    """Validate queued updates and the concurrency cap."""
+
+    def test_rule_event_is_queued(self, cfn, queue):
+        """Test a rule event queues its stack until the queue drains."""
+        results = cwe_update_target.lambda_handler(
+            get_descriptor('stack-a'), None)
+        assert results[0]['status'] == 'QUEUED'
+        assert get_toggle(cfn, 'stack-a') == 'A'
+
+        results = cwe_update_target.lambda_handler({'drain': True}, None)
+        assert results[0]['status'] == 'UPDATED'
+        assert get_toggle(cfn, 'stack-a') == 'B'
+        assert len(queue) == 0
+
+    def test_duplicate_intents_update_once(self, cfn, queue):
+        """Test several intents for one stack cause a single update."""
+        queue.send([get_descriptor('stack-a'), get_descriptor('stack-b'),
+                    get_descriptor('stack-a')])
+        results = cwe_update_target.drain_queue()
+        assert sorted(result['stack_name'] for result in results) == [
+            'stack-a', 'stack-b']
+        assert get_toggle(cfn, 'stack-a') == 'B'
+        assert len(queue) == 0
+
+    def test_in_progress_updates_are_capped(self, cfn, queue):
+        """Test draining stops at max_in_progress updates."""
+        # started from another environment, so cached here as idle
+        set_status(cfn, 'stack-c', 'UPDATE_COMPLETE')
+        cwe_update_target.tracker.started('stack-c')
+        queue.send([get_descriptor('stack-a'), get_descriptor('stack-b')])
+
+        with mock.patch.object(stack_cache, 'call',
+                               side_effect=describe_in_progress('stack-c')):
+            with mock.patch.object(cwe_update_target, 'max_in_progress', 1):
+                assert cwe_update_target.drain_queue() == []
+            with mock.patch.object(cwe_update_target, 'max_in_progress', 2):
+                results = cwe_update_target.drain_queue()
+        assert [result['stack_name'] for result in results] == ['stack-a']
+        assert len(queue) == 1
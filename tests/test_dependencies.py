@@ -0,0 +1,44 @@
+"""Perform unit test on dependencies.py."""
+
+import mock
+
+import dependencies
+
+
+class TestLevels(object):
+    """Validate dependency levels."""
+
+    def test_producers_come_first(self):
+        """Test each stack lands in a level after its producers."""
+        producers = {'app': {'network', 'database'}, 'database': {'network'},
+                     'network': set(), 'monitoring': set()}
+        assert dependencies.get_levels(producers) == [
+            ['monitoring', 'network'], ['database'], ['app']]
+
+    def test_cycle_shares_last_level(self):
+        """Test stacks in an import cycle still get updated."""
+        producers = {'a': {'b'}, 'b': {'a'}, 'c': set()}
+        assert dependencies.get_levels(producers) == [['c'], ['a', 'b']]
+
+
+class TestProducers(object):
+    """Validate reading producers from exports and imports."""
+
+    def test_only_batch_stacks_count(self):
+        """Test exports and imports outside the batch are ignored."""
+        exports = {'vpc-id': 'network', 'zone-id': 'dns', 'db-url': 'db'}
+        imports = {'vpc-id': ['db', 'app', 'other'], 'zone-id': ['app'],
+                   'db-url': ['app']}
+        with mock.patch.multiple(
+                dependencies, list_exports=lambda client: exports,
+                list_importers=lambda client, name: imports[name]):
+            producers = dependencies.get_producers(
+                None, {'network', 'db', 'app'}, 2)
+        assert producers == {'network': set(), 'db': {'network'},
+                             'app': {'network', 'db'}}
+
+    def test_stack_name_from_id(self):
+        """Test the stack name is read from an exporting stack id."""
+        assert dependencies.get_stack_name(
+            'arn:aws:cloudformation:us-east-1:123456789012:stack/network/'
+            '1a2b3c4d') == 'network'
@@ -0,0 +1,123 @@
+"""Perform unit test on fingerprint.py."""
+
+import json
+
+import boto3
+import mock
+import pytest
+from moto import mock_cloudformation, mock_dynamodb, mock_ssm, mock_sts
+
+import cwe_update_target
+import fingerprint
+import schedule_table
+import state_store
+
+TEMPLATE = json.dumps({
+    'Parameters': {
+        'ForceUpdateToggle': {'Type': 'String', 'Default': 'A',
+                              'AllowedValues': ['A', 'B']},
+    },
+    'Resources': {'Queue': {'Type': 'AWS::SQS::Queue'}},
+})
+
+INPUTS = {'SsmParameters': ['/app/release'], 'StackParameters': 'false'}
+
+
+def get_descriptor(stack_name):
+    """Return a rule input that gates on the release parameter."""
+    return {
+        'event_name': 'auto-update-{}'.format(stack_name),
+        'stack_name': stack_name,
+        'toggle_parameter': 'ForceUpdateToggle',
+        'toggle_values': ['A', 'B'],
+        'fingerprint_inputs': INPUTS,
+    }
+
+
+@pytest.fixture
+def aws():
+    """Create a stack, the release parameter and the schedule table."""
+    store = mock.patch.object(state_store, 'state_store',
+                              state_store.MemoryStateStore())
+    with mock_cloudformation(), mock_sts(), mock_ssm(), mock_dynamodb(), \
+            store:
+        cwe_update_target.elevated_clients.clear()
+        cwe_update_target.stack_cache.clear()
+        fingerprint.resolver.clear()
+        boto3.client('dynamodb').create_table(
+            TableName=schedule_table.table_name,
+            AttributeDefinitions=[
+                {'AttributeName': 'stack_name', 'AttributeType': 'S'}],
+            KeySchema=[{'AttributeName': 'stack_name', 'KeyType': 'HASH'}],
+            BillingMode='PAY_PER_REQUEST')
+        ssm = boto3.client('ssm')
+        ssm.put_parameter(Name='/app/release', Value='1.0', Type='String')
+        boto3.client('cloudformation').create_stack(
+            StackName='stack-a', TemplateBody=TEMPLATE, Parameters=[
+                {'ParameterKey': 'ForceUpdateToggle',
+                 'ParameterValue': 'A'}])
+        yield ssm
+
+
+def update(stack_name):
+    """Run the updater for a gated stack and return its status."""
+    cwe_update_target.stack_cache.clear()
+    fingerprint.resolver.clear()
+    # moto rejects a second toggle flip, and only the gating is under test
+    with mock.patch.object(cwe_update_target, 'assumed_role_update_stack'):
+        return cwe_update_target.update_target(
+            get_descriptor(stack_name))['status']
+
+
+class TestGating(object):
+    """Validate that stacks only roll when their inputs change."""
+
+    def test_skips_unchanged_inputs(self, aws):
+        """Test a second tick with the same inputs does not update."""
+        assert update('stack-a') == 'UPDATED'
+        assert update('stack-a') == 'UNCHANGED'
+
+    def test_updates_changed_inputs(self, aws):
+        """Test a new parameter value rolls the stack again."""
+        assert update('stack-a') == 'UPDATED'
+        aws.put_parameter(Name='/app/release', Value='1.1', Type='String',
+                          Overwrite=True)
+        assert update('stack-a') == 'UPDATED'
+        assert update('stack-a') == 'UNCHANGED'
+
+    def test_failed_update_is_not_applied(self, aws):
+        """Test a rolled back update is retried with the same inputs."""
+        assert update('stack-a') == 'UPDATED'
+        stack = {'StackName': 'stack-a',
+                 'StackStatus': 'UPDATE_ROLLBACK_COMPLETE'}
+        assert not fingerprint.is_applied(
+            stack, fingerprint.get_fingerprint(stack, INPUTS))
+
+
+class TestInputs(object):
+    """Validate input resolution."""
+
+    def test_stack_ssm_parameters(self):
+        """Test SSM-typed stack parameters are included by default."""
+        stack = {'Parameters': [
+            {'ParameterKey': 'ImageId', 'ParameterValue': '/app/ami',
+             'ResolvedValue': 'ami-12345678'},
+            {'ParameterKey': 'Size', 'ParameterValue': 'large'},
+        ]}
+        assert fingerprint.get_ssm_parameter_names(stack, {}) == ['/app/ami']
+        assert fingerprint.get_ssm_parameter_names(
+            stack, {'StackParameters': 'false'}) == []
+
+    def test_latest_image_is_shared(self):
+        """Test the newest image wins and the lookup is reused."""
+        resolver = fingerprint.InputResolver(60)
+        images = {'Images': [
+            {'ImageId': 'ami-old', 'CreationDate': '2018-01-01T00:00:00Z'},
+            {'ImageId': 'ami-new', 'CreationDate': '2018-06-01T00:00:00Z'},
+        ]}
+        query = {'Owners': ['amazon']}
+        with mock.patch.object(fingerprint, 'call',
+                               return_value=images) as describe:
+            assert resolver.get_latest_image(query) == 'ami-new'
+            assert resolver.get_latest_image(query) == 'ami-new'
+        assert describe.call_count == 1
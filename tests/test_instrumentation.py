@@ -0,0 +1,117 @@
+"""Perform unit test on instrumentation.py."""
+
+import json
+
+import boto3
+import mock
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+from botocore.stub import Stubber
+
+import aws_clients
+import instrumentation
+
+
+@pytest.fixture(autouse=True)
+def fresh_recorder():
+    """Start each test with empty figures."""
+    instrumentation.recorder.drain()
+    aws_clients.call_stats.reset()
+    with mock.patch.object(aws_clients.time, 'sleep'):
+        yield
+
+
+def get_stubbed_client():
+    """Return an instrumented CloudFormation client and its stubber."""
+    client = instrumentation.instrument(
+        boto3.client('cloudformation', config=aws_clients.CLIENT_CONFIG))
+    return client, Stubber(client)
+
+
+class TestInstrument(object):
+    """Validate the botocore hooks."""
+
+    def test_records_latency_and_errors(self):
+        """Test successful and failed calls are both recorded."""
+        client, stubber = get_stubbed_client()
+        stubber.add_response('describe_stacks', {'Stacks': []})
+        stubber.add_client_error('describe_stacks', 'ValidationError')
+        with stubber:
+            client.describe_stacks()
+            with pytest.raises(ClientError):
+                client.describe_stacks()
+
+        figures = instrumentation.recorder.drain()[
+            ('cloudformation', 'DescribeStacks')]
+        assert figures['calls'] == 2
+        assert len(figures['latencies']) == 2
+        assert figures['errors'] == {'ValidationError': 1}
+
+    def test_instrument_is_idempotent(self):
+        """Test instrumenting a client twice records each call once."""
+        client, stubber = get_stubbed_client()
+        instrumentation.instrument(client)
+        stubber.add_response('describe_stacks', {'Stacks': []})
+        with stubber:
+            client.describe_stacks()
+
+        figures = instrumentation.recorder.drain()[
+            ('cloudformation', 'DescribeStacks')]
+        assert figures['calls'] == 1
+
+
+    def test_connection_errors_are_recorded_and_retried(self):
+        """Test a call that never reaches AWS keeps its real error."""
+        client = instrumentation.instrument(boto3.client(
+            'cloudformation', config=aws_clients.CLIENT_CONFIG,
+            region_name='us-east-1', endpoint_url='http://127.0.0.1:1',
+            aws_access_key_id='testing', aws_secret_access_key='testing'))
+        with pytest.raises(EndpointConnectionError):
+            aws_clients.call(client, 'describe_stacks')
+
+        figures = instrumentation.recorder.drain()[
+            ('cloudformation', 'DescribeStacks')]
+        assert figures['errors'] == {
+            'EndpointConnectionError': aws_clients.MAX_ATTEMPTS}
+        assert aws_clients.call_stats.snapshot()[
+            'cloudformation:describe_stacks']['retries'] == \
+            aws_clients.MAX_ATTEMPTS - 1
+
+
+class TestFlushMetrics(object):
+    """Validate the EMF summary."""
+
+    def test_merges_call_layer_counters(self, capsys):
+        """Test throttles and retries from call() reach the summary."""
+        client, stubber = get_stubbed_client()
+        stubber.add_client_error('update_stack', 'Throttling')
+        stubber.add_response('update_stack', {'StackId': 'stack-id'})
+        with stubber:
+            aws_clients.call(client, 'update_stack', StackName='stack')
+
+        documents = aws_clients.flush_metrics()
+        assert len(documents) == 1
+        document = documents[0]
+        assert document['Operation'] == 'UpdateStack'
+        assert document['Calls'] == 2
+        assert document['Throttles'] == 1
+        assert document['Retries'] == 1
+        assert document['ErrorCodes'] == {'Throttling': 1}
+        assert json.loads(capsys.readouterr().out) == document
+        assert aws_clients.call_stats.snapshot() == {}
+        assert aws_clients.flush_metrics() == []
+
+    def test_splits_large_latency_lists(self):
+        """Test no document carries more than MAX_VALUES latencies."""
+        for _ in range(instrumentation.MAX_VALUES + 1):
+            instrumentation.recorder.record('cloudformation',
+                                            'DescribeStacks', 0.01)
+
+        documents = instrumentation.get_documents(
+            instrumentation.recorder.drain(), timestamp=1)
+        assert [len(document['Latency']) for document in documents] == [
+            instrumentation.MAX_VALUES, 1]
+        assert documents[0]['Calls'] == instrumentation.MAX_VALUES + 1
+        assert 'Calls' not in documents[1]
+        assert documents[1]['_aws']['CloudWatchMetrics'][0]['Metrics'] == [
+            {'Name': 'Latency', 'Unit': 'Milliseconds'}]
@@ -0,0 +1,136 @@
+"""Perform unit test on reconcile.py."""
+
+import io
+import json
+import zipfile
+
+import boto3
+import pytest
+from mock import patch
+from moto import (mock_cloudformation, mock_events, mock_iam, mock_lambda,
+                  mock_sts)
+
+import cfn_auto_update_broker
+import reconcile
+
+TEMPLATE = json.dumps({'Resources': {'Queue': {'Type': 'AWS::SQS::Queue'}}})
+
+
+def get_zip_file():
+    """Return a zipped handler for the mock update function."""
+    zip_output = io.BytesIO()
+    with zipfile.ZipFile(zip_output, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('lambda_function.py',
+                          'def lambda_handler(event, context):\n'
+                          '    return event\n')
+    return zip_output.getvalue()
+
+
+def add_rule(stack_name, arn, permission=True):
+    """Create a stack's rule with one target and, optionally, permission."""
+    event_obj = cfn_auto_update_broker.CloudwatchEvent(
+        stack_name, 'rate(1 day)', 'ForceUpdateToggle', ['A', 'B'])
+    events = boto3.client('events')
+    events.put_rule(**event_obj.rule_text)
+    events.put_targets(Rule=event_obj.name, Targets=[{
+        'Id': event_obj.target_function_name, 'Arn': arn,
+        'Input': json.dumps(event_obj.event_constant)}])
+    if permission:
+        add_permission(event_obj.name)
+    return event_obj.name
+
+
+def add_permission(rule_name):
+    """Let a rule invoke the update function."""
+    boto3.client('lambda').add_permission(
+        **cfn_auto_update_broker.AWSLambda(rule_name).add_permission_input)
+
+
+def get_statement_ids():
+    """Return the statement ids of the update function's policy."""
+    policy = boto3.client('lambda').get_policy(
+        FunctionName=cfn_auto_update_broker.function_name)['Policy']
+    return sorted(statement['Sid']
+                  for statement in json.loads(policy)['Statement'])
+
+
+@pytest.fixture
+def fleet():
+    """Create one healthy rule and three kinds of drift."""
+    with mock_sts(), mock_events(), mock_lambda(), mock_iam(), \
+            mock_cloudformation(), \
+            patch.multiple(cfn_auto_update_broker, account_id=None,
+                           function_arn=None):
+        cfn_auto_update_broker.policy_cache.clear()
+        role = boto3.client('iam').create_role(
+            RoleName='lambda-role', AssumeRolePolicyDocument='{}',
+            Path='/')['Role']['Arn']
+        function_arn = boto3.client('lambda').create_function(
+            FunctionName=cfn_auto_update_broker.function_name,
+            Runtime='python3.9', Role=role,
+            Handler='lambda_function.lambda_handler',
+            Code={'ZipFile': get_zip_file()})['FunctionArn']
+        cfn = boto3.client('cloudformation')
+        for stack_name in ('live', 'moved'):
+            cfn.create_stack(StackName=stack_name, TemplateBody=TEMPLATE)
+        add_rule('live', function_arn)
+        add_rule('gone', function_arn)
+        add_rule('moved', function_arn.replace('cwe_update', 'old_update'),
+                 permission=False)
+        add_permission('auto-update-deleted-long-ago')
+        yield function_arn
+
+
+class TestReconcile(object):
+    """Validate the reconciliation sweep."""
+
+    def test_dry_run_reports_drift(self, fleet):
+        """Test a dry run reports every difference and changes nothing."""
+        before = get_statement_ids()
+        report = reconcile.reconcile(dry_run=True)
+        assert report['rules'] == 3
+        assert report['orphaned_rules'] == ['auto-update-gone']
+        assert report['stale_targets'] == {
+            'auto-update-moved': [cfn_auto_update_broker.function_name]}
+        assert list(report['retargeted_rules']) == ['auto-update-moved']
+        assert report['missing_permissions'] == ['auto-update-moved']
+        assert report['orphaned_permissions'] == sorted(
+            cfn_auto_update_broker.AWSLambda(rule_name).statement_id
+            for rule_name in ('auto-update-deleted-long-ago',
+                              'auto-update-gone'))
+        assert get_statement_ids() == before
+
+    def test_sweep_repairs_drift(self, fleet):
+        """Test a sweep leaves only rules that fire the update function."""
+        report = reconcile.reconcile()
+        assert report['errors'] == []
+        events = boto3.client('events')
+        assert sorted(rule['Name'] for rule in events.list_rules(
+            NamePrefix='auto-update-')['Rules']) == [
+            'auto-update-live', 'auto-update-moved']
+        target = events.list_targets_by_rule(
+            Rule='auto-update-moved')['Targets'][0]
+        assert target['Arn'] == fleet
+        assert reconcile.get_rule_input([target])['stack_name'] == 'moved'
+        assert target['InputTransformer']['InputPathsMap'] == {
+            'time': '$.time'}
+        assert get_statement_ids() == sorted(
+            cfn_auto_update_broker.AWSLambda(rule_name).statement_id
+            for rule_name in ('auto-update-live', 'auto-update-moved'))
+
+        # a second sweep finds nothing left to do
+        report = reconcile.reconcile()
+        assert report['orphaned_rules'] == []
+        assert report['stale_targets'] == {}
+        assert report['missing_permissions'] == []
+        assert report['orphaned_permissions'] == []
+
+    def test_shared_policy_replaces_statements(self, fleet):
+        """Test a sweep in the shared policy mode migrates the statements."""
+        with patch.object(cfn_auto_update_broker, 'policy_mode', 'shared'):
+            report = reconcile.reconcile()
+            shared_id = cfn_auto_update_broker.AWSLambda(
+                'auto-update-live').statement_id
+        assert report['errors'] == []
+        assert len(report['missing_permissions']) == 1
+        assert get_statement_ids() == [shared_id]
@@ -0,0 +1,147 @@
+"""Perform unit test on rollouts.py."""
+
+from datetime import datetime, timezone
+
+import mock
+import pytest
+
+import rollouts
+import state_store
+
+STACK = 'stack-a'
+
+
+def get_event(event_id, seconds, status, logical_id=STACK,
+              resource_type=rollouts.STACK_RESOURCE_TYPE):
+    """Return a stack event some seconds after the epoch."""
+    return {
+        'EventId': event_id,
+        'Timestamp': datetime.fromtimestamp(seconds, timezone.utc),
+        'ResourceStatus': status,
+        'LogicalResourceId': logical_id,
+        'ResourceType': resource_type,
+    }
+
+
+class FakeEvents(object):
+    """Serve stack events newest first, two per page."""
+
+    def __init__(self):
+        self.events = []
+        self.read = 0
+
+    def add(self, *events):
+        """Add events in the order they happened."""
+        self.events = list(events)[::-1] + self.events
+
+    def paginate(self, client, method_name, StackName):
+        """Yield the pages of describe_stack_events."""
+        for index in range(0, len(self.events), 2):
+            page = self.events[index:index + 2]
+            self.read += len(page)
+            yield {'StackEvents': page}
+
+
+@pytest.fixture
+def tracked():
+    """Follow one update started a few seconds after the epoch."""
+    fake = FakeEvents()
+    with mock.patch.object(state_store, 'state_store',
+                           state_store.MemoryStateStore()), \
+            mock.patch.multiple(rollouts, track_rollouts=True,
+                                paginate=fake.paginate), \
+            mock.patch.object(rollouts.time, 'time', return_value=100):
+        # events from an earlier update are never read
+        fake.add(get_event('old', 10, 'UPDATE_COMPLETE'))
+        rollouts.started(STACK, STACK)
+        yield fake
+
+
+def follow():
+    """Read the fake events and return the rollouts that finished."""
+    return rollouts.follow(lambda target: None)
+
+
+class TestFollow(object):
+    """Validate following updates to a terminal status."""
+
+    def test_records_duration_and_resources(self, tracked):
+        """Test a finished update records its duration per resource."""
+        tracked.add(
+            get_event('1', 101, 'UPDATE_IN_PROGRESS'),
+            get_event('2', 102, 'UPDATE_IN_PROGRESS', 'Queue', 'Q'),
+            get_event('3', 130, 'UPDATE_COMPLETE', 'Queue', 'Q'))
+        assert follow() == []
+        read = tracked.read
+
+        tracked.add(get_event('4', 161, 'UPDATE_COMPLETE'))
+        assert follow() == [{'finished': 161, 'duration': 60,
+                             'outcome': 'succeeded',
+                             'resources': {'Queue': 28}}]
+        # only the new event and the page it shares were read again
+        assert tracked.read - read == 2
+        assert rollouts.get_summary()['in_progress'] == 0
+
+    def test_ignores_previous_update_in_skew_window(self, tracked):
+        """Test an earlier update's last event does not end the rollout."""
+        tracked.add(get_event('prior', 70, 'UPDATE_COMPLETE'),
+                    get_event('1', 101, 'UPDATE_IN_PROGRESS'))
+        assert follow() == []
+        tracked.add(get_event('2', 131, 'UPDATE_COMPLETE'))
+        finished, = follow()
+        assert (finished['finished'], finished['duration']) == (131, 30)
+
+    def test_gives_up_after_ttl(self, tracked):
+        """Test an update with no terminal event ends as unknown."""
+        with mock.patch.object(rollouts.time, 'time',
+                               return_value=100 + rollouts.rollout_ttl + 1):
+            assert follow()[0]['outcome'] == 'unknown'
+
+
+class TestSharedStore(object):
+    """Validate rollouts kept in the shared state store."""
+
+    def test_followed_from_another_environment(self, state_table):
+        """Test an update started in one environment ends in another."""
+        fake = FakeEvents()
+        starter = state_store.DynamoDBStateStore(state_table)
+        tracker = state_store.DynamoDBStateStore(state_table)
+        with mock.patch.multiple(rollouts, track_rollouts=True,
+                                 paginate=fake.paginate), \
+                mock.patch.object(rollouts.time, 'time', return_value=100):
+            with mock.patch.object(state_store, 'state_store', starter):
+                rollouts.started(STACK, STACK, ('role-arn', 'us-west-2'))
+            fake.add(get_event('1', 101, 'UPDATE_IN_PROGRESS'),
+                     get_event('2', 131, 'UPDATE_COMPLETE'))
+            with mock.patch.object(state_store, 'state_store', tracker):
+                assert [record['duration'] for record in follow()] == [30]
+                assert follow() == []
+        with mock.patch.object(state_store, 'state_store', starter):
+            assert rollouts.get_summary()['count'] == 1
+
+
+class TestSummary(object):
+    """Validate the rollout summary."""
+
+    def test_percentiles_and_slowing(self):
+        """Test percentiles cover all stacks and slow stacks stand out."""
+        store = state_store.MemoryStateStore()
+        durations = {'steady': [10, 11, 12, 11], 'slowing': [10, 10, 40]}
+        for stack_name, history in durations.items():
+            store.set('rollout-history:{}'.format(stack_name), [
+                {'duration': duration, 'outcome': 'succeeded'}
+                for duration in history])
+        with mock.patch.object(state_store, 'state_store', store):
+            summary = rollouts.get_summary()
+        assert summary['count'] == 7
+        assert summary['p50'] == 11
+        assert summary['p99'] == 40
+        assert summary['outcomes'] == {'succeeded': 7}
+        assert summary['slowing'] == ['slowing']
+
+    def test_started_is_off_by_default(self):
+        """Test nothing is followed unless tracking is enabled."""
+        store = state_store.MemoryStateStore()
+        with mock.patch.object(state_store, 'state_store', store):
+            rollouts.started(STACK, STACK)
+        assert store.items('rollout:') == []
@@ -0,0 +1,26 @@
+"""Perform unit test on rule_targets.py."""
+
+import json
+
+from rule_targets import (SCHEDULED_TIME_KEY, get_input_transformer,
+                          get_rule_input)
+
+EVENT_CONSTANT = {'stack_name': 'test-stack',
+                  'toggle_parameter': 'ForceUpdateToggle',
+                  'toggle_values': ['A', 'B']}
+
+
+def test_transformer_input_is_read_back():
+    """Test a rule input reads back without its scheduled time."""
+    transformer = get_input_transformer(EVENT_CONSTANT)
+    template = json.loads(transformer['InputTemplate'])
+    assert template[SCHEDULED_TIME_KEY] == '<time>'
+    assert get_rule_input([{'InputTransformer': transformer}]) == \
+        EVENT_CONSTANT
+
+
+def test_constant_input_is_read_back():
+    """Test targets written before the scheduled time are still read."""
+    assert get_rule_input([{'Input': json.dumps(EVENT_CONSTANT)}]) == \
+        EVENT_CONSTANT
+    assert get_rule_input([{'Id': 'no-input'}]) == {}
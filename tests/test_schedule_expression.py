@@ -0,0 +1,142 @@
+"""Perform unit test on schedule_expression.py."""
+
+from datetime import datetime, timezone
+
+import mock
+import pytest
+
+from schedule_expression import (get_offset, jitter, next_fire_time, parse,
+                                 preview)
+
+
+def utc(*args):
+    """Return an aware UTC datetime."""
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class TestParse(object):
+    """Validate schedule expression parsing."""
+
+    def test_rate(self):
+        """Test rate() expressions resolve to a period in seconds."""
+        assert parse('rate(5 minutes)') == ('rate', 300)
+        assert parse('rate(1 day)') == ('rate', 86400)
+
+    @pytest.mark.parametrize('expression', [
+        'rate(0 minutes)',
+        'rate(5 weeks)',
+        'cron(0 12 * * * *)',
+        'cron(0 12 * *)',
+        'every 5 minutes',
+    ])
+    def test_invalid(self, expression):
+        """Test unsupported expressions are rejected."""
+        with pytest.raises(ValueError):
+            parse(expression)
+
+
+class TestNextFireTime(object):
+    """Validate fire time calculation."""
+
+    def test_rate_is_anchored(self):
+        """Test rate() periods repeat from the anchor."""
+        anchor = utc(2018, 1, 1, 0, 0)
+        after = utc(2018, 1, 1, 0, 7)
+        assert next_fire_time('rate(5 minutes)', after, anchor) == utc(
+            2018, 1, 1, 0, 10)
+
+    def test_rate_is_strictly_after(self):
+        """Test a fire time equal to the moment is skipped."""
+        anchor = utc(2018, 1, 1, 0, 0)
+        after = utc(2018, 1, 1, 0, 10)
+        assert next_fire_time('rate(5 minutes)', after, anchor) == utc(
+            2018, 1, 1, 0, 15)
+
+    def test_cron_daily(self):
+        """Test a daily cron() rolls over to the next day."""
+        after = utc(2018, 1, 1, 12, 30)
+        assert next_fire_time('cron(15 10 * * ? *)', after) == utc(
+            2018, 1, 2, 10, 15)
+
+    def test_cron_weekday(self):
+        """Test named weekdays use the cron() Sunday-first numbering."""
+        # 2018-01-01 is a Monday
+        after = utc(2018, 1, 1, 0, 0)
+        assert next_fire_time('cron(0 8 ? * FRI *)', after) == utc(
+            2018, 1, 5, 8, 0)
+
+    def test_cron_step(self):
+        """Test minute steps."""
+        after = utc(2018, 1, 1, 0, 16)
+        assert next_fire_time('cron(0/15 * * * ? *)', after) == utc(
+            2018, 1, 1, 0, 30)
+
+    @pytest.mark.parametrize('expression, after, expected', [
+        ('cron(0 8 L * ? *)', utc(2018, 2, 1), utc(2018, 2, 28, 8, 0)),
+        # 2018-03-31 is a Saturday
+        ('cron(0 8 LW * ? *)', utc(2018, 3, 1), utc(2018, 3, 30, 8, 0)),
+        # 2018-04-01 is a Sunday
+        ('cron(0 8 1W * ? *)', utc(2018, 3, 31), utc(2018, 4, 2, 8, 0)),
+        ('cron(0 8 ? * 6L *)', utc(2018, 2, 1), utc(2018, 2, 23, 8, 0)),
+        ('cron(0 8 ? * TUE#2 *)', utc(2018, 2, 1), utc(2018, 2, 13, 8, 0)),
+        ('cron(0 8 ? * L *)', utc(2018, 2, 1), utc(2018, 2, 3, 8, 0)),
+    ])
+    def test_cron_special_days(self, expression, after, expected):
+        """Test the L, W and # day tokens of AWS cron()."""
+        assert next_fire_time(expression, after) == expected
+
+    @pytest.mark.parametrize('expression', [
+        'cron(0 8 32W * ? *)',
+        'cron(0 8 ? * MON#6 *)',
+        'cron(0 8 ? * XL *)',
+    ])
+    def test_invalid_special_days(self, expression):
+        """Test malformed L, W and # tokens are rejected."""
+        with pytest.raises(ValueError):
+            parse(expression)
+
+
+class TestJitter(object):
+    """Validate deterministic schedule jitter."""
+
+    def test_offset_is_stable_and_bounded(self):
+        """Test offsets repeat per stack and stay inside the window."""
+        offsets = [get_offset('stack-{}'.format(index), 3600)
+                   for index in range(300)]
+        assert offsets == [get_offset('stack-{}'.format(index), 3600)
+                           for index in range(300)]
+        assert all(0 <= offset < 60 for offset in offsets)
+        assert len(set(offsets)) > 50
+
+    def test_zero_window_is_unchanged(self):
+        """Test a window under a minute disables jitter."""
+        assert jitter('rate(1 day)', 'test-stack', 0) == 'rate(1 day)'
+
+    @pytest.mark.parametrize('expression, expected', [
+        ('rate(1 day)', 'cron(30 4 * * ? *)'),
+        ('rate(6 hours)', 'cron(30 4/6 * * ? *)'),
+        ('rate(15 minutes)', 'cron(0/15 * * * ? *)'),
+        ('rate(2 days)', 'rate(2 days)'),
+        ('cron(0 8 ? * FRI *)', 'cron(30 12 ? * FRI *)'),
+        ('cron(0 * * * ? *)', 'cron(30 * * * ? *)'),
+        ('cron(0/5 * * * ? *)', 'cron(0/5 * * * ? *)'),
+        ('cron(0 10 L * ? *)', 'cron(30 14 L * ? *)'),
+    ])
+    def test_jitter(self, expression, expected):
+        """Test each expression is shifted by the stack's offset."""
+        with mock.patch('schedule_expression.get_offset', return_value=270):
+            assert jitter(expression, 'test-stack', 86400) == expected
+
+    def test_cron_shift_stays_on_the_same_day(self):
+        """Test late cron() times wrap within their day."""
+        with mock.patch('schedule_expression.get_offset', return_value=45):
+            assert jitter('cron(30 23 ? * MON *)', 'test-stack',
+                          3600) == 'cron(45 23 ? * MON *)'
+
+    def test_keeps_the_average_cadence(self):
+        """Test a jittered rate() still fires once per period."""
+        jittered, fire_times = preview('rate(1 day)', 'test-stack', 86400,
+                                       count=3, after=utc(2018, 1, 1, 0, 0))
+        assert jittered.startswith('cron(')
+        assert [(later - earlier).total_seconds() for earlier, later in
+                zip(fire_times, fire_times[1:])] == [86400, 86400]
@@ -0,0 +1,108 @@
+"""Perform unit test on schedule_table.py."""
+
+from datetime import datetime, timedelta, timezone
+
+import boto3
+import pytest
+from moto import mock_dynamodb
+
+import schedule_expression
+import schedule_table
+
+
+@pytest.fixture
+def table():
+    """Create the schedule table with its due index."""
+    with mock_dynamodb():
+        dynamodb = boto3.client('dynamodb')
+        dynamodb.create_table(
+            TableName=schedule_table.table_name,
+            AttributeDefinitions=[
+                {'AttributeName': 'stack_name', 'AttributeType': 'S'},
+                {'AttributeName': 'shard', 'AttributeType': 'S'},
+                {'AttributeName': 'next_run', 'AttributeType': 'N'},
+            ],
+            KeySchema=[{'AttributeName': 'stack_name', 'KeyType': 'HASH'}],
+            GlobalSecondaryIndexes=[{
+                'IndexName': schedule_table.DUE_INDEX,
+                'KeySchema': [
+                    {'AttributeName': 'shard', 'KeyType': 'HASH'},
+                    {'AttributeName': 'next_run', 'KeyType': 'RANGE'},
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+            }],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        yield dynamodb
+
+
+class TestScheduleTable(object):
+    """Validate schedule registration and claiming."""
+
+    def test_claim_due_stacks(self, table):
+        """Test only due stacks are claimed, and only once."""
+        now = datetime(2018, 1, 1, tzinfo=timezone.utc)
+        schedule_table.put_schedule('fast-stack', 'rate(5 minutes)',
+                                    'ForceUpdateToggle', ['A', 'B'], now)
+        schedule_table.put_schedule('slow-stack', 'rate(1 day)',
+                                    'ForceUpdateToggle', ['A', 'B'], now)
+
+        tick = now + timedelta(minutes=5)
+        claimed = schedule_table.claim_due_stacks(tick)
+        assert claimed == [{
+            'event_name': 'auto-update-fast-stack',
+            'stack_name': 'fast-stack',
+            'toggle_parameter': 'ForceUpdateToggle',
+            'toggle_values': ['A', 'B'],
+            'dispatched': True,
+            'scheduled_at': schedule_expression.to_timestamp(tick),
+        }]
+        assert schedule_table.claim_due_stacks(tick) == []
+
+    def test_delete_schedule(self, table):
+        """Test deleted stacks are never dispatched."""
+        now = datetime(2018, 1, 1, tzinfo=timezone.utc)
+        schedule_table.put_schedule('test-stack', 'rate(5 minutes)',
+                                    'ForceUpdateToggle', ['A', 'B'], now)
+        schedule_table.delete_schedule('test-stack')
+        tick = now + timedelta(hours=1)
+        assert schedule_table.claim_due_stacks(tick) == []
+
+    def test_claims_are_capped_per_tick(self, table):
+        """Test stacks over the cap stay due for the next tick."""
+        now = datetime(2018, 1, 1, tzinfo=timezone.utc)
+        for index in range(5):
+            schedule_table.put_schedule(
+                'stack-{}'.format(index), 'rate(5 minutes)',
+                'ForceUpdateToggle', ['A', 'B'],
+                now + timedelta(seconds=index))
+        tick = now + timedelta(minutes=6)
+        first = schedule_table.claim_due_stacks(tick, limit=3)
+        assert [stack['stack_name'] for stack in first] == [
+            'stack-0', 'stack-1', 'stack-2']
+        second = schedule_table.claim_due_stacks(tick, limit=3)
+        assert [stack['stack_name'] for stack in second] == [
+            'stack-3', 'stack-4']
+
+    def test_update_keeps_applied_fingerprint(self, table):
+        """Test re-registering a schedule keeps the applied fingerprint."""
+        now = datetime(2018, 1, 1, tzinfo=timezone.utc)
+        schedule_table.put_schedule('test-stack', 'rate(5 minutes)',
+                                    'ForceUpdateToggle', ['A', 'B'], now,
+                                    fingerprint_inputs={'ssm': ['/ami']},
+                                    stack_target={'region': 'us-west-2'})
+        schedule_table.set_applied_fingerprint('test-stack', 'abc')
+        schedule_table.put_schedule('test-stack', 'rate(1 hour)',
+                                    'ForceUpdateToggle', ['A', 'B'], now)
+        assert schedule_table.get_applied_fingerprint('test-stack') == 'abc'
+        tick = now + timedelta(hours=1)
+        descriptor, = schedule_table.claim_due_stacks(tick)
+        assert 'fingerprint_inputs' not in descriptor
+        assert 'region' not in descriptor
+
+    def test_defer_skips_deleted_schedule(self, table):
+        """Test deferring a deleted schedule does not recreate it."""
+        schedule_table.defer_schedule('test-stack', 1514764800)
+        item = table.get_item(TableName=schedule_table.table_name,
+                              Key={'stack_name': {'S': 'test-stack'}})
+        assert 'Item' not in item
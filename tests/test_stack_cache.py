@@ -0,0 +1,70 @@
+"""Perform unit test on stack_cache.py."""
+
+from datetime import datetime
+
+import boto3
+import pytest
+from moto import mock_cloudformation
+
+from stack_cache import StackCache
+
+TEMPLATE = ('{"Parameters": {"Toggle": {"Type": "String"}}, '
+            '"Resources": {"Queue": {"Type": "AWS::SQS::Queue"}}}')
+
+
+@pytest.fixture
+def cfn():
+    """Create mock stacks."""
+    with mock_cloudformation():
+        cfn = boto3.client('cloudformation')
+        for stack_name in ('stack-a', 'stack-b'):
+            cfn.create_stack(
+                StackName=stack_name, TemplateBody=TEMPLATE,
+                Parameters=[{'ParameterKey': 'Toggle',
+                             'ParameterValue': 'A'}])
+        yield cfn
+
+
+class TestStackCache(object):
+    """Validate stack metadata caching."""
+
+    def test_get_is_cached(self, cfn):
+        """Test a second lookup inside the TTL is served from cache."""
+        cache = StackCache(60)
+        first = cache.get('stack-a')
+        second = cache.get('stack-a')
+        assert first == second
+        assert cache.stats['misses'] == 1
+        assert cache.stats['hits'] == 1
+
+    def test_get_returns_copies(self, cfn):
+        """Test callers cannot edit the cached parameters."""
+        cache = StackCache(60)
+        cache.get('stack-a')['Parameters'][0].pop('ParameterValue')
+        assert cache.get('stack-a')['Parameters'][0][
+            'ParameterValue'] == 'A'
+
+    def test_expired_entries_are_reloaded(self, cfn):
+        """Test a zero TTL always describes the stack."""
+        cache = StackCache(0)
+        cache.get('stack-a')
+        cache.get('stack-a')
+        assert cache.stats['misses'] == 2
+
+    def test_prime(self, cfn):
+        """Test priming loads the named stacks in one sweep."""
+        cache = StackCache(60)
+        assert cache.prime(['stack-b']) == 1
+        cache.get('stack-b')
+        assert cache.stats['hits'] == 1
+        assert cache.lookup('stack-a') is None
+
+    def test_changed_update_time_invalidates(self, cfn):
+        """Test a newer LastUpdatedTime replaces the cached entry."""
+        cache = StackCache(60)
+        stack = cache.get('stack-a')
+        stack['LastUpdatedTime'] = datetime(2030, 1, 1)
+        stack['StackStatus'] = 'UPDATE_IN_PROGRESS'
+        cache.store(stack)
+        assert cache.stats['invalidations'] == 1
+        assert cache.get('stack-a')['StackStatus'] == 'UPDATE_IN_PROGRESS'
@@ -0,0 +1,49 @@
+"""Perform unit test on state_store.py."""
+
+import pytest
+
+import state_store
+
+
+@pytest.fixture
+def store(state_table):
+    """Return a store on the shared state table."""
+    return state_store.DynamoDBStateStore(state_table)
+
+
+class TestDynamoDBStateStore(object):
+    """Validate the shared state store."""
+
+    def test_values_round_trip(self, store):
+        """Test values come back as they were stored."""
+        store.set('deferred:stack', {'retry_at': 1.5, 'descriptor': {}})
+        assert store.get('deferred:stack') == {'retry_at': 1.5,
+                                               'descriptor': {}}
+        assert store.get('deferred:other', 'missing') == 'missing'
+
+    def test_items_by_prefix(self, store):
+        """Test a prefix returns only its own keys."""
+        store.set('rollout:a', 1)
+        store.set('rollout-history:a', [2])
+        store.set('ordered-rollout', {'level': 0})
+        assert store.items('rollout:') == [('rollout:a', 1)]
+        assert store.items('rollout-history:') == [('rollout-history:a',
+                                                    [2])]
+        assert store.get('ordered-rollout') == {'level': 0}
+
+    def test_take_hands_out_a_value_once(self, store):
+        """Test only the first take of a key gets its value."""
+        store.set('deferred:stack', {'retry_at': 1})
+        assert store.take('deferred:stack') == {'retry_at': 1}
+        assert store.take('deferred:stack') is None
+        store.delete('deferred:stack')
+        assert store.items('deferred:') == []
+
+    def test_replace_needs_the_expected_value(self, store):
+        """Test a conditional write fails once another caller changed it."""
+        store.set('ordered-rollout', {'level': 0, 'levels': [['a']]})
+        plan = store.get('ordered-rollout')
+        assert store.replace('ordered-rollout', plan, dict(plan, level=1))
+        assert not store.replace('ordered-rollout', plan,
+                                 dict(plan, level=1))
+        assert store.get('ordered-rollout')['level'] == 1
@@ -0,0 +1,96 @@
+"""Perform unit test on structured_logging.py."""
+
+import json
+import logging
+
+import mock
+import pytest
+
+import structured_logging
+from structured_logging import LogEvent
+
+ASSUME_ROLE_RESPONSE = {
+    'Credentials': {
+        'AccessKeyId': 'AKIAEXAMPLE',
+        'SecretAccessKey': 'secret-key',
+        'SessionToken': 'session-token',
+    },
+    'AssumedRoleUser': {'Arn': 'arn:aws:sts::123456789012:assumed-role/x'},
+}
+
+
+@pytest.fixture
+def structured():
+    """Switch to structured mode with short fields."""
+    with mock.patch.object(structured_logging, 'log_mode', 'structured'), \
+            mock.patch.object(structured_logging, 'field_length', 20), \
+            mock.patch.object(structured_logging, 'sampled', True):
+        yield
+
+
+@pytest.fixture
+def log(caplog):
+    """Return a filtered logger whose records are captured."""
+    caplog.set_level(logging.INFO)
+    return structured_logging.get_logger('test_structured_logging')
+
+
+class TestRedact(object):
+    """Validate secret redaction."""
+
+    def test_redacts_credentials(self):
+        """Test assume_role credentials never reach the message."""
+        message = LogEvent('assume_role', response=ASSUME_ROLE_RESPONSE)
+        assert 'secret-key' not in str(message)
+        assert 'session-token' not in str(message)
+        assert 'assumed-role' in str(message)
+
+    def test_strips_response_url_signature(self):
+        """Test the pre-signed response url loses its query string."""
+        event = {'ResponseURL': 'https://bucket.s3.amazonaws.com/key'
+                                '?X-Amz-Signature=abc'}
+        assert structured_logging.redact(event) == {
+            'ResponseURL': 'https://bucket.s3.amazonaws.com/key?***'}
+
+
+class TestLogEvent(object):
+    """Validate rendering."""
+
+    def test_renders_lazily(self, log):
+        """Test fields are not formatted for dropped records."""
+        field = mock.MagicMock()
+        with mock.patch.object(structured_logging, 'sampled', False):
+            log.info(LogEvent('dropped', field=field))
+        field.__str__.assert_not_called()
+
+    def test_structured_fields_are_truncated(self, structured, log, caplog):
+        """Test structured INFO records are JSON with truncated fields."""
+        log.info(LogEvent('put_targets', response='x' * 50))
+        record = json.loads(caplog.records[-1].getMessage())
+        assert record == {'message': 'put_targets',
+                          'response': 'x' * 20 + '...<30 more>'}
+
+    def test_error_path_is_not_truncated(self, structured, log, caplog):
+        """Test errors keep every field in full."""
+        log.error(LogEvent('failed on event', event='x' * 50))
+        record = json.loads(caplog.records[-1].getMessage())
+        assert record == {'message': 'failed on event', 'event': 'x' * 50}
+
+
+class TestSampling(object):
+    """Validate success-path sampling."""
+
+    def test_unsampled_invocation_keeps_errors(self, structured, log, caplog):
+        """Test unsampled invocations drop INFO but keep errors."""
+        with mock.patch.object(structured_logging, 'sample_rate', 0), \
+                mock.patch.object(structured_logging, 'sampled', True):
+            assert not structured_logging.start_invocation()
+            log.info(LogEvent('put_targets', response='ok'))
+            log.error(LogEvent('failed on event', event='boom'))
+        assert [record.levelname for record in caplog.records] == ['ERROR']
+
+    def test_full_mode_is_never_sampled(self):
+        """Test the default mode keeps every invocation."""
+        with mock.patch.object(structured_logging, 'sample_rate', 0), \
+                mock.patch.object(structured_logging, 'sampled', True):
+            assert structured_logging.start_invocation()
@@ -0,0 +1,62 @@
+"""Perform unit test on update_queue.py."""
+
+import boto3
+import pytest
+from moto import mock_sqs
+
+import aws_clients
+import update_queue
+
+
+def get_intent(index):
+    """Return an update intent for a numbered stack."""
+    return {'stack_name': 'stack-{}'.format(index),
+            'toggle_parameter': 'ForceUpdateToggle',
+            'toggle_values': ['A', 'B']}
+
+
+@pytest.fixture(params=['memory', 'sqs'])
+def queue(request):
+    """Return each queue backend in turn."""
+    if request.param == 'memory':
+        yield update_queue.MemoryQueue(300)
+        return
+    with mock_sqs():
+        aws_clients.clients.clear()
+        queue_url = boto3.client('sqs').create_queue(
+            QueueName='updates')['QueueUrl']
+        yield update_queue.SqsQueue(queue_url, 300)
+        aws_clients.clients.clear()
+
+
+def receive_all(queue):
+    """Receive every visible intent."""
+    received = []
+    while True:
+        messages = queue.receive(10)
+        if not messages:
+            return received
+        received.extend(messages)
+
+
+class TestQueues(object):
+    """Validate the queue interface of each backend."""
+
+    def test_send_receive_delete(self, queue):
+        """Test received intents stay hidden until deleted or released."""
+        queue.send([get_intent(index) for index in range(12)])
+        received = receive_all(queue)
+        assert sorted(message['intent']['stack_name']
+                      for message in received) == sorted(
+            'stack-{}'.format(index) for index in range(12))
+        assert queue.receive(10) == []
+
+        queue.release([received[0]['id']])
+        queue.delete([message['id'] for message in received[1:]])
+        assert [message['intent'] for message in receive_all(queue)] == [
+            received[0]['intent']]
+
+    def test_receive_respects_limit(self, queue):
+        """Test receive never returns more than asked for."""
+        queue.send([get_intent(index) for index in range(5)])
+        assert len(queue.receive(2)) <= 2
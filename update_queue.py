@@ -0,0 +1,155 @@
+"""Buffer stack update intents between the schedule rules and update_stack.
+
+Rules enqueue intents with ``send``, and a consumer later takes them with
+``receive``. A consumer then either acknowledges intents with ``delete`` or
+makes them visible again with ``release``. ``memory`` queues live as long
+as the execution environment and are meant for tests and local runs.
+``sqs`` queues are durable across invocations.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+from aws_clients import call, get_client
+from structured_logging import LogEvent, get_logger
+
+log = get_logger(__name__)
+
+# 'none' updates stacks as their rules fire, 'memory' or 'sqs' buffers them
+update_queue_type = os.environ.get('UPDATE_QUEUE', 'none')
+update_queue_url = os.environ.get('UPDATE_QUEUE_URL')
+# seconds a received intent stays hidden from other consumers
+visibility_timeout = int(os.environ.get('QUEUE_VISIBILITY_TIMEOUT', '300'))
+
+# SQS accepts at most ten entries per batch call
+SQS_BATCH_SIZE = 10
+
+
+def chunks(items, size):
+    """Yield consecutive slices of a list."""
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+class MemoryQueue(object):
+    """Queue intents in memory with SQS-like visibility."""
+
+    def __init__(self, visibility_timeout):
+        """Define an empty queue."""
+        self.visibility_timeout = visibility_timeout
+        self.messages = {}
+        self.lock = threading.Lock()
+
+    def send(self, intents):
+        """Add intents to the queue."""
+        with self.lock:
+            for intent in intents:
+                self.messages[str(uuid.uuid4())] = {
+                    'intent': intent, 'visible_at': 0}
+
+    def receive(self, max_messages):
+        """Return up to max_messages visible intents, hiding them."""
+        now = time.time()
+        received = []
+        with self.lock:
+            for receipt, message in self.messages.items():
+                if len(received) >= max_messages:
+                    break
+                if message['visible_at'] <= now:
+                    message['visible_at'] = now + self.visibility_timeout
+                    received.append({'id': receipt,
+                                     'intent': message['intent']})
+        return received
+
+    def delete(self, receipts):
+        """Acknowledge received intents."""
+        with self.lock:
+            for receipt in receipts:
+                self.messages.pop(receipt, None)
+
+    def release(self, receipts):
+        """Make received intents visible again straight away."""
+        with self.lock:
+            for receipt in receipts:
+                if receipt in self.messages:
+                    self.messages[receipt]['visible_at'] = 0
+
+    def __len__(self):
+        """Return the number of queued intents."""
+        with self.lock:
+            return len(self.messages)
+
+
+class SqsQueue(object):
+    """Queue intents in an SQS queue."""
+
+    def __init__(self, queue_url, visibility_timeout):
+        """Define the queue."""
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+
+    def send(self, intents):
+        """Add intents to the queue, ten per call."""
+        for batch in chunks(list(intents), SQS_BATCH_SIZE):
+            response = call(get_client('sqs'), 'send_message_batch',
+                            QueueUrl=self.queue_url, Entries=[
+                                {'Id': str(index),
+                                 'MessageBody': json.dumps(intent)}
+                                for index, intent in enumerate(batch)])
+            if response.get('Failed'):
+                raise RuntimeError('Failed to queue intents: {}'.format(
+                    response['Failed']))
+
+    def receive(self, max_messages):
+        """Return up to max_messages visible intents, hiding them."""
+        response = call(get_client('sqs'), 'receive_message',
+                        QueueUrl=self.queue_url,
+                        MaxNumberOfMessages=max(1, min(max_messages,
+                                                       SQS_BATCH_SIZE)),
+                        VisibilityTimeout=self.visibility_timeout,
+                        WaitTimeSeconds=0)
+        return [{'id': message['ReceiptHandle'],
+                 'intent': json.loads(message['Body'])}
+                for message in response.get('Messages', [])]
+
+    def delete(self, receipts):
+        """Acknowledge received intents, ten per call."""
+        for batch in chunks(list(receipts), SQS_BATCH_SIZE):
+            call(get_client('sqs'), 'delete_message_batch',
+                 QueueUrl=self.queue_url, Entries=[
+                     {'Id': str(index), 'ReceiptHandle': receipt}
+                     for index, receipt in enumerate(batch)])
+
+    def release(self, receipts):
+        """Make received intents visible again straight away."""
+        for batch in chunks(list(receipts), SQS_BATCH_SIZE):
+            call(get_client('sqs'), 'change_message_visibility_batch',
+                 QueueUrl=self.queue_url, Entries=[
+                     {'Id': str(index), 'ReceiptHandle': receipt,
+                      'VisibilityTimeout': 0}
+                     for index, receipt in enumerate(batch)])
+
+
+UPDATE_QUEUES = {
+    'memory': lambda: MemoryQueue(visibility_timeout),
+    'sqs': lambda: SqsQueue(update_queue_url, visibility_timeout),
+}
+
+update_queue = None
+update_queue_lock = threading.Lock()
+
+
+def get_update_queue():
+    """Return the configured queue, or None when updates are not queued."""
+    global update_queue
+    if update_queue_type == 'none':
+        return None
+    with update_queue_lock:
+        if update_queue is None:
+            update_queue = UPDATE_QUEUES[update_queue_type]()
+            log.info(LogEvent('Using update queue',
+                              type=update_queue_type))
+        return update_queue